@@ -7,7 +7,17 @@ import os
 
 ######### Settings for Data Dictionary
 EXPERIMENT_LIST = ['historical', 'ssp126', 'ssp370', 'ssp245', 'ssp585']
+# Variables processed by subcomponents A-C. Each model's datasets are found
+# with a single catalog search and regridded once for all of its variables
+VARIABLE_IDS = ['tas', 'tasmin', 'tasmax', 'pr']
+# Variable of the BEST observations (subcomponent D)
 VARIABLE_ID = 'tas'
+# Conversion of each variable from its CMIP6 units: values*scale + offset.
+# Variables that are not listed keep their CMIP6 units
+UNIT_CONVERSIONS = {'tas': {'scale': 1., 'offset': -273.15, 'units': 'degC'},
+                    'tasmin': {'scale': 1., 'offset': -273.15, 'units': 'degC'},
+                    'tasmax': {'scale': 1., 'offset': -273.15, 'units': 'degC'},
+                    'pr': {'scale': 86400., 'offset': 0., 'units': 'mm/day'}}
 TABLE_ID = 'Amon'
 GRID_LABEL = 'gn'
 
@@ -30,5 +40,123 @@ DIR_DATA_INTERMED = DIR_DATA + 'intermediate_processed_data/'
 DIR_INTERMEDIATE_PROCESSED_MODEL_DATA = DIR_DATA_INTERMED + 'Processed_Model_Data/'
 DIR_INTERMEDIATE_OBSERVATION_DATA = DIR_DATA_INTERMED + 'Raw_Historical_Observations/'
 DIR_PROCESSED_DATA = DIR_DATA + 'processed_data/'
+DIR_REGRID_WEIGHTS = DIR_DATA_INTERMED + 'Regridding_Weights/'
 
 DIR_GOOGLE_DRIVE_PERMISSIONS = DIR_DATA + 'catalogs/'
+
+######### Floating Point Precision
+# dtype of the data computed and saved by subcomponents B, C, and D. Running
+# sums, means, and sums of squares (across models and over time) are still
+# accumulated in float64
+DATA_DTYPE = 'float32'
+
+######### Regridding Settings
+# Either 'xesmf' (needs ESMF) or 'sparse' (scipy.sparse weights, see sparse_regrid.py)
+REGRID_BACKEND = 'xesmf'
+WEIGHT_CACHE_MAX_BYTES = 2 * 1024**3
+WEIGHT_CACHE_MAX_AGE_DAYS = 90
+# Weight files still being generated (see temporary_weight_path) that were
+# last written longer ago than this were left by a killed run and are evicted
+WEIGHT_TMP_MAX_AGE_HOURS = 12
+# Method used to regrid the BEST observations onto the reference grid of the
+# models (nearest, so that cells without observations are not blended in)
+OBS_REGRID_METHOD = 'nearest_s2d'
+
+######### Parallel Processing of Model Datasets
+# Number of datasets processed at once in subcomponent B (1 runs in serial)
+NUM_WORKERS = 1
+# Either 'processes' (local process pool) or 'dask' (local dask cluster)
+PARALLEL_BACKEND = 'processes'
+# Maximum bytes of resident memory of each worker (checked while each task
+# runs with the 'processes' backend, and by the nanny of each dask worker),
+# or None for no limit
+WORKER_MEMORY_LIMIT = None
+# Seconds between checks of the memory of a task with a WORKER_MEMORY_LIMIT
+MEMORY_CHECK_SECONDS = 0.5
+# Maximum bytes of the block of all ensemble members read at once when
+# averaging over the members of a lazy dataset
+ENSEMBLE_BLOCK_BYTES = 128 * 1024**2
+
+######### Model Weighting
+# How models are weighted in the multi-model statistics of subcomponent C:
+# 'equal', 'table' (read from MODEL_WEIGHTS_FILE, with 'model' and 'weight'
+# columns), or 'skill' (skill against the BEST observations times the
+# independence of model families, see model_weights.py)
+MODEL_WEIGHTING = 'equal'
+MODEL_WEIGHTS_FILE = DIR_DATA_INTERMED + 'model_weights.csv'
+# Family of models whose family is not the part of their name before the
+# first '-' (e.g. 'CESM2-WACCM' is already in the 'CESM2' family)
+MODEL_FAMILIES = {}
+# Years of the historical climatologies compared with the observations
+SKILL_PERIOD = ('1980', '2014')
+# Error scale of the skill weights (None for the median error of all models)
+SKILL_SIGMA = None
+
+######### Time Alignment of Models
+# Time axis of the multi-model statistics of models that cover different
+# months: 'intersection' (only months every model covers) or 'union' (every
+# month any model covers; the statistics skip models without the month)
+TIME_ALIGNMENT = 'intersection'
+
+######### Multi-Model Quantiles
+# Quantiles across models written by subcomponent C (0.5 is named 'median',
+# the others 'q05', 'q95', etc.)
+QUANTILES = [0.05, 0.1, 0.5, 0.9, 0.95]
+# With more models than this, quantiles are approximated with a sketch that
+# keeps a bounded number of models in memory (None to always be exact)
+QUANTILE_SKETCH_SIZE = None
+
+######### Parallel Processing of Multi-Model Statistics
+# Number of latitude bands computed at once in subcomponent C (None for one
+# per core, 1 runs in serial)
+BAND_WORKERS = 1
+# Either 'threads' or 'processes'
+BAND_BACKEND = 'threads'
+# Maximum bytes of memory for the bands in progress, or None for half of the
+# available memory
+BAND_MEMORY_BUDGET = 1024**3
+# Number of model slices read ahead while the current slice is reduced (0 to
+# read each slice when it is needed)
+PREFETCH_DEPTH = 2
+
+######### Zarr Output Settings
+# Chunk size of each dimension in the zarr files (-1 is the whole dimension)
+ZARR_CHUNKS = {'time': -1, 'lat': 10, 'lon': 10}
+# Blosc compression of the data variables of every zarr file: the codec
+# ('zstd', 'lz4', 'zlib', ...), its level (1-9), and the shuffle ('none',
+# 'byte', or 'bit'). None uses zarr's default compressor
+ZARR_COMPRESSOR = {'cname': 'zstd', 'clevel': 5, 'shuffle': 'bit'}
+# Number of significant decimal digits kept by rounding the mantissa of
+# floating point data variables before compression (e.g. 4 keeps 0.01 C at
+# 15 C and 0.001 mm/day at 2 mm/day), or None to keep every bit
+ZARR_QUANTIZE_DIGITS = None
+# Maximum bytes of data held in memory at once while writing a zarr file
+ZARR_MEMORY_BUDGET = 512 * 1024**2
+# Chunk layouts of the processed data files read by the dashboard. 'series'
+# files hold all times of a few grid cells in each chunk (for time series at
+# a point), 'map' files hold the whole globe for a few times in each chunk
+CHUNK_LAYOUTS = {'series': {'time': -1, 'lat': 10, 'lon': 10},
+                 'map': {'time': 12, 'lat': -1, 'lon': -1}}
+LAYOUT_SUFFIXES = {'series': '', 'map': '_map'}
+PROCESSED_LAYOUTS = ['series', 'map']
+
+######### Temporal Products
+# Lengths in years of the rolling climatology windows
+CLIMATOLOGY_WINDOWS = [20, 30]
+# Time means of the monthly data written by subcomponents C and D, each to
+# its own zarr file next to the monthly one (with the suffix before the
+# layout suffix, e.g. modelData_tas_ssp126_annual_map.zarr)
+TEMPORAL_PRODUCTS = ['annual', 'seasonal'] + ['climatology' + str(window)
+                                              for window in CLIMATOLOGY_WINDOWS]
+PRODUCT_SUFFIXES = dict(monthly='', **{product: '_' + product
+                                       for product in TEMPORAL_PRODUCTS})
+# Variables averaged in the temporal products. Time means of the multi-model
+# min, max, std, and quantiles are not the statistics of the models' time
+# means, so only the multi-model mean is averaged
+PRODUCT_VARIABLES = ['mean']
+
+######### Dashboard Indexes
+# Directory of the indexes the dashboard reads instead of searching the
+# processed data (e.g. the nearest grid cell index of the reference grid, and
+# the tables of the time series at every city)
+DIR_DASHBOARD_INDEXES = DIR_PROCESSED_DATA + 'dashboard_indexes/'
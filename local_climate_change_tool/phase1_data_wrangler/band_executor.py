@@ -0,0 +1,370 @@
+"""
+band_executor.py
+
+Computes the multi-model statistics of several latitude bands at once on a
+pool of threads or processes (see BAND_WORKERS and BAND_BACKEND).
+
+Threads share the model datasets and return their results directly. Process
+workers are started with 'spawn' (forking a process that has reader threads
+running can deadlock) and are given the (lazy) model datasets once when they
+start. They write the results of each band into a memory-mapped buffer (in
+/dev/shm when it exists) that the main process reads without any pickling
+of arrays.
+
+Quantiles across models (see quantiles.py) are computed in the same pass
+when they are asked for, and are returned under their quantile_name. If
+per-model weights are given, the mean, std, and quantiles are weighted.
+If per-model time slices are given (see time_alignment.py), each model's
+band is read onto the shared time axis of the models.
+The statistics are accumulated in float64 and returned as DATA_DTYPE.
+"""
+import os
+import tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import dask
+import numpy as np
+
+from phase1_data_wrangler.analysis_parameters import BAND_WORKERS, \
+    BAND_BACKEND, BAND_MEMORY_BUDGET, CHUNK_LAYOUTS, PREFETCH_DEPTH, DATA_DTYPE
+from phase1_data_wrangler.streaming_stats import StreamingStats
+from phase1_data_wrangler.quantiles import quantile_name, \
+    make_quantile_accumulator, quantile_memory_arrays
+from phase1_data_wrangler.prefetch_reader import prefetch, IO_STATS, \
+    reset_io_stats, merge_io_stats
+from phase1_data_wrangler.time_alignment import read_aligned_band
+
+BAND_STATS = ['mean', 'min', 'max', 'std']
+# Number of float64 arrays of the size of one model's band held in memory
+# while a band is computed: the model's values (plus PREFETCH_DEPTH read
+# ahead), the 6 running statistics (with the sum of weights), temporaries of
+# the update, and the 4 results
+ARRAYS_PER_BAND = 14 + PREFETCH_DEPTH
+BUFFER_DIR = '/dev/shm/' if os.path.isdir('/dev/shm') else tempfile.gettempdir()+'/'
+
+# The model datasets of a process worker (set when the worker starts)
+WORKER_DATASETS = dict()
+
+
+def default_num_workers():
+    """Returns the number of cores this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def available_memory():
+    """Returns the number of bytes of memory that are currently available."""
+    return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+
+
+def band_stat_names(quantiles=()):
+    """Returns the names of the statistics of a band, including quantiles."""
+    return BAND_STATS + [quantile_name(quantile) for quantile in quantiles]
+
+
+def quantile_band_arrays(num_models, quantiles=()):
+    """Returns how many more arrays of a band's size quantiles hold in memory.
+
+    These are the models kept by the quantile accumulator, a copy of them
+    while they are sorted or partitioned, and the results.
+    """
+    if not quantiles:
+        return 0
+    return 2*quantile_memory_arrays(num_models) + len(quantiles)
+
+
+def choose_band_size(ntime, nlat, nlon, num_workers=BAND_WORKERS,
+                     memory_budget=BAND_MEMORY_BUDGET,
+                     lat_chunk=CHUNK_LAYOUTS['series']['lat'], extra_arrays=0):
+    """Chooses the number of latitudes in each band.
+
+    Bands are as large as the memory budget allows with two bands in flight
+    per worker (one being computed and one waiting to be written), but small
+    enough that every worker gets a band. Bands are a whole number of lat
+    chunks of the output file, so no two bands write to the same chunk.
+
+    Args:
+        ntime, nlat, nlon: Integer sizes of the statistics.
+        num_workers: Integer number of bands computed at once (None for one
+                     per core).
+        memory_budget: Integer bytes of memory to use for the bands in
+                       flight (None for half of the available memory).
+        lat_chunk: Integer lat chunk size of the output file.
+        extra_arrays: Integer number of arrays of a band's size held in
+                      memory on top of ARRAYS_PER_BAND (e.g. for quantiles).
+    Returns:
+        band_size: Integer number of latitudes in each band.
+    """
+    if num_workers is None:
+        num_workers = default_num_workers()
+    if memory_budget is None:
+        memory_budget = available_memory()//2
+    bytes_per_lat = (ARRAYS_PER_BAND + extra_arrays)*ntime*nlon*8
+    band_size = memory_budget // (bytes_per_lat*2*num_workers)
+    band_size = min(band_size, -(-nlat // num_workers))
+    band_size = max(lat_chunk*(band_size // lat_chunk), lat_chunk)
+    return min(band_size, nlat)
+
+
+def band_bounds(nlat, band_size):
+    """Returns the first and last (exclusive) latitude index of each band."""
+    nlat0_chunk = np.arange(0, nlat, band_size)
+    nlatf_chunk = np.minimum(nlat0_chunk + band_size, nlat)
+    return [nlat0_chunk, nlatf_chunk]
+
+
+def read_model_band(dataset, varname, nlat0, nlatf, time_slice=None):
+    """Reads one latitude band of a model's variable into memory.
+
+    With a time_slice, the band is read onto the shared time axis (see
+    time_alignment.read_aligned_band).
+    """
+    if time_slice is not None:
+        return read_aligned_band(dataset, varname, nlat0, nlatf, time_slice)
+    return dataset[varname][:, nlat0:nlatf, :].values
+
+
+def band_ntime(datasets, varname, time_slices=None):
+    """Returns the number of times of the statistics of the datasets."""
+    if time_slices is not None:
+        return time_slices[0][3]
+    return datasets[0][varname].shape[0]
+
+
+def band_read_args(datasets, varname, bands, time_slices=None):
+    """Returns the read_model_band arguments of each model of each band."""
+    if time_slices is None:
+        time_slices = [None]*len(datasets)
+    return [(dataset, varname, nlat0, nlatf, time_slice)
+            for [nlat0, nlatf] in bands
+            for dataset, time_slice in zip(datasets, time_slices)]
+
+
+def reduce_band(model_bands, shape, num_models, quantiles=(), weights=None):
+    """Adds the bands of num_models models from an iterator to the statistics.
+
+    Args:
+        model_bands: Iterator over the band of each model.
+        shape: Shape of a band.
+        num_models: Integer number of models.
+        quantiles: List of quantiles across models to compute as well.
+        weights: List of the weight of each model (None for equal weights).
+    Returns:
+        Dictionary of the 'mean', 'min', 'max', and 'std' arrays of the band,
+        and of each quantile (named by quantile_name).
+    """
+    stats = StreamingStats(shape, weighted=weights is not None)
+    if weights is None:
+        weights = [1.]*num_models
+    quantile_stats = None
+    if quantiles:
+        quantile_stats = make_quantile_accumulator(shape, num_models, quantiles,
+                                                   dtype=DATA_DTYPE)
+    for weight in weights:
+        values = next(model_bands)
+        stats.add(values, weight)
+        if quantile_stats is not None:
+            quantile_stats.add(values, weight)
+    results = stats.results(DATA_DTYPE)
+    if quantile_stats is not None:
+        results.update({name: values.astype(DATA_DTYPE)
+                        for name, values in quantile_stats.results().items()})
+    return results
+
+
+def compute_band(datasets, varname, nlat0, nlatf, depth=PREFETCH_DEPTH, quantiles=(),
+                 weights=None, time_slices=None):
+    """Computes the multi-model statistics of one latitude band.
+
+    The next models' bands are read (up to depth ahead) while the current
+    model's band is added to the statistics.
+
+    Args:
+        datasets: List of the model datasets.
+        varname: String name of the variable.
+        nlat0, nlatf: Integer first and last (exclusive) latitude index.
+        depth: Integer number of models to read ahead.
+        quantiles: List of quantiles across models to compute as well.
+        weights: List of the weight of each model (None for equal weights).
+        time_slices: List of the time slice of each model (None if the
+                     models share their time axis).
+    Returns:
+        Dictionary of the 'mean', 'min', 'max', and 'std' arrays of the band,
+        and of each quantile (named by quantile_name).
+    """
+    ntime = band_ntime(datasets, varname, time_slices)
+    nlon = datasets[0][varname].shape[2]
+    read_args = band_read_args(datasets, varname, [(nlat0, nlatf)], time_slices)
+    reads = prefetch(read_model_band, read_args, depth)
+    try:
+        return reduce_band(reads, (ntime, nlatf - nlat0, nlon), len(datasets), quantiles,
+                           weights)
+    finally:
+        reads.close()
+
+
+def compute_bands(datasets, varname, bands, depth=PREFETCH_DEPTH, quantiles=(),
+                  weights=None, time_slices=None):
+    """Computes the statistics of each band in turn, reading ahead across bands.
+
+    Unlike calling compute_band for each band, reads of the first models of
+    the next band overlap with reducing the last models of the current band.
+
+    Yields:
+        (nlat0, nlatf, results) for each (nlat0, nlatf) in bands.
+    """
+    ntime = band_ntime(datasets, varname, time_slices)
+    nlon = datasets[0][varname].shape[2]
+    read_args = band_read_args(datasets, varname, bands, time_slices)
+    reads = prefetch(read_model_band, read_args, depth)
+    for [nlat0, nlatf] in bands:
+        yield (nlat0, nlatf, reduce_band(reads, (ntime, nlatf - nlat0, nlon),
+                                         len(datasets), quantiles, weights))
+    reads.close()
+
+
+def set_worker_datasets(datasets):
+    """Stores the model datasets in a process worker when it starts."""
+    WORKER_DATASETS['datasets'] = datasets
+
+
+def compute_band_in_worker(varname, nlat0, nlatf, buffer_path, quantiles=(),
+                           weights=None, time_slices=None):
+    """Computes one band in a process worker and writes it to a buffer file.
+
+    Returns:
+        Dictionary of the I/O statistics of the band (see prefetch_reader.py).
+    """
+    reset_io_stats()
+    # Each worker already has a core, so read without dask's thread pool
+    with dask.config.set(scheduler='synchronous'):
+        results = compute_band(WORKER_DATASETS['datasets'], varname, nlat0, nlatf,
+                               quantiles=quantiles, weights=weights,
+                               time_slices=time_slices)
+    names = band_stat_names(quantiles)
+    shape = (len(names),) + results['mean'].shape
+    buffer = np.memmap(buffer_path, dtype=DATA_DTYPE, mode='r+', shape=shape)
+    for i, name in enumerate(names):
+        buffer[i] = results[name]
+    buffer.flush()
+    return dict(IO_STATS)
+
+
+def read_band_buffer(buffer_path, shape, names=BAND_STATS):
+    """Maps the results of a band written by compute_band_in_worker.
+
+    The buffer file is deleted right away; its memory is freed once the
+    returned arrays are no longer used.
+    """
+    buffer = np.memmap(buffer_path, dtype=DATA_DTYPE, mode='r',
+                       shape=(len(names),) + shape)
+    os.remove(buffer_path)
+    return {name: buffer[i] for i, name in enumerate(names)}
+
+
+def new_buffer_path():
+    """Creates an empty buffer file for the results of a band."""
+    [handle, buffer_path] = tempfile.mkstemp(prefix='mms_band_', suffix='.buf',
+                                             dir=BUFFER_DIR)
+    os.close(handle)
+    return buffer_path
+
+
+def submit_band(executor, backend, datasets, varname, nlat0, nlatf, quantiles=(),
+                weights=None, time_slices=None):
+    """Submits one band to the executor.
+
+    Returns:
+        (nlat0, nlatf, future, buffer_path), where buffer_path is None
+        unless the band is computed in a process worker.
+    """
+    if backend == 'threads':
+        return (nlat0, nlatf,
+                executor.submit(compute_band, datasets, varname, nlat0, nlatf,
+                                quantiles=quantiles, weights=weights,
+                                time_slices=time_slices), None)
+    buffer_path = new_buffer_path()
+    return (nlat0, nlatf,
+            executor.submit(compute_band_in_worker, varname, nlat0, nlatf, buffer_path,
+                            quantiles, weights, time_slices),
+            buffer_path)
+
+
+def band_results(band, ntime, nlon, names=BAND_STATS):
+    """Waits for a band submitted with submit_band and returns its results."""
+    [nlat0, nlatf, future, buffer_path] = band
+    try:
+        results = future.result()
+    except Exception:
+        if buffer_path is not None and os.path.exists(buffer_path):
+            os.remove(buffer_path)
+        raise
+    if buffer_path is not None:
+        merge_io_stats(results)
+        results = read_band_buffer(buffer_path, (ntime, nlatf - nlat0, nlon), names)
+    return (nlat0, nlatf, results)
+
+
+def map_bands(datasets, varname, nlat0_chunk, nlatf_chunk,
+              num_workers=BAND_WORKERS, backend=BAND_BACKEND, quantiles=(), weights=None,
+              time_slices=None):
+    """Computes the statistics of each band, several bands at a time.
+
+    At most two bands per worker are in flight, so memory use does not
+    depend on the number of bands.
+
+    Args:
+        datasets: List of the model datasets.
+        varname: String name of the variable.
+        nlat0_chunk, nlatf_chunk: Arrays of the first and last (exclusive)
+                                  latitude index of each band.
+        num_workers: Integer number of bands computed at once (None for one
+                     per core, 1 to compute bands in the calling thread).
+        backend: Either 'threads' or 'processes'.
+        quantiles: List of quantiles across models to compute as well.
+        weights: List of the weight of each model (None for equal weights).
+        time_slices: List of the time slice of each model (None if the
+                     models share their time axis).
+    Yields:
+        (nlat0, nlatf, results) for each band in order, where results is the
+        dictionary of the band's statistics.
+    """
+    if num_workers is None:
+        num_workers = default_num_workers()
+    bands = [(int(nlat0), int(nlatf)) for nlat0, nlatf in zip(nlat0_chunk, nlatf_chunk)]
+    if num_workers == 1:
+        yield from compute_bands(datasets, varname, bands, quantiles=quantiles,
+                                 weights=weights, time_slices=time_slices)
+        return
+
+    if backend == 'threads':
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+    elif backend == 'processes':
+        executor = ProcessPoolExecutor(max_workers=num_workers,
+                                       mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=set_worker_datasets,
+                                       initargs=(datasets,))
+    else:
+        raise ValueError('Unknown band backend: '+str(backend))
+
+    ntime = band_ntime(datasets, varname, time_slices)
+    nlon = datasets[0][varname].shape[2]
+    names = band_stat_names(quantiles)
+    in_flight = deque()
+    with executor:
+        try:
+            for [nlat0, nlatf] in bands:
+                in_flight.append(submit_band(executor, backend, datasets, varname,
+                                             nlat0, nlatf, quantiles, weights,
+                                             time_slices))
+                if len(in_flight) >= 2*num_workers:
+                    yield band_results(in_flight.popleft(), ntime, nlon, names)
+            while in_flight:
+                yield band_results(in_flight.popleft(), ntime, nlon, names)
+        finally:
+            for [_, _, future, buffer_path] in in_flight:
+                future.cancel()
+                if buffer_path is not None and os.path.exists(buffer_path):
+                    os.remove(buffer_path)
@@ -0,0 +1,242 @@
+"""
+benchmarks.py
+
+Times parts of the data wrangler against the implementations they replaced,
+on synthetic data of realistic size. Run with:
+
+    python -m phase1_data_wrangler.benchmarks
+"""
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import cftime
+import zarr
+import xarray as xr
+
+from phase1_data_wrangler.subcomp_b_process_climate_model_data import reindex_time
+from phase1_data_wrangler.subcomp_c_multi_model_stats import \
+    initialize_empty_mms_arrays, fill_empty_arrays
+from phase1_data_wrangler.band_executor import default_num_workers
+from phase1_data_wrangler.zarr_writer import write_zarr_streaming
+from phase1_data_wrangler.analysis_parameters import CHUNK_LAYOUTS
+
+BENCHMARK_CALENDARS = ['noleap', '360_day', 'julian', 'standard', 'proleptic_gregorian']
+BENCHMARK_NUM_YEARS = [150, 500, 1000]
+BENCHMARK_NUM_MEMBERS = 10
+# Size (models, time, lat, lon) of the synthetic scenario for subcomponent C
+BENCHMARK_SCENARIO_SHAPE = (8, 240, 180, 360)
+# Size (time, lat, lon) of the synthetic temperatures written with each codec
+BENCHMARK_CODEC_SHAPE = (1200, 90, 180)
+# (compressor, quantize digits) pairs compared by benchmark_codecs (see
+# ZARR_COMPRESSOR and ZARR_QUANTIZE_DIGITS)
+BENCHMARK_CODECS = [(None, None),
+                    ({'cname': 'lz4', 'clevel': 5, 'shuffle': 'byte'}, None),
+                    ({'cname': 'zstd', 'clevel': 3, 'shuffle': 'byte'}, None),
+                    ({'cname': 'zstd', 'clevel': 5, 'shuffle': 'bit'}, None),
+                    ({'cname': 'zstd', 'clevel': 9, 'shuffle': 'bit'}, None),
+                    ({'cname': 'zlib', 'clevel': 5, 'shuffle': 'byte'}, None),
+                    ({'cname': 'zstd', 'clevel': 5, 'shuffle': 'bit'}, 4),
+                    ({'cname': 'zstd', 'clevel': 5, 'shuffle': 'bit'}, 3)]
+BENCHMARK_POINT_READS = 50
+
+
+def time_function(function, *args, repeat=3, **kwargs):
+    """Returns the shortest time in seconds of repeat calls of function."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def legacy_reindex_time(startingtimes):
+    """The original reindex_time, which converts one timestamp at a time."""
+    newtimes = np.empty(np.shape(startingtimes.values), dtype=cftime.DatetimeProlepticGregorian)
+    for i in range(0, len(startingtimes)):
+        yr = int(str(startingtimes.values[i])[0:4])
+        mon = int(str(startingtimes.values[i])[5:7])
+        newdate = cftime.DatetimeProlepticGregorian(yr, mon, 15)
+        newtimes[i] = newdate
+
+    return newtimes
+
+
+def monthly_times(num_years, calendar, start_year=1850):
+    """Returns a DataArray of mid-month times in the given calendar."""
+    times = [cftime.datetime(year, month, 16, calendar=calendar)
+             for year in range(start_year, start_year + num_years)
+             for month in range(1, 13)]
+    return xr.DataArray(np.array(times, dtype=object), dims=['time'])
+
+
+def benchmark_reindex_time(num_years_list=BENCHMARK_NUM_YEARS,
+                           calendars=BENCHMARK_CALENDARS,
+                           num_members=BENCHMARK_NUM_MEMBERS):
+    """Times reindex_time against legacy_reindex_time.
+
+    The time axis is converted once per member, as it is when the members of
+    an ensemble are read and normalized one at a time.
+
+    Args:
+        num_years_list: List of integer lengths of the time axis in years.
+        calendars: List of string calendar names.
+        num_members: Integer number of ensemble members per dataset.
+    Returns:
+        results: List of (calendar, num_years, legacy seconds, new seconds).
+    """
+    results = []
+    for calendar in calendars:
+        for num_years in num_years_list:
+            times = monthly_times(num_years, calendar)
+            legacy = time_function(lambda: [legacy_reindex_time(times)
+                                            for _ in range(num_members)])
+            new = time_function(lambda: [reindex_time(times)
+                                         for _ in range(num_members)])
+            results.append((calendar, num_years, legacy, new))
+    return results
+
+
+def write_benchmark_scenario(data_path, shape=BENCHMARK_SCENARIO_SHAPE):
+    """Writes random model files of a synthetic scenario to data_path."""
+    [num_models, ntime, nlat, nlon] = shape
+    rng = np.random.default_rng(0)
+    for i in range(num_models):
+        values = rng.normal(size=(ntime, nlat, nlon))
+        xr.Dataset({'tas': (('time', 'lat', 'lon'), values)},
+                   coords={'time': np.arange(ntime),
+                           'lat': np.linspace(-89.5, 89.5, nlat),
+                           'lon': np.linspace(0.5, 359.5, nlon)}).to_zarr(
+                               data_path + 'tas_benchmark_M' + str(i) + '.zarr')
+
+
+def synthetic_temperatures(shape=BENCHMARK_CODEC_SHAPE):
+    """Returns a float32 dataset of monthly temperatures (in C) with a
+    latitude gradient, a seasonal cycle, a trend, and noise."""
+    [ntime, nlat, nlon] = shape
+    rng = np.random.default_rng(0)
+    lats = np.linspace(-89, 89, nlat)
+    months = np.arange(ntime)
+    values = (27 - 45*np.sin(np.deg2rad(lats))**2)[np.newaxis, :, np.newaxis] + \
+        (10*np.sin(2*np.pi*months/12)[:, np.newaxis]*np.sin(np.deg2rad(lats)))[:, :, np.newaxis] + \
+        0.002*months[:, np.newaxis, np.newaxis] + rng.normal(scale=1.5, size=shape)
+    times = pd.date_range('1900-01-01', periods=ntime, freq='MS') + pd.Timedelta(days=14)
+    return xr.Dataset({'mean': (('time', 'lat', 'lon'), values.astype(np.float32))},
+                      coords={'time': times, 'lat': lats,
+                              'lon': np.linspace(0, 360, nlon, endpoint=False)})
+
+
+def directory_size(path):
+    """Returns the total size in bytes of the files under a directory."""
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def codec_name(compressor, quantize_digits):
+    """Returns a short label of a compressor and quantization."""
+    if compressor is None:
+        name = 'zarr default'
+    else:
+        name = '%s-%d-%s' % (compressor['cname'], compressor['clevel'], compressor['shuffle'])
+    if quantize_digits is not None:
+        name = name + ' q' + str(quantize_digits)
+    return name
+
+
+def benchmark_codecs(codecs=None, shape=BENCHMARK_CODEC_SHAPE,
+                     num_reads=BENCHMARK_POINT_READS):
+    """Writes synthetic temperatures with each codec to a 'series' layout file.
+
+    Args:
+        codecs: List of (compressor, quantize digits) pairs (by default
+                BENCHMARK_CODECS).
+        shape: Tuple of the number of times, lats, and lons.
+        num_reads: Integer number of random grid cells whose time series
+                   are read to time point reads.
+    Returns:
+        results: List of (codec, compression ratio, write MB/s, point read
+                 latency in ms, largest absolute error).
+    """
+    if codecs is None:
+        codecs = BENCHMARK_CODECS
+    ds = synthetic_temperatures(shape).load()
+    raw_bytes = ds['mean'].nbytes
+    rng = np.random.default_rng(1)
+    points = list(zip(rng.integers(shape[1], size=num_reads),
+                      rng.integers(shape[2], size=num_reads)))
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for i, [compressor, quantize_digits] in enumerate(codecs):
+            store_path = data_dir + '/codec' + str(i) + '.zarr'
+            seconds = time_function(write_zarr_streaming, ds, store_path,
+                                    chunks=CHUNK_LAYOUTS['series'], compressor=compressor,
+                                    quantize_digits=quantize_digits, repeat=1)
+            ratio = raw_bytes/directory_size(store_path + '/mean')
+            array = zarr.open_group(store_path, mode='r')['mean']
+            start = time.perf_counter()
+            for [lat, lon] in points:
+                array[:, lat, lon]
+            latency = (time.perf_counter() - start)/num_reads
+            error = float(np.nanmax(np.abs(array[...] - ds['mean'].values)))
+            results.append((codec_name(compressor, quantize_digits), ratio,
+                            raw_bytes/seconds/1e6, 1000*latency, error))
+    return results
+
+
+def benchmark_band_workers(num_workers_list=None, backends=('threads', 'processes'),
+                           shape=BENCHMARK_SCENARIO_SHAPE):
+    """Times fill_empty_arrays on 1 to N cores.
+
+    Args:
+        num_workers_list: List of integer numbers of workers (by default,
+                          powers of 2 up to the number of cores).
+        backends: List of band backends to time.
+        shape: Tuple of the number of models, times, lats, and lons.
+    Returns:
+        results: List of (backend, workers, seconds, speedup over 1 worker).
+    """
+    if num_workers_list is None:
+        num_workers_list = sorted({min(2**i, default_num_workers())
+                                   for i in range(default_num_workers().bit_length())})
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_path = data_dir + '/'
+        write_benchmark_scenario(data_path, shape)
+        for backend in backends:
+            serial_time = None
+            for num_workers in num_workers_list:
+                [empty_dsets, dim_info, _, file_names,
+                 datasets] = initialize_empty_mms_arrays(data_path, 'benchmark', None,
+                                                         num_workers=num_workers)
+                seconds = time_function(fill_empty_arrays, empty_dsets, dim_info,
+                                        file_names, datasets, 'tas', None,
+                                        num_workers=num_workers, backend=backend,
+                                        repeat=1)
+                if serial_time is None:
+                    serial_time = seconds
+                results.append((backend, num_workers, seconds, serial_time/seconds))
+    return results
+
+
+def print_results(title, header, results):
+    """Prints a table of benchmark results."""
+    print(title)
+    print(''.join(column.rjust(22) for column in header))
+    for row in results:
+        print(''.join((('%.4f' % value) if isinstance(value, float) else str(value)).rjust(22)
+                      for value in row))
+    print('')
+
+
+if __name__ == '__main__':
+    print_results('reindex_time (' + str(BENCHMARK_NUM_MEMBERS) + ' members)',
+                  ['calendar', 'years', 'legacy loop (s)', 'vectorized (s)'],
+                  benchmark_reindex_time())
+    print_results('fill_empty_arrays ' + str(BENCHMARK_SCENARIO_SHAPE),
+                  ['backend', 'workers', 'time (s)', 'speedup'],
+                  benchmark_band_workers())
+    print_results('zarr codecs ' + str(BENCHMARK_CODEC_SHAPE),
+                  ['codec', 'ratio', 'write (MB/s)', 'point read (ms)', 'max error'],
+                  benchmark_codecs())
@@ -0,0 +1,135 @@
+"""
+calendar_normalization.py
+
+Converts the time axes of model output from any CF calendar (noleap, 360_day,
+all_leap, julian, gregorian/standard, or proleptic_gregorian) to a shared
+monthly index in the proleptic Gregorian calendar.
+
+Every timestamp is mapped to the 15th of its month, so datasets that use
+different calendars (or put their monthly timestamps on different days) end
+up with identical time coordinates. Whole time axes are converted at once:
+times are first turned into integer month indices (12*year + month - 1), which
+are checked for gaps and duplicates with array operations, and the output
+times are then gathered from a table of mid-month times that is built once
+and shared by every dataset. The years and months of cftime times are read
+with the field accessors of xarray's CFTimeIndex.
+"""
+import numpy as np
+import xarray as xr
+import cftime
+
+MONTH_DAY = 15
+SUPPORTED_CALENDARS = ('noleap', '365_day', '360_day', 'all_leap', '366_day', 'julian',
+                       'gregorian', 'standard', 'proleptic_gregorian')
+
+# Table of mid-month proleptic Gregorian times, covering the months from
+# 'first' to first + len(times) - 1
+MONTH_TABLE = {'first': 0, 'times': np.empty(0, dtype=object)}
+
+
+def datetime64_months(values):
+    """Returns month indices (12*year + month - 1) of numpy datetime64 values."""
+    months_since_epoch = values.astype('datetime64[M]').astype(np.int64)
+    return months_since_epoch + 12*1970
+
+
+def cftime_months(values):
+    """Returns month indices (12*year + month - 1) of cftime datetime values.
+
+    cftime datetimes store the year and month of their own calendar, so the
+    month index does not depend on the calendar. The years and months of the
+    whole array are read at once through a CFTimeIndex, so all the times must
+    use the same calendar.
+
+    Raises:
+        ValueError: If the times use an unsupported calendar.
+    """
+    calendar = values.flat[0].calendar
+    if calendar not in SUPPORTED_CALENDARS:
+        raise ValueError('Unsupported calendar: ' + str(calendar))
+    index = xr.CFTimeIndex(values.ravel())
+    months = 12*np.asarray(index.year, dtype=np.int64) + np.asarray(index.month, dtype=np.int64) - 1
+    return months.reshape(values.shape)
+
+
+def month_index(values):
+    """Converts an array of times to month indices.
+
+    Args:
+        values: Numpy array of numpy datetime64 or cftime datetime values.
+    Returns:
+        months: Integer numpy array of month indices (12*year + month - 1).
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return datetime64_months(values)
+    return cftime_months(values)
+
+
+def validate_months(months):
+    """Checks that month indices are consecutive, with no gaps or duplicates.
+
+    Raises:
+        ValueError: If a month is repeated, missing, or out of order.
+    """
+    steps = np.diff(months)
+    bad = np.flatnonzero(steps != 1)
+    if bad.size > 0:
+        i = bad[0]
+        if steps[i] == 0:
+            problem = 'Duplicate month'
+        elif steps[i] > 1:
+            problem = 'Gap of ' + str(steps[i] - 1) + ' months after'
+        else:
+            problem = 'Time goes backwards after'
+        [year, month] = np.divmod(months[i], 12)
+        raise ValueError(problem + ' ' + str(year) + '-' + str(month + 1).zfill(2) +
+                         ' (' + str(bad.size) + ' problems in total)')
+
+
+def extend_month_table(first, last):
+    """Makes sure MONTH_TABLE covers the month indices from first to last."""
+    table_first = MONTH_TABLE['first']
+    table_last = table_first + len(MONTH_TABLE['times']) - 1
+    if len(MONTH_TABLE['times']) > 0 and first >= table_first and last <= table_last:
+        return
+    if len(MONTH_TABLE['times']) > 0:
+        first = min(first, table_first)
+        last = max(last, table_last)
+
+    times = np.empty(last - first + 1, dtype=object)
+    times[:] = [cftime.DatetimeProlepticGregorian(month // 12, month % 12 + 1, MONTH_DAY)
+                for month in range(first, last + 1)]
+    MONTH_TABLE['first'] = first
+    MONTH_TABLE['times'] = times
+
+
+def months_to_times(months):
+    """Converts month indices to proleptic Gregorian times on the 15th of each month.
+
+    Args:
+        months: Integer numpy array of month indices (12*year + month - 1).
+    Returns:
+        Numpy array of cftime.DatetimeProlepticGregorian values.
+    """
+    months = np.asarray(months, dtype=np.int64)
+    if months.size == 0:
+        return np.empty(months.shape, dtype=object)
+    extend_month_table(int(months.min()), int(months.max()))
+    return MONTH_TABLE['times'][months - MONTH_TABLE['first']]
+
+
+def normalize_times(values, validate=True):
+    """Converts times in any calendar to the shared monthly proleptic Gregorian index.
+
+    Args:
+        values: Numpy array of numpy datetime64 or cftime datetime values.
+        validate: If True, checks that the times are consecutive months.
+    Returns:
+        Numpy array of cftime.DatetimeProlepticGregorian values on the 15th
+        of each month.
+    """
+    months = month_index(values)
+    if validate:
+        validate_months(months)
+    return months_to_times(months)
@@ -11,6 +11,10 @@ C - Calculate summary statistics for each scenario:                 7.5 mins
 D - Process historical observations to be consistently formatted:   1   min
 
 TOTAL: 22.5 mins
+
+Each subcomponent keeps a manifest next to its output files (see manifest.py),
+so re-running only recomputes outputs whose inputs, parameters, or code have
+changed since they were made.
 """
 import os
 import time
@@ -18,11 +22,24 @@ import glob
 
 from phase1_data_wrangler.subcomp_a_create_data_dict import create_data_dict
 from phase1_data_wrangler.subcomp_b_process_climate_model_data import \
-    create_reference_grid, process_all_files_in_dictionary
-from phase1_data_wrangler.subcomp_c_multi_model_stats import process_all_scenarios
-from phase1_data_wrangler.subcomp_d_process_historical_obs import process_all_observations
+    create_reference_grid, process_all_files_in_dictionary, generate_new_filename, \
+    dataset_variables
+from phase1_data_wrangler.subcomp_c_multi_model_stats import \
+    process_all_scenarios, get_scenario_fnames, get_mms_store_name, \
+    get_model_weights, print_model_weights
+from phase1_data_wrangler.subcomp_d_process_historical_obs import \
+    process_all_observations, OBS_FILE_NAME, OUT_FILE_NAME
+from phase1_data_wrangler.manifest import read_manifest, code_revision, \
+    catalog_entry, file_entry, make_entry, entry_hash, is_stale, \
+    staging_path, replace_store, prune_stores, file_hash, STAGING_DIR_NAME
+from phase1_data_wrangler.zarr_writer import layout_store_path
+from phase1_data_wrangler.temporal_products import product_store_path
+from phase1_data_wrangler.regrid_weight_cache import evict_weight_files, \
+    cache_hit_rate, reset_cache_stats
 from phase1_data_wrangler.analysis_parameters import EXPERIMENT_LIST, \
-    VARIABLE_ID, TABLE_ID, GRID_LABEL, DIR_PROCESSED_DATA, \
+    VARIABLE_IDS, TABLE_ID, GRID_LABEL, DIR_PROCESSED_DATA, \
+    CHUNK_LAYOUTS, PROCESSED_LAYOUTS, TEMPORAL_PRODUCTS, OBS_REGRID_METHOD, MODEL_WEIGHTING, \
+    MODEL_WEIGHTS_FILE, MODEL_FAMILIES, SKILL_PERIOD, SKILL_SIGMA, \
     DIR_INTERMEDIATE_PROCESSED_MODEL_DATA, DIR_INTERMEDIATE_OBSERVATION_DATA
 
 START_TIME = time.time()
@@ -30,25 +47,29 @@ START_TIME = time.time()
 # Settings for this script
 
 PRINT_STATEMENTS_ON = True
-EXCEPTIONS_LIST = ('tas_historical_CESM2',
-                   'tas_ssp126_CanESM5', 'tas_ssp126_CAMS-CSM1-0',
-                   'tas_ssp245_CAMS-CSM1-0', 'tas_ssp245_HadGEM3-GC31-LL',
-                   'tas_ssp370_CESM2-WACCM', 'tas_ssp370_MPI-ESM1-2-HR',
-                   'tas_ssp370_CAMS-CSM1-0', 'tas_ssp370_BCC-ESM1',
-                   'tas_ssp585_CAMS-CSM1-0', 'tas_ssp585_CanESM5'
-                  )
+# Scenario and model of the datasets that throw exceptions (to investigate
+# later); none of their variables are processed
+EXCEPTED_DATASETS = ('historical_CESM2',
+                     'ssp126_CanESM5', 'ssp126_CAMS-CSM1-0',
+                     'ssp245_CAMS-CSM1-0', 'ssp245_HadGEM3-GC31-LL',
+                     'ssp370_CESM2-WACCM', 'ssp370_MPI-ESM1-2-HR',
+                     'ssp370_CAMS-CSM1-0', 'ssp370_BCC-ESM1',
+                     'ssp585_CAMS-CSM1-0', 'ssp585_CanESM5'
+                    )
+# File names (see generate_new_filename) of every variable of those datasets
+EXCEPTIONS_LIST = tuple(variable+'_'+dataset for dataset in EXCEPTED_DATASETS
+                        for variable in VARIABLE_IDS)
 REFERENCE_GRID_KEY = 'CMIP.BCC.BCC-CSM2-MR.historical.Amon.gn'
 
 # Parameter names
 SCENARIO_LIST = EXPERIMENT_LIST
-VARIABLE_NAME = VARIABLE_ID
+VARIABLE_NAMES = VARIABLE_IDS
 
 # Directory information
 OUTPUT_PATH = DIR_PROCESSED_DATA
-CURRENT_PATH = '/home/jovyan/local-climate-data-tool/Analysis/Phase1_ProcessData/'
 DIR_INTERMEDIATE = DIR_INTERMEDIATE_PROCESSED_MODEL_DATA
-DIR_PROCESSED_MODEL_DATA = '/home/jovyan/local-climate-data-tool/data/processed_data/model_data/'
-DIR_PROCESSED_OBS_DATA = '/home/jovyan/local-climate-data-tool/data/processed_data/observation_data/'
+DIR_PROCESSED_MODEL_DATA = DIR_PROCESSED_DATA + 'model_data/'
+DIR_PROCESSED_OBS_DATA = DIR_PROCESSED_DATA + 'observation_data/'
 DIR_INTERMEDIATE_MODEL_DATA = DIR_INTERMEDIATE_PROCESSED_MODEL_DATA
 DIR_INTER_OBS_DATA = DIR_INTERMEDIATE_OBSERVATION_DATA
 
@@ -80,6 +101,68 @@ def delete_zarr_files(data_dir, regex, print_statements_on=False, file_type='.za
         print('   Deleted '+str(i)+' files in '+data_dir)
 
 
+def layout_store_names(store_name):
+    """Returns the names of the zarr files of store_name in each chunk layout."""
+    return [layout_store_path(store_name, layout) for layout in PROCESSED_LAYOUTS]
+
+
+def product_store_names(store_name):
+    """Returns the names of the zarr files of the temporal products of
+    store_name in each chunk layout."""
+    return [name for product in TEMPORAL_PRODUCTS
+            for name in layout_store_names(product_store_path(store_name, product))]
+
+
+def is_any_stale(data_dir, manifest, store_name, entry):
+    """Checks whether store_name needs recomputing in any chunk layout.
+
+    The stores of its temporal products are checked too. Products that were
+    never written (without any whole period in the data) are not in the
+    manifest, so only products that were written and have since gone missing
+    or changed count as stale.
+    """
+    products = [name for name in product_store_names(store_name) if name in manifest]
+    return any(is_stale(data_dir, manifest, name, entry)
+               for name in layout_store_names(store_name) + products)
+
+
+def replace_all_layouts(data_dir, manifest, store_name, entry):
+    """Replaces store_name and its temporal products in every chunk layout
+    with their staged versions."""
+    for name in layout_store_names(store_name):
+        replace_store(data_dir, manifest, name, entry)
+    # Products without any whole period in the data are not written, and
+    # are removed if an earlier run wrote them
+    not_written = []
+    for name in product_store_names(store_name):
+        if os.path.exists(data_dir + STAGING_DIR_NAME + name):
+            replace_store(data_dir, manifest, name, entry)
+        elif name in manifest:
+            not_written.append(name)
+    prune_stores(data_dir, manifest, [name for name in manifest if name not in not_written])
+
+
+def weighting_parameters(weighting=MODEL_WEIGHTING):
+    """Describes the model weighting of the multi-model statistics.
+
+    Only the settings used by the weighting are included, so that e.g.
+    changing SKILL_PERIOD does not recompute statistics with equal weights.
+
+    Args:
+        weighting: Either 'equal', 'table', or 'skill'.
+    Returns:
+        parameters: Dictionary of the weighting settings (with a hash of
+                    MODEL_WEIGHTS_FILE for 'table').
+    """
+    parameters = {'method': weighting}
+    if weighting == 'table':
+        parameters['weights_file'] = file_hash(MODEL_WEIGHTS_FILE)
+    elif weighting == 'skill':
+        parameters.update({'skill_period': SKILL_PERIOD, 'skill_sigma': SKILL_SIGMA,
+                           'families': MODEL_FAMILIES})
+    return parameters
+
+
 def subcomponent_a(print_statements_on=False):
     """Creates data dictionary of all available climate model data.
 
@@ -90,147 +173,270 @@ def subcomponent_a(print_statements_on=False):
         print_statements_on: True if you want to print what is happening.
     Returns:
         dset_dict: The climate data dictionary.
+        dataset_info: DataFrame describing the catalog entries in dset_dict.
     """
     if print_statements_on:
         print('====> Creating data dictionary of available model data')
-    [_, dset_dict, _] = create_data_dict(this_experiment_id=SCENARIO_LIST,
-                                         this_variable_id=VARIABLE_NAME,
-                                         this_table_id=TABLE_ID,
-                                         this_grid_label=GRID_LABEL)
+    [dataset_info, dset_dict, _] = create_data_dict(this_experiment_id=SCENARIO_LIST,
+                                                    this_variable_id=VARIABLE_NAMES,
+                                                    this_table_id=TABLE_ID,
+                                                    this_grid_label=GRID_LABEL)
     if print_statements_on:
         print_time()
-    return dset_dict
+    return [dset_dict, dataset_info]
 
 
-def subcomponent_b(ref_grid_key, dset_dict, print_statements_on=False):
+def subcomponent_b(ref_grid_key, dset_dict, dataset_info, force=False,
+                   print_statements_on=False):
     """Processes raw climate model data.
 
     Creates intermediate spatial model files with consistent formatting
-    (dims: lat/lon/time). If intermediate spatial model files exist in the
-    output folder when this is run, those existing files are deleted.
+    (dims: lat/lon/time), one for each variable of each dataset. Only
+    datasets with files that are missing or out of date according to the
+    manifest in the output folder are recomputed (all of their variables
+    share the regridder, and are processed and saved one at a time), and
+    each new file then replaces the existing one. Files for datasets that
+    are no longer in the dictionary are deleted. Regridding weights are
+    cached between runs (see regrid_weight_cache.py).
 
     Args:
         ref_grid_key: Label for key of the reference grid.
         dset_dict: The climate data dictionary.
+        dataset_info: DataFrame describing the catalog entries in dset_dict.
+        force: True if you want to recompute all files.
         print_statements_on: True if you want to print what is happening.
+    Returns:
+        updated: List of string names of the files that were recomputed.
+        final_grid: The dataset of the reference grid.
     """
-    # Delete existing files because you can't overwrite zarr files
     if print_statements_on:
-        print('====> Deleting existing intermediate model data files')
-    delete_zarr_files(data_dir=DIR_INTERMEDIATE_MODEL_DATA,
-                      regex=VARIABLE_NAME+'_*')
+        print('====> Creating reference grid for data regridding')
+    final_grid = create_reference_grid(reference_key=ref_grid_key,
+                                       dset_dict=dset_dict)
     if print_statements_on:
         print_time()
 
     if print_statements_on:
-        print('====> Creating reference grid for data regridding')
-    final_grid = create_reference_grid(reference_key=ref_grid_key,
-                                       dset_dict=dset_dict)
+        print('====> Checking which intermediate model data files are out of date')
+    manifest = read_manifest(DIR_INTERMEDIATE_MODEL_DATA)
+    parameters = {'reference_grid': catalog_entry(ref_grid_key, dataset_info)}
+    revision = code_revision(process_all_files_in_dictionary)
+    entries = dict()
+    stale_dict = dict()
+    for key in dset_dict.keys():
+        for variable in dataset_variables(dset_dict[key], VARIABLE_NAMES):
+            fname = generate_new_filename(key, variable)
+            if fname in EXCEPTIONS_LIST:
+                continue
+            entries[fname] = make_entry(catalog_entry(key, dataset_info, variable),
+                                        parameters, revision)
+            if force or is_stale(DIR_INTERMEDIATE_MODEL_DATA, manifest,
+                                 fname+'.zarr', entries[fname]):
+                stale_dict[key] = dset_dict[key]
+    pruned = []
+    for variable in VARIABLE_NAMES:
+        pruned += prune_stores(DIR_INTERMEDIATE_MODEL_DATA, manifest,
+                               keep_names=[fname+'.zarr' for fname in entries],
+                               prefix=variable+'_')
     if print_statements_on:
+        print('   '+str(len(stale_dict))+' of '+str(len(entries))+
+              ' files are out of date, deleted '+str(len(pruned))+' old files')
         print_time()
 
     if print_statements_on:
         print('====> Generating consistent data files for each model and scenario')
-    process_all_files_in_dictionary(dset_dict=dset_dict,
-                                    exceptions_list=EXCEPTIONS_LIST,
-                                    final_grid=final_grid)
+    reset_cache_stats()
+    staging_dir = staging_path(DIR_INTERMEDIATE_MODEL_DATA)
+    failures = process_all_files_in_dictionary(dset_dict=stale_dict,
+                                               exceptions_list=EXCEPTIONS_LIST,
+                                               final_grid=final_grid,
+                                               data_path_out=staging_dir,
+                                               variable_ids=VARIABLE_NAMES)
+    updated = []
+    for key in stale_dict.keys():
+        for variable in dataset_variables(stale_dict[key], VARIABLE_NAMES):
+            fname = generate_new_filename(key, variable)
+            if fname in entries and fname not in failures:
+                replace_store(DIR_INTERMEDIATE_MODEL_DATA, manifest,
+                              fname+'.zarr', entries[fname])
+                updated.append(fname)
     if print_statements_on:
+        hit_rate = cache_hit_rate()
+        if hit_rate is not None:
+            print('   Regridding weight cache hit rate: '+str(round(100*hit_rate))+'%')
         print_time()
 
+    # Regridding weights are kept between runs, so only trim the cache
     if print_statements_on:
-        print('====> Deleting regridding intermediate files')
-    delete_zarr_files(data_dir=CURRENT_PATH,
-                      regex='nearest_s2d_*', file_type='.nc')
+        print('====> Evicting old regridding weight files')
+    num_evicted = evict_weight_files()
     if print_statements_on:
+        print('   Evicted '+str(num_evicted)+' files')
         print_time()
 
+    return [updated, final_grid]
+
 
-def subcomponent_c(num_chunks, normalized, print_statements_on=False):
+def subcomponent_c(num_chunks, normalized, force=False, print_statements_on=False):
     """Processes intermediate spatial model files.
 
     Process files (dims: lat/lon/time) with output from subcomponent b to
     create multimodel statistics (i.e. compressing data across all models)
-    of dims: lat/lon/time. If files exist in the output folder when this is
-    run, those existing files are deleted.
+    of dims: lat/lon/time for each variable and scenario. Only those whose
+    intermediate files (or, with 'skill' weighting, processed observations)
+    or model weighting have changed since the statistics were last computed
+    (according to the manifests) are recomputed, and each new file then
+    replaces the existing one.
 
     Args:
-        num_chunks: Integer number of chunks to use for saving the zarr file.
+        num_chunks: Integer number of latitude bands (None to choose the
+                    band size from the cores and memory available).
         normalized: False (default) if the data is not normalized.
+        force: True if you want to recompute all files.
         print_statements_on: True if you want to print what is happening.
+    Returns:
+        updated: List of string names of the files that were recomputed.
     """
-    # Delete existing files because you can't overwrite zarr files
     if print_statements_on:
-        print('====> Deleting existing processed data files')
-
-    delete_zarr_files(data_dir=DIR_PROCESSED_MODEL_DATA,
-                      regex='modelData_'+VARIABLE_NAME+'_*')
-
+        print('====> Checking which processed data files are out of date')
+    input_manifest = read_manifest(DIR_INTERMEDIATE)
+    manifest = read_manifest(DIR_PROCESSED_MODEL_DATA)
+    parameters = {'num_chunks': num_chunks, 'normalized': normalized,
+                  'layouts': {layout: CHUNK_LAYOUTS[layout] for layout in PROCESSED_LAYOUTS},
+                  'weighting': weighting_parameters()}
+    # Skill weights are derived from the processed observations (subcomp D)
+    obs_sources = dict()
+    if MODEL_WEIGHTING == 'skill':
+        obs_manifest = read_manifest(DIR_PROCESSED_OBS_DATA)
+        obs_sources[OUT_FILE_NAME] = entry_hash(obs_manifest.get(OUT_FILE_NAME, {}))
+    revision = code_revision(process_all_scenarios)
+    entries = dict()
+    stale_scenarios = {variable: [] for variable in VARIABLE_NAMES}
+    for variable in VARIABLE_NAMES:
+        for scenario_name in SCENARIO_LIST:
+            input_names = get_scenario_fnames(DIR_INTERMEDIATE, scenario_name, normalized,
+                                              variable_name=variable)
+            sources = {fname: entry_hash(input_manifest.get(fname+'.zarr', {}))
+                       for fname in input_names}
+            sources.update(obs_sources)
+            store_name = get_mms_store_name(variable, scenario_name, normalized)
+            entries[store_name] = make_entry(sources, parameters, revision)
+            if force or is_any_stale(DIR_PROCESSED_MODEL_DATA, manifest,
+                                     store_name, entries[store_name]):
+                stale_scenarios[variable].append(scenario_name)
+    num_stale = sum(len(scenarios) for scenarios in stale_scenarios.values())
     if print_statements_on:
+        print('   '+str(num_stale)+' of '+str(len(entries))+
+              ' variable scenarios are out of date')
         print_time()
 
     if print_statements_on:
         print('====> Generating multimodel statistics')
-    process_all_scenarios(data_path=DIR_INTERMEDIATE,
-                          variable_name=VARIABLE_NAME,
-                          scenario_list=SCENARIO_LIST,
-                          num_chunks=num_chunks,
-                          normalized=normalized)
+    staging_dir = staging_path(DIR_PROCESSED_MODEL_DATA)
+    updated = []
+    if num_stale > 0:
+        # The same model weights are used for every variable
+        model_weights = get_model_weights(DIR_INTERMEDIATE, MODEL_WEIGHTING,
+                                          output_path=staging_dir)
+        print_model_weights(model_weights)
+    for variable, scenario_list in stale_scenarios.items():
+        if not scenario_list:
+            continue
+        process_all_scenarios(data_path=DIR_INTERMEDIATE,
+                              variable_name=variable,
+                              scenario_list=scenario_list,
+                              num_chunks=num_chunks,
+                              normalized=normalized,
+                              output_path=staging_dir,
+                              model_weights=model_weights)
+        for scenario_name in scenario_list:
+            store_name = get_mms_store_name(variable, scenario_name, normalized)
+            replace_all_layouts(DIR_PROCESSED_MODEL_DATA, manifest, store_name,
+                                entries[store_name])
+            updated.append(store_name)
     if print_statements_on:
         print_time()
 
+    return updated
+
 
-def subcomponent_d(print_statements_on=False):
+def subcomponent_d(ref_grid_key, final_grid, dataset_info, force=False,
+                   print_statements_on=False):
     """Processes raw historical climate observations.
 
     Creates processed files with formatting to match climate model data
-    (dims: lat/lon/time). If processed historical observation files exist
-    in the output folder when this is run, those existing files are deleted.
+    (dims: lat/lon/time), regridded onto the reference grid of the model
+    data. The processed file is only recomputed if the raw observations file,
+    the reference grid, or the processing code has changed since it was made.
 
     Args:
+        ref_grid_key: Label for key of the reference grid.
+        final_grid: The dataset of the reference grid.
+        dataset_info: DataFrame describing the catalog entries.
+        force: True if you want to recompute the processed file.
         print_statements_on: True if you want to print what is happening.
+    Returns:
+        True if the processed file was recomputed.
     """
-    # Delete existing files because you can't overwrite zarr files
-    if print_statements_on:
-        print('====> Deleting existing processed observation files')
-    delete_zarr_files(data_dir=DIR_PROCESSED_OBS_DATA,
-                      regex='historical_obs*')
-    if print_statements_on:
-        print_time()
+    manifest = read_manifest(DIR_PROCESSED_OBS_DATA)
+    parameters = {'layouts': {layout: CHUNK_LAYOUTS[layout] for layout in PROCESSED_LAYOUTS},
+                  'reference_grid': catalog_entry(ref_grid_key, dataset_info),
+                  'regrid_method': OBS_REGRID_METHOD}
+    entry = make_entry(file_entry(DIR_INTER_OBS_DATA + OBS_FILE_NAME), parameters,
+                       code_revision(process_all_observations))
+    if not force and not is_any_stale(DIR_PROCESSED_OBS_DATA, manifest,
+                                      OUT_FILE_NAME, entry):
+        if print_statements_on:
+            print('====> Processed observation files are up to date')
+        return False
 
     if print_statements_on:
         print('====> Processing historical observations')
-    process_all_observations(data_path=DIR_INTER_OBS_DATA)
+    staging_dir = staging_path(DIR_PROCESSED_OBS_DATA)
+    process_all_observations(data_path=DIR_INTER_OBS_DATA, data_path_out=staging_dir,
+                             reference_grid=final_grid)
+    replace_all_layouts(DIR_PROCESSED_OBS_DATA, manifest, OUT_FILE_NAME, entry)
 
     if print_statements_on:
         print_time()
+    return True
 
 
-def main(print_statements_on=PRINT_STATEMENTS_ON):
+def main(print_statements_on=PRINT_STATEMENTS_ON, force=False):
     """Runs all subcomponents in the appropriate sequence.
 
     Runs subcomponents A-D to create climate data processed for use in the
-    Dashboard Generator.
+    Dashboard Generator. The observations (D) are processed before the
+    multi-model statistics (C), since 'skill' model weights are derived from
+    them.
 
     Args:
         print_statements_on: True if you want to print what is happening.
+        force: True if you want to recompute all files, even if they are
+               up to date.
     """
     if print_statements_on:
         print('---------------Running subcomponent A---------------')
-    data_dict = subcomponent_a(print_statements_on=print_statements_on)
+    [data_dict, dataset_info] = subcomponent_a(print_statements_on=print_statements_on)
 
     if print_statements_on:
         print('---------------Running subcomponent B---------------')
-    subcomponent_b(ref_grid_key=REFERENCE_GRID_KEY,
-                   dset_dict=data_dict,
-                   print_statements_on=print_statements_on)
+    [_, final_grid] = subcomponent_b(ref_grid_key=REFERENCE_GRID_KEY,
+                                     dset_dict=data_dict,
+                                     dataset_info=dataset_info,
+                                     force=force,
+                                     print_statements_on=print_statements_on)
 
     if print_statements_on:
-        print('---------------Running subcomponent C---------------')
-    subcomponent_c(num_chunks=20, normalized=False, print_statements_on=print_statements_on)
+        print('---------------Running subcomponent D---------------')
+    subcomponent_d(ref_grid_key=REFERENCE_GRID_KEY, final_grid=final_grid,
+                   dataset_info=dataset_info, force=force,
+                   print_statements_on=print_statements_on)
 
     if print_statements_on:
-        print('---------------Running subcomponent D---------------')
-    subcomponent_d(print_statements_on=print_statements_on)
+        print('---------------Running subcomponent C---------------')
+    subcomponent_c(num_chunks=None, normalized=False, force=force,
+                   print_statements_on=print_statements_on)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,230 @@
+"""
+manifest.py
+
+Keeps a manifest next to each output directory of the data wrangler that
+records, for every output store, the inputs, parameters, and code revision
+that produced it. This lets re-runs recompute only the outputs that are out
+of date instead of deleting and rebuilding everything.
+"""
+import os
+import ast
+import json
+import shutil
+import inspect
+import hashlib
+
+MANIFEST_NAME = 'manifest.json'
+STAGING_DIR_NAME = '.staging/'
+PACKAGE_NAME = 'phase1_data_wrangler'
+CATALOG_KEY_COLUMNS = ['activity_id', 'institution_id', 'source_id',
+                       'experiment_id', 'table_id', 'grid_label']
+
+
+def read_manifest(data_dir):
+    """Reads the manifest in data_dir.
+
+    Args:
+        data_dir: The string path of the output directory.
+    Returns:
+        manifest: Dictionary of store name to manifest entry (empty if there
+                  is no manifest yet).
+    """
+    filename = data_dir + MANIFEST_NAME
+    if not os.path.isfile(filename):
+        return dict()
+    with open(filename, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(data_dir, manifest):
+    """Atomically writes the manifest to data_dir."""
+    filename = data_dir + MANIFEST_NAME
+    tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    os.makedirs(data_dir, exist_ok=True)
+    with open(tmp_filename, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+def imported_modules(source_file):
+    """Returns the names of the modules of this package that a source file
+    imports (e.g. 'zarr_writer' for from phase1_data_wrangler.zarr_writer
+    import write_zarr_streaming)."""
+    with open(source_file, 'r') as source:
+        tree = ast.parse(source.read())
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module == PACKAGE_NAME:
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module is not None:
+            if node.module.startswith(PACKAGE_NAME + '.'):
+                names.add(node.module.split('.')[1])
+        elif isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[1] for alias in node.names
+                         if alias.name.startswith(PACKAGE_NAME + '.'))
+    return names
+
+
+def source_revision(source_file):
+    """Returns a hash of a source file and of every module of this package
+    that it imports, directly or through other modules."""
+    package_dir = os.path.dirname(os.path.abspath(source_file))
+    files = {os.path.abspath(source_file)}
+    to_visit = list(files)
+    while to_visit:
+        for name in imported_modules(to_visit.pop()):
+            module_file = os.path.join(package_dir, name + '.py')
+            if os.path.isfile(module_file) and module_file not in files:
+                files.add(module_file)
+                to_visit.append(module_file)
+
+    hasher = hashlib.sha1()
+    for module_file in sorted(files):
+        hasher.update(os.path.basename(module_file).encode())
+        with open(module_file, 'rb') as source:
+            hasher.update(source.read())
+    return hasher.hexdigest()[0:16]
+
+
+def code_revision(obj):
+    """Returns a hash of the source file that defines obj (module or function)
+    and of the modules of this package it imports, so that changes to helper
+    modules (e.g. zarr_writer.py) also mark outputs out of date."""
+    return source_revision(inspect.getsourcefile(obj))
+
+
+def catalog_entry(this_key, dataset_info, variable_id=None):
+    """Describes the catalog entry of a dataset in the data dictionary.
+
+    Args:
+        this_key: String key of the dataset in the dictionary
+                  (e.g. 'CMIP.BCC.BCC-CSM2-MR.historical.Amon.gn').
+        dataset_info: DataFrame of the catalog search (see subcomp A).
+        variable_id: String ID of a single variable of the dataset to
+                     describe (None for all of its variables).
+    Returns:
+        Dictionary with the sorted store paths, versions, and member ids
+        that make up the dataset.
+    """
+    rows = dataset_info
+    for column, value in zip(CATALOG_KEY_COLUMNS, this_key.split('.')):
+        rows = rows[rows[column] == value]
+    if variable_id is not None:
+        rows = rows[rows['variable_id'] == variable_id]
+    entry = {'key': this_key,
+             'zstore': sorted(str(x) for x in rows['zstore']),
+             'member_id': sorted(str(x) for x in rows['member_id'])}
+    if 'version' in rows.columns:
+        entry['version'] = sorted(str(x) for x in rows['version'])
+    return entry
+
+
+def file_entry(filename):
+    """Describes an input file by its name, size, and modification time."""
+    return {'file': os.path.basename(filename),
+            'size': os.path.getsize(filename),
+            'mtime': os.path.getmtime(filename)}
+
+
+def file_hash(filename):
+    """Returns a short hash of the contents of a file (None if it is missing)."""
+    if not os.path.isfile(filename):
+        return None
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as input_file:
+        hasher.update(input_file.read())
+    return hasher.hexdigest()[0:16]
+
+
+def make_entry(sources, parameters, revision):
+    """Creates the manifest entry for an output store.
+
+    Args:
+        sources: JSON-serializable description of the inputs of the store.
+        parameters: Dictionary of the parameters used to create the store.
+        revision: String code revision that created the store.
+    Returns:
+        entry: The manifest entry.
+    """
+    entry = {'sources': sources,
+             'parameters': parameters,
+             'code_revision': revision}
+    # Round trip through json so that entries compare equal to those read in
+    return json.loads(json.dumps(entry, sort_keys=True))
+
+
+def entry_hash(entry):
+    """Returns a short hash of a manifest entry."""
+    return hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()[0:16]
+
+
+def is_stale(data_dir, manifest, store_name, entry):
+    """Checks whether an output store needs to be recomputed.
+
+    Args:
+        data_dir: The string path of the output directory.
+        manifest: The manifest of the output directory.
+        store_name: String name of the store (e.g. 'tas_ssp126_CanESM5.zarr').
+        entry: The manifest entry the store would have if it were recomputed.
+    Returns:
+        True if the store is missing or was made from different inputs,
+        parameters, or code.
+    """
+    if not os.path.exists(data_dir + store_name):
+        return True
+    return manifest.get(store_name) != entry
+
+
+def staging_path(data_dir):
+    """Returns an empty staging directory to write new stores to before
+    they replace the stores in data_dir."""
+    staging_dir = data_dir + STAGING_DIR_NAME
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    return staging_dir
+
+
+def replace_store(data_dir, manifest, store_name, entry):
+    """Replaces a store in data_dir with its newly written staged version.
+
+    The new store is only moved into place once it is completely written,
+    so readers never see a partially written store. The old store is moved
+    aside first, so the store is briefly missing between the two moves. The
+    manifest entry is updated and the manifest is written back to disk.
+
+    Args:
+        data_dir: The string path of the output directory.
+        manifest: The manifest of the output directory.
+        store_name: String name of the store.
+        entry: The manifest entry of the new store.
+    """
+    final_path = data_dir + store_name
+    old_path = data_dir + STAGING_DIR_NAME + store_name + '.old'
+    if os.path.exists(final_path):
+        os.replace(final_path, old_path)
+    os.replace(data_dir + STAGING_DIR_NAME + store_name, final_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+    manifest[store_name] = entry
+    write_manifest(data_dir, manifest)
+
+
+def prune_stores(data_dir, manifest, keep_names, prefix=''):
+    """Deletes stores recorded in the manifest that are no longer produced.
+
+    Args:
+        data_dir: The string path of the output directory.
+        manifest: The manifest of the output directory.
+        keep_names: Collection of string store names to keep.
+        prefix: Only stores with names starting with prefix are deleted.
+    Returns:
+        pruned: List of the string names of the deleted stores.
+    """
+    pruned = [name for name in manifest
+              if name.startswith(prefix) and name not in keep_names]
+    for name in pruned:
+        shutil.rmtree(data_dir + name, ignore_errors=True)
+        del manifest[name]
+    if pruned:
+        write_manifest(data_dir, manifest)
+    return pruned
@@ -0,0 +1,139 @@
+"""
+model_weights.py
+
+Weights of each model in the multi-model statistics of subcomponent C.
+
+Weights are either read from a table (a csv file with 'model' and 'weight'
+columns) or derived from each model's skill and independence:
+    - skill: the error of the model's climatology pattern against the BEST
+      observations of subcomponent D, turned into a weight exp(-(e/sigma)^2)
+    - independence: models of the same family (e.g. CESM2 and CESM2-WACCM)
+      share their family's weight, so families with many members are not
+      over-counted
+Weights are scaled to a mean of 1.
+"""
+import numpy as np
+import pandas as pd
+
+from phase1_data_wrangler.analysis_parameters import MODEL_FAMILIES, SKILL_PERIOD, \
+    SKILL_SIGMA
+
+
+def model_name(file_name):
+    """Returns the model (source_id) of a processed model file name."""
+    return file_name.split('_')[-1]
+
+
+def model_family(model, families=MODEL_FAMILIES):
+    """Returns the family of a model: its entry in families, or else the
+    part of its name before the first '-' (e.g. 'CESM2' for 'CESM2-WACCM')."""
+    if model in families:
+        return families[model]
+    return model.split('-')[0]
+
+
+def normalize_weights(weights):
+    """Scales a dictionary of model weights to a mean of 1."""
+    mean_weight = np.mean(list(weights.values()))
+    if not mean_weight > 0:
+        raise ValueError('The model weights must not all be zero')
+    return {model: weight/mean_weight for model, weight in weights.items()}
+
+
+def read_weight_table(path):
+    """Reads a csv file of model weights into a dictionary of model to weight."""
+    table = pd.read_csv(path)
+    if (table['weight'] < 0).any():
+        raise ValueError('Model weights must not be negative: '+path)
+    return dict(zip(table['model'], table['weight'].astype(float)))
+
+
+def write_weight_table(weights, path):
+    """Writes a dictionary of model weights to a csv file."""
+    table = pd.DataFrame({'model': list(weights.keys()), 'weight': list(weights.values())})
+    table.to_csv(path, index=False)
+
+
+def weights_for_files(file_names, weights):
+    """Returns the list of the weight of the model of each file."""
+    missing = [model_name(name) for name in file_names if model_name(name) not in weights]
+    if missing:
+        raise ValueError('No weight for models: '+', '.join(missing))
+    return [weights[model_name(name)] for name in file_names]
+
+
+def independence_weights(models, families=MODEL_FAMILIES):
+    """Returns weights of 1/(number of models in the family) for each model."""
+    model_families = [model_family(model, families) for model in models]
+    return {model: 1/model_families.count(family)
+            for model, family in zip(models, model_families)}
+
+
+def climatology(data_array, period=SKILL_PERIOD):
+    """Returns the time mean of a DataArray over a (start, end) period."""
+    [start, end] = period
+    return data_array.sel(time=slice(start, end)).mean('time')
+
+
+def pattern_error(model_clim, obs_clim):
+    """Returns the area-weighted centered RMS error of a model's climatology.
+
+    The observations are taken at the nearest grid cell of each model grid
+    cell. Each field's area-weighted mean is removed first, so the error
+    measures the pattern and does not depend on offsets (e.g. of K and C).
+
+    Args:
+        model_clim: DataArray of the model's climatology on a lat/lon grid.
+        obs_clim: DataArray of the observed climatology on a lat/lon grid.
+    Returns:
+        The float error.
+    """
+    obs_clim = obs_clim.interp(lat=model_clim['lat'], lon=model_clim['lon'],
+                               method='nearest')
+    model_values = np.asarray(model_clim.values, dtype=np.float64)
+    obs_values = np.asarray(obs_clim.values, dtype=np.float64)
+    area = np.broadcast_to(np.cos(np.deg2rad(model_clim['lat'].values))[:, np.newaxis],
+                           model_values.shape)
+    area = np.where(np.isfinite(model_values) & np.isfinite(obs_values), area, 0.)
+    model_values = np.nan_to_num(model_values)
+    obs_values = np.nan_to_num(obs_values)
+    model_anomaly = model_values - np.sum(area*model_values)/np.sum(area)
+    obs_anomaly = obs_values - np.sum(area*obs_values)/np.sum(area)
+    return float(np.sqrt(np.sum(area*(model_anomaly - obs_anomaly)**2)/np.sum(area)))
+
+
+def skill_weights(errors, sigma=SKILL_SIGMA):
+    """Turns a dictionary of model errors into weights exp(-(error/sigma)^2).
+
+    Args:
+        errors: Dictionary of model to float error.
+        sigma: Float error scale (None for the median error).
+    Returns:
+        Dictionary of model to weight.
+    """
+    if sigma is None:
+        sigma = np.median(list(errors.values()))
+    if not sigma > 0:
+        return {model: 1. for model in errors}
+    return {model: float(np.exp(-(error/sigma)**2)) for model, error in errors.items()}
+
+
+def derive_model_weights(model_climatologies, obs_clim, sigma=SKILL_SIGMA,
+                         families=MODEL_FAMILIES):
+    """Derives model weights from skill against observations and independence.
+
+    Args:
+        model_climatologies: Dictionary of model to DataArray of its
+                             climatology (see climatology).
+        obs_clim: DataArray of the observed climatology.
+        sigma: Float error scale of the skill weights (None for the median).
+        families: Dictionary of model to family name.
+    Returns:
+        Dictionary of model to weight, with a mean of 1.
+    """
+    errors = {model: pattern_error(model_clim, obs_clim)
+              for model, model_clim in model_climatologies.items()}
+    performance = skill_weights(errors, sigma)
+    independence = independence_weights(list(model_climatologies.keys()), families)
+    return normalize_weights({model: performance[model]*independence[model]
+                              for model in model_climatologies})
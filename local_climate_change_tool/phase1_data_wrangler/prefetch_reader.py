@@ -0,0 +1,101 @@
+"""
+prefetch_reader.py
+
+Reads model data ahead of time on a thread pool, so that reading the next
+slices overlaps with reducing the current one. Reads are started up to
+PREFETCH_DEPTH slices ahead and their results are handed back in order.
+
+The time spent waiting for reads and the time spent computing in between
+are added up in IO_STATS, to show how much of a run is I/O bound.
+"""
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from phase1_data_wrangler.analysis_parameters import PREFETCH_DEPTH
+
+
+IO_STATS = {'reads': 0, 'io_wait': 0.0, 'compute': 0.0}
+IO_STATS_LOCK = threading.Lock()
+
+
+def record_io_stats(reads, io_wait, compute):
+    """Adds a number of reads and seconds of I/O wait and compute to IO_STATS."""
+    with IO_STATS_LOCK:
+        IO_STATS['reads'] = IO_STATS['reads'] + reads
+        IO_STATS['io_wait'] = IO_STATS['io_wait'] + io_wait
+        IO_STATS['compute'] = IO_STATS['compute'] + compute
+
+
+def reset_io_stats():
+    """Resets the I/O counters."""
+    with IO_STATS_LOCK:
+        IO_STATS['reads'] = 0
+        IO_STATS['io_wait'] = 0.0
+        IO_STATS['compute'] = 0.0
+
+
+def merge_io_stats(stats):
+    """Adds I/O counts (e.g. from a worker process) to the totals."""
+    record_io_stats(stats['reads'], stats['io_wait'], stats['compute'])
+
+
+def io_wait_fraction():
+    """Returns the fraction of the recorded time that was spent waiting for reads.
+
+    Returns:
+        The fraction between 0 and 1, or None if nothing was recorded.
+    """
+    total = IO_STATS['io_wait'] + IO_STATS['compute']
+    if total == 0:
+        return None
+    return IO_STATS['io_wait']/total
+
+
+def prefetch(read_function, read_args, depth=PREFETCH_DEPTH):
+    """Calls read_function for each item of read_args, reading ahead.
+
+    Up to depth calls run ahead on a thread pool while the caller works on
+    the previous results. With depth 0, each read runs when it is needed.
+    The time the caller is blocked waiting for a read, and the time it
+    spends between reads, are added to IO_STATS.
+
+    Args:
+        read_function: Function that reads one slice.
+        read_args: List of tuples of arguments of read_function.
+        depth: Integer number of reads to run ahead.
+    Yields:
+        The result of read_function for each item of read_args, in order.
+    """
+    reads = 0
+    io_wait = 0.0
+    compute = 0.0
+    try:
+        if depth == 0:
+            for args in read_args:
+                start = time.perf_counter()
+                result = read_function(*args)
+                reads = reads + 1
+                io_wait = io_wait + time.perf_counter() - start
+                start = time.perf_counter()
+                yield result
+                compute = compute + time.perf_counter() - start
+            return
+
+        with ThreadPoolExecutor(max_workers=depth) as reader:
+            pending = deque()
+            next_index = 0
+            while next_index < len(read_args) or pending:
+                while next_index < len(read_args) and len(pending) <= depth:
+                    pending.append(reader.submit(read_function, *read_args[next_index]))
+                    next_index = next_index + 1
+                start = time.perf_counter()
+                result = pending.popleft().result()
+                reads = reads + 1
+                io_wait = io_wait + time.perf_counter() - start
+                start = time.perf_counter()
+                yield result
+                compute = compute + time.perf_counter() - start
+    finally:
+        record_io_stats(reads, io_wait, compute)
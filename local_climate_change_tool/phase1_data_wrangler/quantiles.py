@@ -0,0 +1,225 @@
+"""
+quantiles.py
+
+Computes NaN-aware quantiles over a dimension (e.g. over models) by adding in
+one slice at a time.
+
+ExactQuantiles keeps every slice and selects the quantiles exactly, with the
+same linear interpolation as np.nanquantile. QuantileSketch keeps a bounded
+number of slices no matter how many are added: once its buffer is full, it
+sorts the buffer and keeps every other value with twice the weight (a
+KLL-style compactor), so its quantiles are approximate.
+
+Slices may be added with weights (e.g. per-model weights). Weighted
+quantiles are the smallest value whose cumulative weight reaches the
+quantile; with equal weights the exact quantiles are interpolated like
+np.nanquantile.
+"""
+import numpy as np
+
+from phase1_data_wrangler.analysis_parameters import QUANTILES, QUANTILE_SKETCH_SIZE
+
+
+def quantile_name(quantile):
+    """Returns the variable name of a quantile ('median', 'q05', 'q95', 'q2p5')."""
+    if quantile == 0.5:
+        return 'median'
+    percent = round(100*quantile, 6)
+    if percent == int(percent):
+        return 'q' + str(int(percent)).zfill(2)
+    return 'q' + str(percent).replace('.', 'p')
+
+
+def exact_quantiles(values, quantiles=QUANTILES):
+    """Computes quantiles over the first axis, skipping NaNs.
+
+    Without NaNs, only the values at the needed ranks are selected with
+    np.partition. With NaNs, the values are sorted (NaNs sort last) and each
+    point's ranks are scaled to its number of non-NaN values.
+
+    Args:
+        values: Float array with the values to reduce along its first axis.
+        quantiles: List of quantiles between 0 and 1.
+    Returns:
+        Dictionary of quantile name (see quantile_name) to array of the
+        quantile at each point (NaN where all values are NaN).
+    """
+    results = dict()
+    if not np.isnan(values).any():
+        positions = [quantile*(values.shape[0] - 1) for quantile in quantiles]
+        ranks = sorted({int(np.floor(p)) for p in positions} |
+                       {int(np.ceil(p)) for p in positions})
+        selected = np.partition(values, ranks, axis=0)
+        for quantile, position in zip(quantiles, positions):
+            lower = selected[int(np.floor(position))]
+            upper = selected[int(np.ceil(position))]
+            results[quantile_name(quantile)] = lower + (upper - lower)*(position -
+                                                                        np.floor(position))
+        return results
+
+    sorted_values = np.sort(values, axis=0)
+    count = (~np.isnan(values)).sum(axis=0)
+    for quantile in quantiles:
+        position = quantile*np.maximum(count - 1, 0)
+        lower = np.take_along_axis(sorted_values, np.floor(position).astype(int)[np.newaxis],
+                                   axis=0)[0]
+        upper = np.take_along_axis(sorted_values, np.ceil(position).astype(int)[np.newaxis],
+                                   axis=0)[0]
+        value = lower + (upper - lower)*(position - np.floor(position))
+        results[quantile_name(quantile)] = np.where(count > 0, value, np.nan)
+    return results
+
+
+def weighted_quantiles(values, weights, quantiles=QUANTILES):
+    """Computes quantiles over the first axis of weighted values, skipping NaNs.
+
+    The q quantile at a point is the smallest value whose cumulative weight
+    reaches q times the point's total weight.
+
+    Args:
+        values: Float array with the values to reduce along its first axis.
+        weights: Array of non-negative weights, broadcastable to values.
+        quantiles: List of quantiles between 0 and 1.
+    Returns:
+        Dictionary of quantile name to array of the quantile at each point.
+    """
+    weights = np.where(np.isnan(values), 0., np.broadcast_to(weights, values.shape))
+    order = np.argsort(values, axis=0)
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    cumulative = np.cumsum(np.take_along_axis(weights, order, axis=0), axis=0)
+    total = cumulative[-1]
+    results = dict()
+    for quantile in quantiles:
+        index = np.minimum((cumulative < quantile*total).sum(axis=0), values.shape[0] - 1)
+        value = np.take_along_axis(sorted_values, index[np.newaxis], axis=0)[0]
+        results[quantile_name(quantile)] = np.where(total > 0, value, np.nan)
+    return results
+
+
+class ExactQuantiles():
+    """Keeps every added slice to compute exact quantiles.
+
+    Attributes:
+        values: Float array (of the given dtype) of num_values slices of the
+                given shape.
+        weights: Float64 array of the weight of each slice.
+        num_added: Integer number of slices added so far.
+    """
+
+    def __init__(self, shape, num_values, quantiles=QUANTILES, dtype=np.float64):
+        self.values = np.empty((num_values,) + tuple(shape), dtype=dtype)
+        self.weights = np.ones(num_values)
+        self.num_added = 0
+        self.quantiles = quantiles
+
+    def add(self, values, weight=1.):
+        """Adds one slice of values with a weight."""
+        self.values[self.num_added] = values
+        self.weights[self.num_added] = weight
+        self.num_added = self.num_added + 1
+
+    def results(self):
+        """Returns the dictionary of quantiles of the slices added so far."""
+        values = self.values[0:self.num_added]
+        weights = self.weights[0:self.num_added]
+        if np.all(weights == weights[0]):
+            return exact_quantiles(values, self.quantiles)
+        weights = weights.reshape((len(weights),) + (1,)*(values.ndim - 1))
+        return weighted_quantiles(values, weights, self.quantiles)
+
+
+class QuantileSketch():
+    """Approximate quantiles from a bounded number of kept slices.
+
+    Each level holds up to size slices of values and of their weights.
+    When a level is full, it is sorted at every point and neighbouring pairs
+    of values are merged into one value (picked at a random offset, the same
+    for all points) carrying the weight of both, which is moved up to the
+    next level. At most size*(1 + log2(num_added/size)) slices are kept.
+    Until the first level is full, the quantiles are exact.
+
+    Attributes:
+        levels: List of float arrays (of the given dtype) of size slices of
+                the given shape.
+        level_weights: List of float64 arrays of the weights of the values
+                       in each level (0 for NaNs).
+        fill: List of the integer number of slices held in each level.
+        weighted: True once a slice with a weight other than 1 was added.
+    """
+
+    def __init__(self, shape, size=QUANTILE_SKETCH_SIZE, quantiles=QUANTILES, seed=0,
+                 dtype=np.float64):
+        if size < 2 or size % 2 != 0:
+            raise ValueError('The sketch size must be an even number of at least 2')
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.size = size
+        self.quantiles = quantiles
+        self.weighted = False
+        self.levels = []
+        self.level_weights = []
+        self.fill = []
+        self.rng = np.random.default_rng(seed)
+
+    def push(self, level, values, weights):
+        """Adds slices (along the first axis of values) to a level."""
+        if level == len(self.levels):
+            self.levels.append(np.empty((self.size,) + self.shape, dtype=self.dtype))
+            self.level_weights.append(np.empty((self.size,) + self.shape))
+            self.fill.append(0)
+        start = self.fill[level]
+        self.levels[level][start:start + len(values)] = values
+        self.level_weights[level][start:start + len(values)] = weights
+        self.fill[level] = start + len(values)
+        if self.fill[level] == self.size:
+            order = np.argsort(self.levels[level], axis=0)
+            sorted_values = np.take_along_axis(self.levels[level], order, axis=0)
+            sorted_weights = np.take_along_axis(self.level_weights[level], order, axis=0)
+            offset = self.rng.integers(2)
+            kept = sorted_values[offset::2]
+            # A NaN is only kept if both values of its pair are NaN
+            kept = np.where(np.isnan(kept), sorted_values[1 - offset::2], kept)
+            self.fill[level] = 0
+            self.push(level + 1, kept, sorted_weights[0::2] + sorted_weights[1::2])
+
+    def add(self, values, weight=1.):
+        """Adds one slice of values with a weight."""
+        self.weighted = self.weighted or weight != 1
+        values = np.asarray(values, dtype=self.dtype)[np.newaxis]
+        self.push(0, values, np.where(np.isnan(values), 0., weight))
+
+    def results(self):
+        """Returns the dictionary of quantiles of the slices added so far."""
+        values = np.concatenate([level[0:fill] for level, fill in zip(self.levels, self.fill)])
+        weights = np.concatenate([level_weights[0:fill] for level_weights, fill
+                                  in zip(self.level_weights, self.fill)])
+        if len(self.levels) == 1 and not self.weighted:
+            return exact_quantiles(values, self.quantiles)
+        return weighted_quantiles(values, weights, self.quantiles)
+
+
+def make_quantile_accumulator(shape, num_values, quantiles=QUANTILES,
+                              sketch_size=QUANTILE_SKETCH_SIZE, dtype=np.float64):
+    """Returns an accumulator of the quantiles of num_values slices.
+
+    Args:
+        shape: Shape of each slice.
+        num_values: Integer number of slices that will be added.
+        quantiles: List of quantiles between 0 and 1.
+        sketch_size: Integer number of slices a QuantileSketch may keep per
+                     level, or None to always compute exact quantiles.
+        dtype: Float dtype the slices are kept in.
+    Returns:
+        An ExactQuantiles if there are at most sketch_size slices (or
+        sketch_size is None), otherwise a QuantileSketch.
+    """
+    if sketch_size is None or num_values <= sketch_size:
+        return ExactQuantiles(shape, num_values, quantiles, dtype)
+    return QuantileSketch(shape, sketch_size, quantiles, dtype=dtype)
+
+
+def quantile_memory_arrays(num_values, sketch_size=QUANTILE_SKETCH_SIZE):
+    """Returns how many slices (of values or weights) a quantile accumulator holds at most."""
+    if sketch_size is None or num_values <= sketch_size:
+        return num_values
+    return 2*sketch_size*(1 + int(np.ceil(np.log2(num_values/sketch_size))))
@@ -0,0 +1,172 @@
+"""
+regrid_weight_cache.py
+
+Keeps regridding weight files on disk between runs so that the weights for a
+given model grid are only generated once, no matter how many experiments are
+processed on that grid.
+"""
+import os
+import glob
+import time
+import hashlib
+import numpy as np
+
+from phase1_data_wrangler.analysis_parameters import DIR_REGRID_WEIGHTS, \
+    WEIGHT_CACHE_MAX_BYTES, WEIGHT_CACHE_MAX_AGE_DAYS, WEIGHT_TMP_MAX_AGE_HOURS
+
+
+CACHE_STATS = {'hits': 0, 'misses': 0}
+
+
+def grid_hash(ds_in, reference_grid, regrid_method,
+              latvariable='lat', lonvariable='lon'):
+    """Creates a key identifying a source grid, reference grid, and method.
+
+    Args:
+        ds_in: The dataset on the source grid.
+        reference_grid: The dataset containing the reference grid.
+        regrid_method: The string name of the method to use for regridding.
+        latvariable: The string name for the source latitude variable.
+        lonvariable: The string name for the source longitude variable.
+    Returns:
+        The hexadecimal string hash of the grids and method.
+    """
+    hasher = hashlib.sha1()
+    for coord in [ds_in[latvariable], ds_in[lonvariable],
+                  reference_grid['lat'], reference_grid['lon']]:
+        values = np.ascontiguousarray(np.asarray(coord), dtype=np.float64)
+        hasher.update(str(values.shape).encode())
+        hasher.update(values.tobytes())
+    hasher.update(regrid_method.encode())
+
+    return hasher.hexdigest()[0:16]
+
+
+def weight_file_path(weight_key, regrid_method, extension='.nc',
+                     cache_dir=DIR_REGRID_WEIGHTS):
+    """Returns the path of the weight file for this key and method."""
+    return cache_dir + regrid_method + '_' + weight_key + extension
+
+
+def lookup_weights(weight_file):
+    """Checks whether the weight file is cached and records a hit or miss.
+
+    Cached files that are used have their modification time updated, so that
+    eviction by age removes the files that have gone unused the longest.
+
+    Args:
+        weight_file: The string path of the weight file.
+    Returns:
+        True if the weight file already exists in the cache.
+    """
+    if os.path.isfile(weight_file):
+        CACHE_STATS['hits'] = CACHE_STATS['hits'] + 1
+        os.utime(weight_file)
+        return True
+    CACHE_STATS['misses'] = CACHE_STATS['misses'] + 1
+    return False
+
+
+def temporary_weight_path(weight_file):
+    """Returns a per-process path to generate a weight file in.
+
+    Generating weights under a temporary name and then publishing them with
+    publish_weights means that concurrent runs never read a partial file.
+    """
+    os.makedirs(os.path.dirname(weight_file), exist_ok=True)
+    [root, extension] = os.path.splitext(weight_file)
+    return root + '.' + str(os.getpid()) + '.tmp' + extension
+
+
+def is_temporary_weight_file(filename):
+    """Checks whether filename is a weight file still being generated (see
+    temporary_weight_path)."""
+    return '.tmp.' in os.path.basename(filename)
+
+
+def publish_weights(tmp_file, weight_file):
+    """Atomically moves a newly generated weight file into the cache."""
+    os.replace(tmp_file, weight_file)
+
+
+def cache_hit_rate():
+    """Returns the fraction of weight lookups that were cache hits.
+
+    Returns:
+        The hit rate between 0 and 1, or None if there were no lookups.
+    """
+    total = CACHE_STATS['hits'] + CACHE_STATS['misses']
+    if total == 0:
+        return None
+    return CACHE_STATS['hits']/total
+
+
+def reset_cache_stats():
+    """Resets the hit and miss counters."""
+    CACHE_STATS['hits'] = 0
+    CACHE_STATS['misses'] = 0
+
+
+def merge_cache_stats(stats):
+    """Adds hit and miss counts (e.g. from a worker process) to the totals."""
+    CACHE_STATS['hits'] = CACHE_STATS['hits'] + stats['hits']
+    CACHE_STATS['misses'] = CACHE_STATS['misses'] + stats['misses']
+
+
+def evict_weight_files(cache_dir=DIR_REGRID_WEIGHTS,
+                       max_bytes=WEIGHT_CACHE_MAX_BYTES,
+                       max_age_days=WEIGHT_CACHE_MAX_AGE_DAYS,
+                       tmp_max_age_hours=WEIGHT_TMP_MAX_AGE_HOURS):
+    """Deletes cached weight files that are too old or over the size budget.
+
+    Files unused for more than max_age_days are deleted first. If the files
+    left over still take up more than max_bytes, the least recently used
+    files are deleted until the cache fits. Weight files that other runs are
+    still generating (written to within tmp_max_age_hours) are never deleted
+    and do not count towards max_bytes, while older ones were left behind by
+    killed runs and are deleted. Files that other runs delete in the meantime
+    are skipped.
+
+    Args:
+        cache_dir: The string path of the weight cache directory.
+        max_bytes: Integer maximum total size of the cache in bytes.
+        max_age_days: Maximum number of days since a file was last used.
+        tmp_max_age_hours: Maximum number of hours since a weight file that
+                           is being generated was last written to.
+    Returns:
+        num_evicted: Integer number of files that were deleted.
+    """
+    now = time.time()
+    files = []
+    orphans = []
+    for file in glob.glob(cache_dir + '*'):
+        if not os.path.isfile(file) or file.endswith('.md'):
+            continue
+        try:
+            file_stat = os.stat(file)
+        except FileNotFoundError:
+            # Evicted or replaced by another run in the meantime
+            continue
+        if not is_temporary_weight_file(file):
+            files.append((file, file_stat.st_size, file_stat.st_mtime))
+        elif file_stat.st_mtime < now - tmp_max_age_hours*60*60:
+            orphans.append(file)
+    files.sort(key=lambda file_info: file_info[2])
+
+    oldest_allowed = now - max_age_days*24*60*60
+    total_bytes = sum(size for _, size, _ in files)
+    evicted = []
+    for file, size, mtime in files:
+        if mtime < oldest_allowed or total_bytes > max_bytes:
+            total_bytes = total_bytes - size
+            evicted.append(file)
+
+    num_evicted = 0
+    for file in orphans + evicted:
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            continue
+        num_evicted = num_evicted + 1
+
+    return num_evicted
@@ -0,0 +1,319 @@
+"""
+sparse_regrid.py
+
+Regrids model output with regridding weights stored as a scipy.sparse matrix.
+This is an alternative to xESMF that does not need ESMF to be installed, and
+that regrids all timesteps at once with one sparse-dense matrix product per
+dask block.
+
+Supports the regrid_method names used by xESMF:
+    'nearest_s2d':  Nearest source cell to each destination cell (any grid).
+    'bilinear':     Bilinear interpolation (rectilinear grids).
+    'conservative': First-order conservative remapping (rectilinear grids).
+"""
+import numpy as np
+import scipy.sparse
+from scipy.spatial import cKDTree
+import dask.array as da
+import xarray as xr
+
+SUPPORTED_METHODS = ('nearest_s2d', 'bilinear', 'conservative')
+
+
+def latlon_to_xyz(lats, lons):
+    """Converts latitudes and longitudes (degrees) to points on the unit sphere.
+
+    Args:
+        lats: Numpy array of latitudes.
+        lons: Numpy array of longitudes (any convention, e.g. 0-360 or -180-180).
+    Returns:
+        Numpy array of shape (number of points, 3).
+    """
+    lat_rad = np.deg2rad(np.ravel(lats))
+    lon_rad = np.deg2rad(np.ravel(lons))
+    return np.column_stack([np.cos(lat_rad)*np.cos(lon_rad),
+                            np.cos(lat_rad)*np.sin(lon_rad),
+                            np.sin(lat_rad)])
+
+
+def nearest_weights(lats_in, lons_in, lats_out, lons_out):
+    """Creates weights that take the nearest source cell for each destination cell.
+
+    Args:
+        lats_in, lons_in: Numpy arrays (1D or 2D) of the source cell centers.
+        lats_out, lons_out: Numpy arrays (1D or 2D) of the destination cell centers.
+    Returns:
+        weights: Sparse matrix of shape (number of destination cells,
+                 number of source cells).
+    """
+    if np.ndim(lats_in) == 1:
+        [lons_in, lats_in] = np.meshgrid(lons_in, lats_in)
+    if np.ndim(lats_out) == 1:
+        [lons_out, lats_out] = np.meshgrid(lons_out, lats_out)
+    num_in = np.size(lats_in)
+    num_out = np.size(lats_out)
+
+    tree = cKDTree(latlon_to_xyz(lats_in, lons_in))
+    [_, nearest] = tree.query(latlon_to_xyz(lats_out, lons_out))
+
+    return scipy.sparse.csr_matrix((np.ones(num_out), (np.arange(num_out), nearest)),
+                                   shape=(num_out, num_in))
+
+
+def linear_weights_1d(x_in, x_out, period=None):
+    """Creates 1D linear interpolation weights.
+
+    Destination points outside of the source points take the value of the
+    nearest source point, unless the coordinate is periodic.
+
+    Args:
+        x_in: Numpy array of increasing source coordinates.
+        x_out: Numpy array of destination coordinates.
+        period: Period of the coordinate (e.g. 360 for longitude), or None.
+    Returns:
+        Sparse matrix of shape (len(x_out), len(x_in)).
+    """
+    x_in = np.asarray(x_in, dtype=np.float64)
+    x_out = np.asarray(x_out, dtype=np.float64)
+    num_in = len(x_in)
+    if period is not None:
+        # Extend the source points by one point on each side to wrap around
+        x_ext = np.concatenate([[x_in[-1]-period], x_in, [x_in[0]+period]])
+        index_ext = np.concatenate([[num_in-1], np.arange(num_in), [0]])
+        x_out = x_in[0] + np.mod(x_out - x_in[0], period)
+    else:
+        x_ext = x_in
+        index_ext = np.arange(num_in)
+        x_out = np.clip(x_out, x_in[0], x_in[-1])
+
+    upper = np.clip(np.searchsorted(x_ext, x_out, side='right'), 1, len(x_ext)-1)
+    lower = upper - 1
+    frac = (x_out - x_ext[lower])/(x_ext[upper] - x_ext[lower])
+    rows = np.arange(len(x_out))
+
+    return scipy.sparse.csr_matrix((np.concatenate([1-frac, frac]),
+                                    (np.concatenate([rows, rows]),
+                                     np.concatenate([index_ext[lower], index_ext[upper]]))),
+                                   shape=(len(x_out), num_in))
+
+
+def sort_permutation(coords):
+    """Returns the sparse matrix that sorts coords into increasing order."""
+    order = np.argsort(coords)
+    return scipy.sparse.csr_matrix((np.ones(len(order)), (np.arange(len(order)), order)),
+                                   shape=(len(order), len(order)))
+
+
+def sorted_weights_1d(weights_function, x_in, x_out, **kwargs):
+    """Runs a 1D weights function on sorted coordinates and undoes the sort.
+
+    This allows weights to be created for grids with decreasing coordinates
+    (e.g. latitudes from north to south).
+    """
+    x_in = np.asarray(x_in, dtype=np.float64)
+    x_out = np.asarray(x_out, dtype=np.float64)
+    sort_in = sort_permutation(x_in)
+    sort_out = sort_permutation(x_out)
+    weights = weights_function(sort_in.dot(x_in), sort_out.dot(x_out), **kwargs)
+    return (sort_out.T.dot(weights).dot(sort_in)).tocsr()
+
+
+def bilinear_weights(lats_in, lons_in, lats_out, lons_out):
+    """Creates bilinear interpolation weights between rectilinear grids.
+
+    Args:
+        lats_in, lons_in: 1D numpy arrays of the source cell centers.
+        lats_out, lons_out: 1D numpy arrays of the destination cell centers.
+    Returns:
+        weights: Sparse matrix of shape (number of destination cells,
+                 number of source cells).
+    """
+    lat_weights = sorted_weights_1d(linear_weights_1d, lats_in, lats_out)
+    lon_weights = sorted_weights_1d(linear_weights_1d, lons_in, lons_out, period=360.)
+    return scipy.sparse.kron(lat_weights, lon_weights, format='csr')
+
+
+def cell_bounds(centers, lower_limit=-np.inf, upper_limit=np.inf):
+    """Estimates the bounds of cells from their centers.
+
+    Args:
+        centers: 1D numpy array of increasing cell centers.
+        lower_limit, upper_limit: Values to clip the outer bounds to (optional).
+    Returns:
+        Numpy array of len(centers)+1 bounds.
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    mids = (centers[1:] + centers[:-1])/2
+    bounds = np.concatenate([[2*centers[0] - mids[0]], mids, [2*centers[-1] - mids[-1]]])
+    return np.clip(bounds, lower_limit, upper_limit)
+
+
+def overlap_weights_1d(bounds_in, bounds_out, period=None):
+    """Creates weights from the fraction of each destination cell covered by
+    each source cell in one dimension.
+
+    Args:
+        bounds_in: Numpy array of increasing source cell bounds.
+        bounds_out: Numpy array of increasing destination cell bounds.
+        period: Period of the coordinate (e.g. 360 for longitude), or None.
+    Returns:
+        Sparse matrix of shape (len(bounds_out)-1, len(bounds_in)-1).
+    """
+    shifts = [0.] if period is None else [-period, 0., period]
+    overlap = np.zeros((len(bounds_out)-1, len(bounds_in)-1))
+    for shift in shifts:
+        lower = np.maximum(bounds_out[:-1, np.newaxis], bounds_in[np.newaxis, :-1] + shift)
+        upper = np.minimum(bounds_out[1:, np.newaxis], bounds_in[np.newaxis, 1:] + shift)
+        overlap = overlap + np.maximum(upper - lower, 0)
+    covered = overlap.sum(axis=1, keepdims=True)
+    return scipy.sparse.csr_matrix(overlap/np.where(covered > 0, covered, 1))
+
+
+def lat_overlap_weights(lats_in, lats_out):
+    """Creates the latitude part of conservative weights from increasing
+    latitudes. The area between two latitudes is proportional to the
+    difference of their sines."""
+    sin_bounds_in = np.sin(np.deg2rad(cell_bounds(lats_in, -90., 90.)))
+    sin_bounds_out = np.sin(np.deg2rad(cell_bounds(lats_out, -90., 90.)))
+    return overlap_weights_1d(sin_bounds_in, sin_bounds_out)
+
+
+def lon_overlap_weights(lons_in, lons_out):
+    """Creates the longitude part of conservative weights from increasing
+    longitudes."""
+    return overlap_weights_1d(cell_bounds(lons_in), cell_bounds(lons_out), period=360.)
+
+
+def conservative_weights(lats_in, lons_in, lats_out, lons_out):
+    """Creates first-order conservative weights between rectilinear grids.
+
+    Each destination cell is the area-weighted mean of the source cells that
+    overlap it. Cell bounds are estimated from the cell centers.
+
+    Args:
+        lats_in, lons_in: 1D numpy arrays of the source cell centers.
+        lats_out, lons_out: 1D numpy arrays of the destination cell centers.
+    Returns:
+        weights: Sparse matrix of shape (number of destination cells,
+                 number of source cells).
+    """
+    lat_weights = sorted_weights_1d(lat_overlap_weights, lats_in, lats_out)
+    lon_weights = sorted_weights_1d(lon_overlap_weights, lons_in, lons_out)
+    return scipy.sparse.kron(lat_weights, lon_weights, format='csr')
+
+
+def create_weights(lats_in, lons_in, lats_out, lons_out, regrid_method):
+    """Creates the sparse regridding weights for a regrid_method.
+
+    Raises:
+        ValueError: If the method is not supported for these grids.
+    """
+    if regrid_method == 'nearest_s2d':
+        return nearest_weights(lats_in, lons_in, lats_out, lons_out)
+    if regrid_method not in SUPPORTED_METHODS:
+        raise ValueError('Regrid method ' + regrid_method + ' is not supported; use one of ' +
+                         str(SUPPORTED_METHODS))
+    if np.ndim(lats_in) != 1 or np.ndim(lats_out) != 1:
+        raise ValueError('Regrid method ' + regrid_method + ' needs rectilinear grids')
+    if regrid_method == 'bilinear':
+        return bilinear_weights(lats_in, lons_in, lats_out, lons_out)
+    return conservative_weights(lats_in, lons_in, lats_out, lons_out)
+
+
+def regrid_block(block, weights, shape_out):
+    """Regrids one in-memory block of an array (see apply_weights)."""
+    return apply_weights(weights, block, shape_out)
+
+
+def apply_weights(weights, data, shape_out):
+    """Regrids an array whose last two dimensions are the source grid.
+
+    All leading dimensions (e.g. time) are regridded at once with a single
+    sparse-dense matrix product. Dask arrays are regridded block by block.
+
+    Args:
+        weights: Sparse matrix of regridding weights.
+        data: Numpy or dask array of shape (..., source ny, source nx).
+        shape_out: Tuple (destination ny, destination nx).
+    Returns:
+        Numpy or dask array of shape (..., destination ny, destination nx).
+    """
+    if isinstance(data, da.Array):
+        data = data.rechunk({data.ndim-2: -1, data.ndim-1: -1})
+        return data.map_blocks(regrid_block, weights=weights, shape_out=shape_out,
+                               chunks=data.chunks[:-2] + ((shape_out[0],), (shape_out[1],)),
+                               dtype=data.dtype)
+    leading_shape = np.shape(data)[:-2]
+    flat = np.reshape(data, (-1, np.shape(data)[-2]*np.shape(data)[-1]))
+    regridded = weights.dot(flat.T).T
+    return np.reshape(regridded, leading_shape + tuple(shape_out)).astype(data.dtype)
+
+
+class SparseRegridder():
+    """Regrids datasets with precomputed sparse weights, like xesmf.Regridder."""
+
+    def __init__(self, weights, grid_dims_in, reference_grid):
+        """
+        Args:
+            weights: Sparse matrix of regridding weights.
+            grid_dims_in: Tuple of the names of the source (y, x) dimensions.
+            reference_grid: The dataset containing the reference grid.
+        """
+        self.weights = weights
+        self.grid_dims_in = tuple(grid_dims_in)
+        self.reference_grid = reference_grid
+        self.shape_out = (reference_grid['lat'].size, reference_grid['lon'].size)
+
+    def regrid_dataarray(self, data_array):
+        """Regrids a DataArray with the source grid as its last two dimensions."""
+        other_dims = [dim for dim in data_array.dims if dim not in self.grid_dims_in]
+        data_array = data_array.transpose(*(other_dims + list(self.grid_dims_in)))
+        regridded = apply_weights(self.weights, data_array.data, self.shape_out)
+        coords = {dim: data_array[dim] for dim in other_dims if dim in data_array.coords}
+        coords['lat'] = self.reference_grid['lat'].values
+        coords['lon'] = self.reference_grid['lon'].values
+        return xr.DataArray(regridded, dims=other_dims + ['lat', 'lon'],
+                            coords=coords, attrs=data_array.attrs, name=data_array.name)
+
+    def __call__(self, ds_in):
+        """Regrids all variables of a Dataset (or a DataArray) on the source grid."""
+        if isinstance(ds_in, xr.DataArray):
+            return self.regrid_dataarray(ds_in)
+        regridded = {name: self.regrid_dataarray(ds_in[name])
+                     for name in ds_in.data_vars
+                     if set(self.grid_dims_in).issubset(ds_in[name].dims)}
+        return xr.Dataset(regridded, attrs=ds_in.attrs)
+
+
+def source_grid_dims(ds_in, latvariable='lat', lonvariable='lon'):
+    """Returns the names of the (y, x) dimensions of the source grid."""
+    if ds_in[latvariable].ndim == 1:
+        return (ds_in[latvariable].dims[0], ds_in[lonvariable].dims[0])
+    return ds_in[latvariable].dims
+
+
+def build_regridder(ds_in, reference_grid, regrid_method, weight_file=None,
+                    reuse_weights=False, latvariable='lat', lonvariable='lon'):
+    """Creates a SparseRegridder, reading or saving its weights in weight_file.
+
+    Args:
+        ds_in: The dataset on the source grid.
+        reference_grid: The dataset containing the reference grid.
+        regrid_method: The string name of the method to use for regridding.
+        weight_file: String path of the .npz file of weights (optional).
+        reuse_weights: True to read the weights from weight_file.
+        latvariable: The string name for the source latitude variable.
+        lonvariable: The string name for the source longitude variable.
+    Returns:
+        The SparseRegridder.
+    """
+    if reuse_weights:
+        weights = scipy.sparse.load_npz(weight_file)
+    else:
+        weights = create_weights(ds_in[latvariable].values, ds_in[lonvariable].values,
+                                 reference_grid['lat'].values, reference_grid['lon'].values,
+                                 regrid_method)
+        if weight_file is not None:
+            scipy.sparse.save_npz(weight_file, weights)
+    return SparseRegridder(weights, source_grid_dims(ds_in, latvariable, lonvariable),
+                           reference_grid)
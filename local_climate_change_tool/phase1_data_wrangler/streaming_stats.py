@@ -0,0 +1,277 @@
+"""
+streaming_stats.py
+
+Computes statistics over a dimension (e.g. over ensemble members or models)
+by adding in one slice at a time, so memory use does not depend on the number
+of slices. Means and standard deviations use Welford's single pass updates,
+and NaNs are skipped like in np.nanmean, np.nanmin, np.nanmax, and np.nanstd.
+Slices can also be given weights (e.g. per-model weights), giving weighted
+means and standard deviations in the same single pass.
+
+Lazy (dask) arrays are reduced one block at a time: each block holds all the
+slices of a few times (at most ENSEMBLE_BLOCK_BYTES), so the reduction stays
+lazy and its memory use does not depend on the length of the data.
+"""
+import numpy as np
+import dask.array as da
+
+from phase1_data_wrangler.analysis_parameters import ENSEMBLE_BLOCK_BYTES
+
+ENSEMBLE_DIM = 'member_id'
+SPREAD_SUFFIX = '_spread'
+COUNT_SUFFIX = '_count'
+
+
+def welford_update(count, mean, m2, values, weight_sum=None, weight=1.):
+    """Adds one slice of values to running counts, means, and sums of squares.
+
+    NaN values are skipped. count, mean, and m2 (and weight_sum) are updated
+    in place. If weight_sum is given, the values are added with the given
+    weight (West's weighted update), so mean and m2 become the weighted mean
+    and weighted sum of squared differences.
+
+    Args:
+        count: Integer array of the number of non-NaN values added so far.
+        mean: Float64 array of the running means (0 where count is 0).
+        m2: Float64 array of the running sums of squared differences from
+            the mean (None to only update the means).
+        values: Array of the values to add, with the same shape.
+        weight_sum: Float64 array of the sum of the weights of the non-NaN
+                    values added so far (optional).
+        weight: Non-negative float weight of the values.
+    """
+    valid = ~np.isnan(values)
+    # Replacing NaNs by the current mean makes their updates zero
+    values = np.where(valid, values, mean)
+    delta = values - mean
+    count += valid
+    if weight_sum is None:
+        mean += delta / np.maximum(count, 1)
+        if m2 is not None:
+            m2 += delta * (values - mean)
+    else:
+        weight_sum += weight*valid
+        mean += delta * np.divide(weight, weight_sum, out=np.zeros(mean.shape),
+                                  where=weight_sum > 0)
+        if m2 is not None:
+            m2 += weight * delta * (values - mean)
+
+
+def welford_finalize(count, mean, m2, weight_sum=None):
+    """Returns the means and standard deviations (ddof=0) of the added values.
+
+    Both are NaN where no non-NaN values (with a non-zero weight, if
+    weight_sum is given) were added. The standard deviations are None if m2
+    is None.
+    """
+    if weight_sum is None:
+        weight_sum = count
+    empty = weight_sum <= 0
+    final_mean = np.where(empty, np.nan, mean)
+    if m2 is None:
+        return [final_mean, None]
+    std = np.sqrt(np.where(empty, np.nan, m2) / np.where(empty, 1, weight_sum))
+    return [final_mean, std]
+
+
+class StreamingStats():
+    """Running NaN-aware count, mean, min, max, and standard deviation.
+
+    Slices are added one at a time with add, so only the running statistics
+    (and the slice being added) are held in memory. More slices can be added
+    to a result at any time, and results over separate slices can be
+    combined with merge.
+
+    If weighted, each slice is added with a weight and the mean and standard
+    deviation are weighted (min, max, and count are not). The standard
+    deviation (spread) and the min and max (extremes) can be left out, so
+    that their running arrays are not allocated.
+
+    Attributes:
+        count: Integer array of the number of non-NaN values added.
+        mean: Float64 array of the running means (0 where count is 0).
+        m2: Float64 array of the running sums of squared differences from the
+            mean (None unless spread).
+        min: Float64 array of the running minimums (inf where count is 0, None
+             unless extremes).
+        max: Float64 array of the running maximums (-inf where count is 0,
+             None unless extremes).
+        weight_sum: Float64 array of the sum of the weights of the non-NaN
+                    values added (None unless weighted).
+    """
+
+    def __init__(self, shape, weighted=False, spread=True, extremes=True):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64) if spread else None
+        self.min = np.full(shape, np.inf) if extremes else None
+        self.max = np.full(shape, -np.inf) if extremes else None
+        self.weight_sum = np.zeros(shape, dtype=np.float64) if weighted else None
+
+    def add(self, values, weight=1.):
+        """Adds one slice of values with a weight, skipping NaNs."""
+        if self.weight_sum is None and weight != 1:
+            raise ValueError('Weights can only be given to a weighted StreamingStats')
+        values = np.asarray(values, dtype=np.float64)
+        welford_update(self.count, self.mean, self.m2, values, self.weight_sum, weight)
+        if self.min is not None:
+            # fmin and fmax ignore NaNs
+            np.fmin(self.min, values, out=self.min)
+            np.fmax(self.max, values, out=self.max)
+
+    def merge(self, other):
+        """Adds all the values that were added to another StreamingStats."""
+        if self.weight_sum is None:
+            [self_weights, other_weights] = [self.count, other.count]
+        else:
+            [self_weights, other_weights] = [self.weight_sum, other.weight_sum]
+        total = self_weights + other_weights
+        delta = other.mean - self.mean
+        weight = np.divide(other_weights, total, out=np.zeros(total.shape), where=total > 0)
+        self.mean += delta*weight
+        if self.m2 is not None:
+            self.m2 += other.m2 + delta**2*self_weights*weight
+        self.count = self.count + other.count
+        if self.weight_sum is not None:
+            self.weight_sum = total
+        if self.min is not None:
+            np.fmin(self.min, other.min, out=self.min)
+            np.fmax(self.max, other.max, out=self.max)
+
+    def results(self, dtype=np.float64):
+        """Returns the statistics of all the values added so far.
+
+        Args:
+            dtype: Float dtype of the returned mean, min, max, and std.
+        Returns:
+            Dictionary of 'mean', 'min', 'max', 'std' (ddof=0), and 'count'
+            arrays (without 'std' unless spread, and without 'min' and 'max'
+            unless extremes). All but count are NaN where no non-NaN values
+            were added.
+        """
+        [mean, std] = welford_finalize(self.count, self.mean, self.m2, self.weight_sum)
+        empty = self.count == 0
+        results = {'mean': mean.astype(dtype), 'count': self.count.copy()}
+        if std is not None:
+            results['std'] = std.astype(dtype)
+        if self.min is not None:
+            results['min'] = np.where(empty, np.nan, self.min).astype(dtype)
+            results['max'] = np.where(empty, np.nan, self.max).astype(dtype)
+        return results
+
+
+def reduce_block(block, axis, names, stat_dtype):
+    """Computes statistics over one axis of an in-memory block, one slice at
+    a time.
+
+    Args:
+        block: Numpy array to reduce.
+        axis: Integer axis to reduce over.
+        names: List of the names of the statistics to return ('mean', 'std',
+               and/or 'count').
+        stat_dtype: Float dtype of the means and standard deviations.
+    Returns:
+        Float64 array of the statistics stacked along a new first axis.
+    """
+    stats = StreamingStats(block.shape[:axis] + block.shape[axis + 1:],
+                           spread='std' in names, extremes=False)
+    for i in range(block.shape[axis]):
+        stats.add(np.take(block, i, axis=axis))
+    results = stats.results(stat_dtype)
+    return np.stack([results[name].astype(np.float64) for name in names])
+
+
+def reduce_lazy_array(data, axis, names, dtype, block_bytes=ENSEMBLE_BLOCK_BYTES,
+                      time_axis=None):
+    """Lazily computes statistics over one axis of a dask array.
+
+    The array is rechunked so that each block holds every slice along axis
+    (and, if time_axis is given, whole fields of as many times as fit in
+    block_bytes), and each block is reduced with reduce_block.
+
+    Returns:
+        Lazy float64 dask array of the statistics stacked along a new first axis.
+    """
+    chunks = {axis: -1}
+    if time_axis is not None:
+        # Whole fields (as the regridders need them) of as many times as fit
+        chunks = {i: -1 for i in range(data.ndim)}
+        chunks[time_axis] = 'auto'
+    data = data.rechunk(chunks, block_size_limit=block_bytes)
+    out_chunks = ((len(names),),) + tuple(chunk for i, chunk in enumerate(data.chunks)
+                                          if i != axis)
+    return da.map_blocks(reduce_block, data, axis=axis, names=names, stat_dtype=dtype,
+                         dtype=np.float64, drop_axis=axis, new_axis=0, chunks=out_chunks)
+
+
+def reduce_dataarray(data_array, dim=ENSEMBLE_DIM, spread=False, count=False,
+                     block_bytes=ENSEMBLE_BLOCK_BYTES):
+    """Computes the mean (and standard deviation and count) of a DataArray over dim.
+
+    Lazy DataArrays stay lazy: they are reduced one block of times at a time
+    when they are computed (see reduce_lazy_array). In-memory DataArrays are
+    reduced one slice along dim at a time.
+
+    Args:
+        data_array: The (lazy or in-memory) DataArray to reduce.
+        dim: String name of the dimension to reduce over.
+        spread: If True, also returns the standard deviation (ddof=0).
+        count: If True, also returns the number of non-NaN values.
+        block_bytes: Integer maximum bytes of each block of a lazy DataArray.
+    Returns:
+        reduced: Dictionary of 'mean' (and 'spread' and 'count') DataArrays
+                 without dim or attributes. mean and spread have the float
+                 dtype of data_array (float64 for other dtypes).
+    """
+    names = ['mean'] + ['std']*spread + ['count']*count
+    template = data_array.isel({dim: 0}, drop=True)
+    template.attrs = dict()
+    dtype = data_array.dtype if np.issubdtype(data_array.dtype, np.floating) else np.float64
+    axis = data_array.get_axis_num(dim)
+
+    if isinstance(data_array.data, da.Array):
+        time_axis = data_array.get_axis_num('time') if 'time' in data_array.dims else None
+        stacked = reduce_lazy_array(data_array.data, axis, names, dtype, block_bytes,
+                                    time_axis)
+    else:
+        stacked = reduce_block(np.asarray(data_array.values), axis, names, dtype)
+
+    dtypes = {'mean': dtype, 'std': dtype, 'count': np.int64}
+    results = {name: template.copy(data=stacked[i].astype(dtypes[name]))
+               for i, name in enumerate(names)}
+    results['spread'] = results.pop('std', None)
+    return results
+
+
+def reduce_ensemble(ds, dim=ENSEMBLE_DIM, spread=False, count=False):
+    """Averages every variable of a dataset over its ensemble members.
+
+    This gives the same means as ds.mean(dim=dim). Lazy datasets stay lazy,
+    and only one block of times of the members of one variable is held in
+    memory at a time (plus the running statistics). The standard deviations
+    and counts are only computed if they are asked for.
+
+    Args:
+        ds: The (lazy or in-memory) dataset with an ensemble dimension.
+        dim: String name of the ensemble dimension.
+        spread: If True, also adds the standard deviation (ddof=0) across
+                members of each variable as <name>_spread.
+        count: If True, also adds the number of non-NaN members of each
+               variable as <name>_count.
+    Returns:
+        ds_reduced: The dataset without the ensemble dimension. Like
+                    ds.mean, the dataset and the averaged variables lose
+                    their attributes.
+    """
+    names = [name for name in ds.data_vars if dim in ds[name].dims]
+    ds_reduced = ds.drop_dims(dim)
+    ds_reduced.attrs = dict()
+    for name in names:
+        reduced = reduce_dataarray(ds[name], dim, spread=spread, count=count)
+        ds_reduced[name] = reduced['mean']
+        if spread:
+            ds_reduced[name + SPREAD_SUFFIX] = reduced['spread']
+        if count:
+            ds_reduced[name + COUNT_SUFFIX] = reduced['count']
+
+    return ds_reduced
@@ -20,6 +20,8 @@ def create_data_dict(this_experiment_id, this_variable_id,
         this_experiment_id: The string ID for the experiment.
                             Can be list of strings.
         this_variable_id; The string ID for this variable (e.g. 'tas').
+                          Can be list of strings, in which case each
+                          dataset in the dict holds all of its variables.
         this_table_id: ID for the table (e.g. 'Amon').
         this_grid_label: String label of the reference grid (e.g. 'gn').
     Returns:
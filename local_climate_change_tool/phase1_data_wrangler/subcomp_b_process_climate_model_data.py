@@ -5,20 +5,52 @@ Processes raw CMIP6 output to create files with consistent dimensions for all mo
 Running this script for all models with just averaging over ensembles, regridding,
 and saving takes about 15-20 mins.
 
-Make sure to clear the directory you would like the zarr files to be saved in - something about
-this format makes it not work to overwrite existing files.
+Each dataset is opened once and its variables (VARIABLE_IDS) are processed
+and saved one at a time, to one zarr file per variable, sharing a single
+regridder (with weights cached between runs, see regrid_weight_cache.py).
+Each variable is streamed to disk one latitude band at a time, so only a
+bounded amount of it is held in memory. Datasets can be processed in
+parallel (see NUM_WORKERS and PARALLEL_BACKEND).
+
+data_wrangler.py only passes in the datasets whose files are out of date
+(according to the manifest of the output directory, see manifest.py) and
+saves them to a staging directory, from which each new file replaces the
+old one, so existing files do not need to be cleared first.
 """
-import cftime
+import os
+import signal
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import dask
 import xarray as xr
-import xesmf as xe
 import numpy as np
+try:
+    import xesmf as xe
+except ImportError:
+    # Only needed for REGRID_BACKEND = 'xesmf'; see sparse_regrid.py
+    xe = None
+try:
+    import psutil
+except ImportError:
+    # Only needed for WORKER_MEMORY_LIMIT with PARALLEL_BACKEND = 'processes'
+    psutil = None
 
 from phase1_data_wrangler.analysis_parameters import EXPERIMENT_LIST, \
-    VARIABLE_ID, DIR_PROCESSED_DATA, DIR_INTERMEDIATE_PROCESSED_MODEL_DATA
+    VARIABLE_IDS, UNIT_CONVERSIONS, DIR_PROCESSED_DATA, DIR_INTERMEDIATE_PROCESSED_MODEL_DATA, \
+    DIR_REGRID_WEIGHTS, NUM_WORKERS, PARALLEL_BACKEND, WORKER_MEMORY_LIMIT, \
+    MEMORY_CHECK_SECONDS, ZARR_CHUNKS, ZARR_MEMORY_BUDGET, REGRID_BACKEND, DATA_DTYPE
+from phase1_data_wrangler.regrid_weight_cache import grid_hash, \
+    weight_file_path, lookup_weights, temporary_weight_path, publish_weights, \
+    CACHE_STATS, reset_cache_stats, merge_cache_stats
+from phase1_data_wrangler.zarr_writer import write_zarr_streaming
+from phase1_data_wrangler import sparse_regrid
+from phase1_data_wrangler.calendar_normalization import normalize_times
+from phase1_data_wrangler.streaming_stats import reduce_ensemble
 
 
 THIS_EXPERIMENT_ID = EXPERIMENT_LIST
-THIS_VARIABLE_ID = VARIABLE_ID
+THIS_VARIABLE_IDS = VARIABLE_IDS
 OUTPUT_PATH = DIR_PROCESSED_DATA
 DIR_INTERMEDIATE = DIR_INTERMEDIATE_PROCESSED_MODEL_DATA
 
@@ -39,130 +71,458 @@ def create_reference_grid(reference_key, dset_dict):
     return ds_out
 
 
-def reindex_time(startingtimes):
+def reindex_time(startingtimes, validate=True):
     """Reindexes time series to proleptic Gregorian calendar type.
 
+    Each time is moved to the 15th of its month (see calendar_normalization.py).
+
     Args:
         startingtimes: Array of the time series.
+        validate: If True, raises a ValueError if there are missing or duplicate months.
     Returns:
         newtimes: Numpy array of the new, proleptic Gregorian calendar type times.
     """
-    newtimes = np.empty(np.shape(startingtimes.values), dtype=cftime.DatetimeProlepticGregorian)
-    for i in range(0, len(startingtimes)):
-        yr = int(str(startingtimes.values[i])[0:4])
-        mon = int(str(startingtimes.values[i])[5:7])
-        newdate = cftime.DatetimeProlepticGregorian(yr, mon, 15)
-        newtimes[i] = newdate
+    newtimes = normalize_times(np.asarray(startingtimes.values), validate=validate)
 
     return newtimes
 
 
+def get_regridder(ds_in, reference_grid, regrid_method='nearest_s2d',
+                  backend=REGRID_BACKEND, weights_dir=DIR_REGRID_WEIGHTS,
+                  latvariable='lat', lonvariable='lon'):
+    """Creates a regridder from the grid of ds_in to the reference grid.
+
+    Regridding weights are read from the weight cache in weights_dir if they
+    have already been generated for this source grid, reference grid, and
+    method. Otherwise they are generated and added to the cache.
+
+    Args:
+        ds_in: The dataset on the source grid.
+        reference_grid: The dataset containing the reference grid.
+        regrid_method: The string name of the method to use for regridding.
+        backend: 'xesmf' to regrid with xESMF or 'sparse' to regrid with
+                 scipy.sparse weights (see sparse_regrid.py).
+        weights_dir: The string path of the regridding weight cache.
+        latvariable: The string name for the latitude variable.
+        lonvariable: The string name for the longitude variable.
+    Returns:
+        regridder: Callable that regrids datasets on the source grid.
+    """
+    weight_key = grid_hash(ds_in, reference_grid, regrid_method,
+                           latvariable=latvariable, lonvariable=lonvariable)
+    if backend == 'sparse':
+        weight_file = weight_file_path(weight_key, regrid_method, extension='.npz',
+                                       cache_dir=weights_dir)
+        reuse_weights = lookup_weights(weight_file)
+        build_file = weight_file if reuse_weights else temporary_weight_path(weight_file)
+        regridder = sparse_regrid.build_regridder(ds_in, reference_grid, regrid_method,
+                                                  weight_file=build_file,
+                                                  reuse_weights=reuse_weights,
+                                                  latvariable=latvariable,
+                                                  lonvariable=lonvariable)
+    elif backend == 'xesmf':
+        if xe is None:
+            raise ImportError("xESMF is not installed; use REGRID_BACKEND = 'sparse'")
+        weight_file = weight_file_path(weight_key, regrid_method, cache_dir=weights_dir)
+        reuse_weights = lookup_weights(weight_file)
+        build_file = weight_file if reuse_weights else temporary_weight_path(weight_file)
+        regridder = xe.Regridder(ds_in, reference_grid, regrid_method, periodic=True,
+                                 filename=build_file, reuse_weights=reuse_weights)
+    else:
+        raise ValueError('Unknown regridding backend: '+str(backend))
+
+    if not reuse_weights:
+        publish_weights(build_file, weight_file)
+
+    return regridder
+
+
+def dataset_variables(ds, variable_ids=THIS_VARIABLE_IDS):
+    """Returns the list of the variables in variable_ids that ds contains."""
+    return [variable for variable in variable_ids if variable in ds.data_vars]
+
+
+def model_regridder(ds, reference_grid, latvariable='lat', lonvariable='lon',
+                    regrid_method='nearest_s2d', weights_dir=DIR_REGRID_WEIGHTS,
+                    backend=REGRID_BACKEND):
+    """Returns a regridder from the grid of model output to a reference grid.
+
+    Only the coordinates of ds are used, so the regridder can be reused for
+    every variable on the same grid (see regrid_model).
+    """
+    # The regridder input always names the coordinates 'lat' and 'lon'
+    ds_grid = xr.Dataset({'lat': ds[latvariable], 'lon': ds[lonvariable]})
+    return get_regridder(ds_grid, reference_grid, regrid_method, backend=backend,
+                         weights_dir=weights_dir)
+
+
 def regrid_model(ds, reference_grid, latvariable='lat',
-                 lonvariable='lon', regrid_method='nearest_s2d'):
+                 lonvariable='lon', regrid_method='nearest_s2d',
+                 weights_dir=DIR_REGRID_WEIGHTS, backend=REGRID_BACKEND,
+                 variables=None, regridder=None):
     """Regrids model output to a reference grid.
 
+    All variables are regridded together with a single regridder, and
+    regridding weights are cached between datasets on the same grid (see
+    get_regridder). A regridder from model_regridder can be passed in to
+    regrid several variables on the same grid one at a time.
+
     Args:
         ds: The dataset of the model output.
         reference_grid: The dataset containing the reference grid.
         latvariable: The string name for the latitude variable.
         lonvariable: The string name for the longitude variable.
         regrid_method: The string name of the method to use for regridding.
+        weights_dir: The string path of the regridding weight cache.
+        backend: String name of the regridding backend ('xesmf' or 'sparse').
+        variables: List of string names of the variables to regrid (None for
+                   all of THIS_VARIABLE_IDS in ds).
+        regridder: Regridder from the grid of ds (None to get one with
+                   model_regridder).
     Returns:
         data_series_regridded: The regridded model dataset.
     """
-    data_series = ds[THIS_VARIABLE_ID]
+    if variables is None:
+        variables = dataset_variables(ds)
+    data_series = ds[variables[0]]
     ds_in = xr.Dataset({'lat': data_series[latvariable],
                         'lon': data_series[lonvariable],
-                        'time': data_series['time'],
-                        THIS_VARIABLE_ID: data_series})
-    regridder = xe.Regridder(ds_in, reference_grid, regrid_method, periodic=True)
+                        'time': data_series['time']})
+    for variable in variables:
+        ds_in[variable] = ds[variable]
+    if regridder is None:
+        regridder = model_regridder(ds_in, reference_grid, regrid_method=regrid_method,
+                                    weights_dir=weights_dir, backend=backend)
     data_series_regridded = regridder(ds_in)
-    data_series_regridded.attrs.update(data_series.attrs)
+    for variable in variables:
+        data_series_regridded[variable].attrs.update(ds[variable].attrs)
 
     return data_series_regridded
 
 
-def process_dataset(this_key, dset_dict, final_grid):
-    """Processes each dataset in dictionary.
+def convert_units(data_array, variable_id, conversions=UNIT_CONVERSIONS):
+    """Converts a variable from its CMIP6 units (see UNIT_CONVERSIONS).
+
+    The scale and offset are Python floats, so they do not promote the
+    values to float64. Variables without a conversion are returned as is.
+    """
+    if variable_id not in conversions:
+        return data_array
+    conversion = conversions[variable_id]
+    attrs = dict(data_array.attrs, units=conversion['units'])
+    converted = data_array*conversion['scale'] + conversion['offset']
+    converted.attrs = attrs
+    return converted
+
+
+def process_variables(this_key, dset_dict, final_grid, variables=None):
+    """Processes each variable of a dataset in dictionary, one at a time.
 
     This processing involves:
         (1) Averaging over all ensemble members (member ids)
         (2) Getting into consistent time format
         (3) Renaming coordinates if necessary
         (4) Regridding to reference dataset
+        (5) Storing the variables as DATA_DTYPE (e.g. float32)
+        (6) Converting the variables' units (see UNIT_CONVERSIONS)
+
+    The variables share a single regridder, but each is only processed when
+    the next one is asked for, so a variable can be saved before the next
+    one is read.
 
     Args:
         this_key: String key of the original datast in the dictionary.
         dset_dict: Dictionary of the model data.
         final_grid: Datasest of the final grid.
-    Returns:
-        dataset_regridded: The regridded model dataset.
+        variables: List of string names of the variables to process (None
+                   for all of THIS_VARIABLE_IDS in the dataset).
+    Yields:
+        variable: String name of the variable.
+        dataset_regridded: The regridded model dataset of the variable.
     """
     # Get original dataset from dictionary
     ds_original = dset_dict[this_key]
+    if variables is None:
+        variables = dataset_variables(ds_original)
+
+    regridder = None
+    for variable in variables:
+        # Average over all ensemble members lazily, one block of times at a time
+        ds = reduce_ensemble(ds_original[[variable]], dim='member_id')
+
+        # Reindex time to consistent time datatype
+        ds = xr.decode_cf(ds)
+        newtimes = reindex_time(startingtimes=ds['time'])
+        ds = ds.assign_coords(time=newtimes)
+
+        # Rename latitude and longitude coordinate names if necessary
+        if 'latitude' in ds.dims:
+            ds = ds.rename({'longitude': 'lon', 'latitude': 'lat'})
+        else:
+            pass
 
-    # Average over all ensemble members
-    ds = ds_original.mean(dim=['member_id'])
+        # Regrid to reference grid, with the regridder of the first variable
+        if regridder is None:
+            regridder = model_regridder(ds, final_grid)
+        dataset_regridded = regrid_model(ds, final_grid, variables=[variable],
+                                         regridder=regridder)
 
-    # Reindex time to consistent time datatype
-    ds = xr.decode_cf(ds)
-    newtimes = reindex_time(startingtimes=ds['time'])
-    ds['time'] = xr.DataArray(newtimes, coords=[newtimes], dims=['time'])
-    ds = ds.copy()
+        # Regridding may promote the values to float64; nothing downstream
+        # needs more than DATA_DTYPE (the ensemble means above accumulate in
+        # float64)
+        values = dataset_regridded[variable].astype(DATA_DTYPE)
+        dataset_regridded[variable] = convert_units(values, variable)
 
-    # Rename latitude and longitude coordinate names if necessary
-    if 'latitude' in ds.dims:
-        ds = ds.rename({'longitude': 'lon', 'latitude': 'lat'})
-    else:
-        pass
+        yield [variable, dataset_regridded]
 
-    # Regrid dataset to reference grid
-    dataset_regridded = regrid_model(ds, final_grid)
 
-    # If using a temperature variable, convert from K to C
-    if THIS_VARIABLE_ID in ('tas', 'tasmin', 'tasmax'):
-        dataset_regridded[THIS_VARIABLE_ID] = dataset_regridded[THIS_VARIABLE_ID] - 273.15
+def process_dataset(this_key, dset_dict, final_grid, variables=None):
+    """Processes each dataset in dictionary (see process_variables).
 
-    return dataset_regridded
+    Returns:
+        dataset_regridded: The regridded model dataset with all variables.
+    """
+    return xr.merge([dataset_regridded for [_, dataset_regridded]
+                     in process_variables(this_key, dset_dict, final_grid, variables)])
 
 
-def generate_new_filename(this_key):
-    """Generates filename for processed data from information in this_key."""
+def generate_new_filename(this_key, variable_id=THIS_VARIABLE_IDS[0]):
+    """Generates filename for processed data of a variable from information in this_key."""
     [_, _, source_id, experiment_id, _, _] = this_key.split('.')
-    this_fname = THIS_VARIABLE_ID+'_'+experiment_id+'_'+source_id
+    this_fname = variable_id+'_'+experiment_id+'_'+source_id
     return this_fname
 
 
-def save_dataset(ds, this_fname, data_path):
-    """Saves processed dataset ds as a zarr file: data_path/this_fname.zarr"""
-    ds.load()
+def save_dataset(ds, this_fname, data_path, chunks=ZARR_CHUNKS,
+                 memory_budget=ZARR_MEMORY_BUDGET):
+    """Saves processed dataset ds as a zarr file: data_path/this_fname.zarr
+
+    The dataset is kept lazy and written one latitude band at a time, so that
+    no more than memory_budget bytes of output are held in memory at once.
+    """
     # Export intermediate processed dataset as zarr file
-    ds.chunk({'lon':10, 'lat':10, 'time':-1})
-    ds.to_zarr(data_path+this_fname+'.zarr')
+    write_zarr_streaming(ds, data_path+this_fname+'.zarr', chunks=chunks,
+                         memory_budget=memory_budget)
+
+
+@contextlib.contextmanager
+def limit_task_memory(memory_limit, interval=MEMORY_CHECK_SECONDS):
+    """Stops the task run in the block once its process uses too much memory.
+
+    A thread checks the resident memory of the process every interval
+    seconds, and once it is over memory_limit bytes the block is interrupted
+    with a MemoryError instead of exhausting memory on the node. Only memory
+    in use counts (not the reserved address space), and the limit ends with
+    the block, so a reused worker starts every task without one.
+
+    The block must run in the main thread of the process, as each task does
+    in the workers of a process pool, since it is interrupted with SIGINT.
+
+    Raises:
+        MemoryError: If the process uses more than memory_limit bytes.
+    """
+    if psutil is None:
+        raise ImportError('psutil is needed to limit the memory of each task')
+    process = psutil.Process()
+    lock = threading.Lock()
+    state = {'running': True, 'resident': None}
+    stop = threading.Event()
+
+    def check_memory():
+        while not stop.wait(interval):
+            resident = process.memory_info().rss
+            if resident > memory_limit:
+                with lock:
+                    if state['running']:
+                        state['resident'] = resident
+                        # A signal also interrupts blocking calls (e.g. reads)
+                        os.kill(os.getpid(), signal.SIGINT)
+                return
+
+    checker = threading.Thread(target=check_memory, daemon=True)
+    checker.start()
+    try:
+        yield
+        # Once the block is done it can no longer be interrupted
+        with lock:
+            state['running'] = False
+    except KeyboardInterrupt:
+        if state['resident'] is None:
+            raise
+        raise MemoryError('Task used ' + str(state['resident']) +
+                          ' bytes of memory, over the limit of ' +
+                          str(memory_limit)) from None
+    finally:
+        stop.set()
+        checker.join()
+
+
+def save_variables(processed_variables, this_key, data_path_out):
+    """Saves each processed variable to its own zarr file as it is processed.
+
+    Args:
+        processed_variables: Iterable of (variable, dataset) pairs, as
+                             yielded by process_variables.
+        this_key: String key of the original dataset in the dictionary.
+        data_path_out: String name of the output path to put the saved files.
+    """
+    for [variable, ds_variable] in processed_variables:
+        save_dataset(ds_variable, generate_new_filename(this_key, variable), data_path_out)
+
+
+def process_and_save_dataset(this_key, ds_original, final_grid, data_path_out,
+                             variables, memory_limit=None):
+    """Processes and saves a single dataset from the dictionary.
+
+    This is the unit of work that is run in each worker when processing
+    datasets in parallel, so only the one dataset it needs is passed in. Each
+    of its variables is saved to its own file.
+
+    Args:
+        this_key: String key of the original dataset in the dictionary.
+        ds_original: The original dataset for this_key.
+        final_grid: Dataset of the final grid.
+        data_path_out: String name of the output path to put the saved files.
+        variables: List of string names of the variables to process.
+        memory_limit: Integer maximum number of bytes of resident memory of
+                      the worker process while it runs this task (optional,
+                      see limit_task_memory).
+    Returns:
+        cache_stats: Dictionary of regridding weight cache hits and misses.
+    """
+    reset_cache_stats()
+
+    # Workers already run in parallel, so compute each task graph in serial
+    with dask.config.set(scheduler='synchronous'), \
+            (limit_task_memory(memory_limit) if memory_limit is not None
+             else contextlib.nullcontext()):
+        save_variables(process_variables(this_key, {this_key: ds_original}, final_grid,
+                                         variables=variables),
+                       this_key, data_path_out)
+
+    return dict(CACHE_STATS)
+
+
+def run_tasks_in_process_pool(tasks, num_workers, memory_limit=None):
+    """Runs process_and_save_dataset for each task on a local process pool.
+
+    Args:
+        tasks: Dictionary of dataset key to process_and_save_dataset arguments.
+        num_workers: Integer maximum number of tasks to run at once.
+        memory_limit: Integer maximum number of bytes of resident memory of a
+                      worker while it runs a task (optional).
+    Returns:
+        failures: Dictionary of dataset key to error message for failed tasks.
+    """
+    failures = dict()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(process_and_save_dataset, *args,
+                                   memory_limit=memory_limit): key
+                   for key, args in tasks.items()}
+        for future in as_completed(futures):
+            try:
+                merge_cache_stats(future.result())
+            except Exception as err: # pylint: disable=broad-except
+                failures[futures[future]] = repr(err)
+    return failures
+
+
+def run_tasks_on_dask_cluster(tasks, num_workers, memory_limit=None):
+    """Runs process_and_save_dataset for each task on a local dask cluster.
+
+    Args:
+        tasks: Dictionary of dataset key to process_and_save_dataset arguments.
+        num_workers: Integer number of single-threaded dask workers.
+        memory_limit: Integer maximum number of bytes for each worker (optional).
+    Returns:
+        failures: Dictionary of dataset key to error message for failed tasks.
+    """
+    # dask.distributed is only needed for this backend
+    from dask.distributed import LocalCluster, Client, as_completed as dask_as_completed
+
+    failures = dict()
+    cluster_memory_limit = 'auto' if memory_limit is None else memory_limit
+    with LocalCluster(n_workers=num_workers, threads_per_worker=1,
+                      memory_limit=cluster_memory_limit) as cluster, \
+            Client(cluster) as client:
+        futures = {client.submit(process_and_save_dataset, *args,
+                                 key='process-'+key, pure=False): key
+                   for key, args in tasks.items()}
+        for future in dask_as_completed(list(futures)):
+            try:
+                merge_cache_stats(future.result())
+            except Exception as err: # pylint: disable=broad-except
+                failures[futures[future]] = repr(err)
+    return failures
 
 
 ##################### Main Workflow ##########################################
 
 def process_all_files_in_dictionary(dset_dict, exceptions_list,
-                                    final_grid, data_path_out=DIR_INTERMEDIATE):
-    """Run process_dataset and save_dataset for all files in the dictionary.
+                                    final_grid, data_path_out=DIR_INTERMEDIATE,
+                                    num_workers=NUM_WORKERS,
+                                    parallel_backend=PARALLEL_BACKEND,
+                                    memory_limit=WORKER_MEMORY_LIMIT,
+                                    variable_ids=THIS_VARIABLE_IDS):
+    """Run process_variables and save_dataset for all files in the dictionary.
+
+    Each dataset is opened once, and its variables in variable_ids share one
+    regridder but are processed and saved one at a time, to one file per
+    variable. With num_workers greater than 1, datasets are processed in
+    parallel on either a pool of local worker processes
+    (parallel_backend='processes') or a local dask cluster
+    (parallel_backend='dask'). A dataset that fails to process is reported
+    and skipped instead of stopping the whole run.
 
     Args:
         dset_dict: The data dictionary.
         exceptions_list: List of strings of file names that will throw exceptions.
         final_grid: Dataset of the final grid.
         data_path_out: String name of the output path to put the saved files.
+        num_workers: Integer maximum number of datasets to process at once.
+        parallel_backend: String name of the parallel backend to use.
+        memory_limit: Integer maximum number of bytes for each task (optional).
+        variable_ids: List of string names of the variables to process.
+    Returns:
+        failures: Dictionary of file name to error message for failed datasets.
     """
+    tasks = dict()
     for key in dset_dict.keys():
-        # Generate new filename for intermediate processed data
-        fname = generate_new_filename(key)
+        # A dataset without any of the variables is still processed, so that
+        # it is reported as a failure below
+        variables = dataset_variables(dset_dict[key], variable_ids) or list(variable_ids)
 
         # Check if one of cases that throws exceptions (to investigate later)
-        if fname in exceptions_list:
+        if any(generate_new_filename(key, variable) in exceptions_list
+               for variable in variables):
             print('******** skipping ************')
-        else:
-            # Process data
-            ds_processed = process_dataset(key, dset_dict, final_grid)
-
-            # Save processed data
-            save_dataset(ds_processed, fname, data_path_out)
+        variables = [variable for variable in variables
+                     if generate_new_filename(key, variable) not in exceptions_list]
+        if variables:
+            tasks[key] = (key, dset_dict[key], final_grid, data_path_out, variables)
+
+    if num_workers > 1 and parallel_backend == 'dask':
+        key_failures = run_tasks_on_dask_cluster(tasks, num_workers, memory_limit)
+    elif num_workers > 1 and parallel_backend == 'processes':
+        key_failures = run_tasks_in_process_pool(tasks, num_workers, memory_limit)
+    elif num_workers > 1:
+        raise ValueError('Unknown parallel backend: '+str(parallel_backend))
+    else:
+        key_failures = dict()
+        for key, (_, _, _, _, variables) in tasks.items():
+            try:
+                # Process and save the data one variable at a time
+                save_variables(process_variables(key, dset_dict, final_grid,
+                                                 variables=variables),
+                               key, data_path_out)
+            except Exception as err: # pylint: disable=broad-except
+                key_failures[key] = repr(err)
+
+    # Every file of a failed dataset has failed
+    failures = {generate_new_filename(key, variable): error
+                for key, error in key_failures.items() for variable in tasks[key][4]}
+
+    for fname, error in failures.items():
+        print('******** failed: '+fname+' ('+error+') ************')
+
+    return failures
@@ -2,25 +2,55 @@
 subcomp_c_multi_model_stats.py
 
 Generates files with multi-model statistics for each experiment.
+
+The statistics are computed one latitude band at a time and each band is
+written straight into its region of the output zarr file, so no full-size
+array is ever held in memory. Quantiles across models (see QUANTILES) are
+computed in the same pass and written as extra variables ('median', 'q05',
+'q95', etc.). Models can be weighted (see MODEL_WEIGHTING and
+model_weights.py), which weights the mean, std, and quantiles. Models that
+cover different months are aligned onto a shared time axis (see
+TIME_ALIGNMENT and time_alignment.py). Annual,
+seasonal, and climatology means of the multi-model mean are written to their
+own zarr files (see temporal_products.py).
 """
 import time
 import glob
+from concurrent.futures import ThreadPoolExecutor
 import xarray as xr
 import numpy as np
+import dask.array as da
 
 from phase1_data_wrangler.analysis_parameters import \
     DIR_INTERMEDIATE_PROCESSED_MODEL_DATA, EXPERIMENT_LIST, VARIABLE_ID, \
-    DIR_PROCESSED_DATA
+    DIR_PROCESSED_DATA, PROCESSED_LAYOUTS, CHUNK_LAYOUTS, BAND_WORKERS, \
+    BAND_BACKEND, BAND_MEMORY_BUDGET, QUANTILES, MODEL_WEIGHTING, MODEL_WEIGHTS_FILE, \
+    SKILL_PERIOD, DATA_DTYPE, TIME_ALIGNMENT
+from phase1_data_wrangler.zarr_writer import write_zarr_layouts, \
+    create_zarr_store, copy_to_layouts
+from phase1_data_wrangler.band_executor import choose_band_size, band_bounds, \
+    map_bands, band_stat_names, quantile_band_arrays
+from phase1_data_wrangler.prefetch_reader import IO_STATS, reset_io_stats, \
+    io_wait_fraction
+from phase1_data_wrangler.model_weights import model_name, climatology, \
+    derive_model_weights, read_weight_table, write_weight_table, weights_for_files
+from phase1_data_wrangler.subcomp_d_process_historical_obs import OUT_DIR, OUT_FILE_NAME
+from phase1_data_wrangler.temporal_products import write_temporal_products
+from phase1_data_wrangler.time_alignment import alignment_key, cached_alignment, \
+    align_datasets
 
 
 DATA_PATH = DIR_INTERMEDIATE_PROCESSED_MODEL_DATA
 SCENARIO_LIST = EXPERIMENT_LIST
 VARIABLE_NAME = VARIABLE_ID
 OUTPUT_PATH = DIR_PROCESSED_DATA+'model_data/'
+OBS_PATH = OUT_DIR + OUT_FILE_NAME
+STAT_NAMES = ['mean', 'min', 'max', 'std']
 INTERMEDIATE_OUTPUT_PATH = '/home/jovyan/local-climate-data-tool/data/intermediate_data/'
 
 
-def get_scenario_fnames(data_path, scenario, normalized=False):
+def get_scenario_fnames(data_path, scenario, normalized=False,
+                        variable_name=VARIABLE_NAME):
     """ Return list of zarr files.
 
     Get a string list of all zarr files in the data_path for the given
@@ -30,6 +60,7 @@ def get_scenario_fnames(data_path, scenario, normalized=False):
         data_path: The string file path.
         scenario: The string name of the scenario.
         normalized: False (default) if the model data is not normalized.
+        variable_name: The string name of the model variable.
     Returns:
         names: The string list of file names.
     """
@@ -40,7 +71,7 @@ def get_scenario_fnames(data_path, scenario, normalized=False):
                                                      'Normalized*_' + scenario + '_*.zarr')]
     else:
         names = [f[begcut:endcut] for f in glob.glob(data_path +
-                                                     VARIABLE_NAME+'*_' + scenario + '_*.zarr')]
+                                                     variable_name+'_' + scenario + '_*.zarr')]
     return names
 
 
@@ -60,18 +91,74 @@ def read_in_fname(data_path, fname):
     return xr.open_zarr(filename)
 
 
+def scenario_alignment(data_path, scenario_name, file_names, datasets,
+                       how=TIME_ALIGNMENT):
+    """Aligns the time axes of the models of a scenario (cached, see
+    time_alignment.py).
+
+    Returns:
+        times: DataArray of the shared time axis.
+        time_slices: List of the time slice of each dataset.
+    """
+    [times, time_slices] = cached_alignment(alignment_key(data_path, scenario_name, file_names),
+                                            datasets, how, scenario_name)
+    times = xr.DataArray(times, coords={'time': times}, dims='time', name='time')
+    return [times, time_slices]
+
+
+def create_mms_store(out_store, lats, lons, times, stat_names=STAT_NAMES):
+    """Creates the zarr file the multi-model statistics are written to.
+
+    Args:
+        out_store: String path of the zarr file to create.
+        lats, lons, times: Coordinates of the statistics.
+        stat_names: List of the names of the statistics.
+    Returns:
+        List of the zarr arrays for each multi-model statistic, in the order
+        of stat_names.
+    """
+    shape = (len(times), len(lats), len(lons))
+    ds_coords = {'time': times, 'lat': lats, 'lon': lons}
+    ds_template = xr.Dataset({name: (('time', 'lat', 'lon'),
+                                     da.empty(shape, dtype=DATA_DTYPE))
+                              for name in stat_names},
+                             coords=ds_coords)
+    group = create_zarr_store(ds_template, out_store, chunks=CHUNK_LAYOUTS['series'])
+    return [group[name] for name in stat_names]
+
+
 def initialize_empty_mms_arrays(data_path, scenario_name, num_chunks,
-                                normalized=False):
+                                normalized=False, out_store=None,
+                                num_workers=BAND_WORKERS,
+                                memory_budget=BAND_MEMORY_BUDGET, quantiles=(),
+                                variable_name=VARIABLE_NAME):
     """Initialize arrays.
 
     Initialize empty arrays that will hold the multi-model stats data for the
-    given scenario.
+    given scenario. If out_store is given, the arrays are the variables of a
+    new zarr file at that path, so that the statistics are written straight
+    to disk; otherwise they are numpy arrays in memory.
+
+    The latitudes are split into num_chunks bands. If num_chunks is None,
+    the band size is chosen from the number of workers and the memory budget
+    (see band_executor.choose_band_size).
+
+    The arrays of any quantiles are added after the mean, min, max, and std
+    arrays. The time axis is shared by all models (see scenario_alignment).
 
     Args:
         data_path: String path where the arrays will be located.
         scenario_name: String name of the scenario.
-        num_chunks: Integer number of chunks to use for saving the zarr file.
+        num_chunks: Integer number of latitude bands (None to choose the
+                    band size automatically).
         normalized: False (default) if the data is not normalized.
+        out_store: String path of the zarr file to create (optional).
+        num_workers: Integer number of bands computed at once (None for one
+                     per core).
+        memory_budget: Integer bytes of memory to use for the bands in
+                       flight (None for half of the available memory).
+        quantiles: List of quantiles across models to compute as well.
+        variable_name: The string name of the model variable.
     Returns:
         empty_dsets: List of empty arrays.
         dim_info: List of number of chunks (lat & lon), models, time, lat, & lon.
@@ -79,11 +166,11 @@ def initialize_empty_mms_arrays(data_path, scenario_name, num_chunks,
         file_names: List of names of files containing models in the scenario.
         datasets: List of empty numpy arrays for each multi-model statistic.
     """
-    file_names = get_scenario_fnames(data_path, scenario_name, normalized)
+    file_names = get_scenario_fnames(data_path, scenario_name, normalized, variable_name)
     datasets = [read_in_fname(data_path, x) for x in file_names]
 
     nmodels = len(datasets)
-    times = datasets[0].time
+    times = scenario_alignment(data_path, scenario_name, file_names, datasets)[0]
     lats = datasets[0]['lat']
     lons = datasets[0]['lon']
     dims = [lats, lons, times]
@@ -91,76 +178,98 @@ def initialize_empty_mms_arrays(data_path, scenario_name, num_chunks,
     ntime = len(times)
     nlat = len(lats)
     nlon = len(lons)
-    multi_model_means = np.empty((ntime, nlat, nlon))
-    multi_model_maxs = np.empty((ntime, nlat, nlon))
-    multi_model_mins = np.empty((ntime, nlat, nlon))
-    multi_model_stds = np.empty((ntime, nlat, nlon))
+    stat_names = band_stat_names(quantiles)
+    if out_store is None:
+        empty_dsets = [np.empty((ntime, nlat, nlon), dtype=DATA_DTYPE) for _ in stat_names]
+    else:
+        empty_dsets = create_mms_store(out_store, lats, lons, times, stat_names)
 
-    chunk_size = int(nlat/num_chunks)
+    if num_chunks is None:
+        band_size = choose_band_size(ntime, nlat, nlon, num_workers, memory_budget,
+                                     extra_arrays=quantile_band_arrays(nmodels, quantiles))
+        [nlat0_chunk, nlatf_chunk] = band_bounds(nlat, band_size)
+    else:
+        chunk_size = int(nlat/num_chunks)
 
-    boundary_cond = np.zeros(num_chunks)
-    boundary_cond[num_chunks-1] = -(chunk_size*num_chunks)+nlat
+        boundary_cond = np.zeros(num_chunks)
+        boundary_cond[num_chunks-1] = -(chunk_size*num_chunks)+nlat
 
-    nlat0_chunk = chunk_size*np.arange(0, num_chunks)
-    nlatf_chunk = chunk_size*np.arange(1, num_chunks+1) +boundary_cond
+        nlat0_chunk = chunk_size*np.arange(0, num_chunks)
+        nlatf_chunk = chunk_size*np.arange(1, num_chunks+1) +boundary_cond
 
-    empty_dsets = [multi_model_means, multi_model_mins, multi_model_maxs, multi_model_stds]
     dim_info = [nlat0_chunk, nlatf_chunk, nmodels, ntime, nlat, nlon]
 
     return [empty_dsets, dim_info, dims, file_names, datasets]
 
 
-def fill_empty_arrays(empty_dsets, dim_info, file_names, datasets, varname, num_chunks):
+def write_band(empty_dsets, chunk_results, nlat0, nlatf, stat_names=STAT_NAMES):
+    """Writes the multi-model statistics of one latitude band to the arrays."""
+    for output, name in zip(empty_dsets, stat_names):
+        output[:, nlat0:nlatf, :] = chunk_results[name]
+
+
+def fill_empty_arrays(empty_dsets, dim_info, file_names, datasets, varname, num_chunks,
+                      num_workers=BAND_WORKERS, backend=BAND_BACKEND, quantiles=(),
+                      weights=None, time_slices=None):
     """Fills the arrays with the multi-model statistics for that scenario.
 
+    Several bands are computed at once on a pool of num_workers threads or
+    processes (see band_executor.py). Each band is written to the arrays by
+    a writer thread while the next bands are computed. At most one band is
+    waiting to be written at a time.
+
     Args:
-        empty_dsets: List of empty arrays.
+        empty_dsets: List of empty arrays (numpy or zarr).
         dim_info: List of number of chunks (lat & lon), models, time, lat, & lon.
         file_names: List of names of files containing models in the scenario.
         datasets: List of empty numpy arrays for each multi-model statistic.
         varname: String name of the variable.
-        num_chunks: Integer number of chunks to use for saving the zarr file.
+        num_chunks: Integer number of chunks to use for saving the zarr file
+                    (the bands themselves are taken from dim_info).
+        num_workers: Integer number of bands computed at once (None for one
+                     per core, 1 runs in serial).
+        backend: Either 'threads' or 'processes'.
+        quantiles: List of quantiles across models, the same as given to
+                   initialize_empty_mms_arrays.
+        weights: List of the weight of each model in datasets (None for
+                 equal weights).
+        time_slices: List of the time slice of each model in datasets (see
+                     scenario_alignment; None to align the models here).
     Returns:
-        List of the multi-model statistic numpy arrays (mean, min, max, std).
+        List of the multi-model statistic arrays (mean, min, max, std, and
+        then the quantiles).
     """
-    [multi_model_means,
-     multi_model_mins,
-     multi_model_maxs,
-     multi_model_stds] = empty_dsets
-    [nlat0_chunk, nlatf_chunk, nmodels, ntime, _, nlon] = dim_info
-    for c in range(0, num_chunks):
-        # Define bounds for data chunk
-        nlat0 = int(nlat0_chunk[c])
-        nlatf = int(nlatf_chunk[c])
-        nlat_chunk = nlatf - nlat0
-
-        # Get data chunk from all models
-        model_data_chunk = np.empty((nmodels, ntime, nlat_chunk, nlon))
-        for i in range(nmodels):
-            #model_name = file_names[i].split("_")[2]
-            #print(model_name)
-            model_data_chunk[i, :, :, :] = datasets[i][varname][:, nlat0:nlatf, :]
-
-        multi_mean_chunk = np.nanmean(model_data_chunk, axis=0)
-        multi_min_chunk = np.nanmin(model_data_chunk, axis=0)
-        multi_max_chunk = np.nanmax(model_data_chunk, axis=0)
-        multi_std_chunk = np.nanstd(model_data_chunk, axis=0)
-
-        multi_model_means[:, nlat0:nlatf, :] = multi_mean_chunk
-        multi_model_mins[:, nlat0:nlatf, :] = multi_min_chunk
-        multi_model_maxs[:, nlat0:nlatf, :] = multi_max_chunk
-        multi_model_stds[:, nlat0:nlatf, :] = multi_std_chunk
-
-    return [multi_model_means, multi_model_mins,
-            multi_model_maxs, multi_model_stds]
-
-
-def create_xr_dataset(lats, lons, times, mean_vals, max_vals, min_vals, std_vals):
+    [nlat0_chunk, nlatf_chunk, _, _, _, _] = dim_info
+    if time_slices is None:
+        time_slices = align_datasets(datasets)[1]
+    stat_names = band_stat_names(quantiles)
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        pending_write = None
+        for [nlat0, nlatf, chunk_results] in map_bands(datasets, varname,
+                                                       nlat0_chunk, nlatf_chunk,
+                                                       num_workers=num_workers,
+                                                       backend=backend,
+                                                       quantiles=quantiles,
+                                                       weights=weights,
+                                                       time_slices=time_slices):
+            if pending_write is not None:
+                pending_write.result()
+            pending_write = writer.submit(write_band, empty_dsets, chunk_results,
+                                          nlat0, nlatf, stat_names)
+        if pending_write is not None:
+            pending_write.result()
+
+    return empty_dsets
+
+
+def create_xr_dataset(lats, lons, times, mean_vals, max_vals, min_vals, std_vals,
+                      quantile_vals=None):
     """Creates an xarray dataset from numpy arrays of multi-model statistics.
 
     Args:
         Arrays of dimensions (lats, lons, times) and multi-model statistic
         values (mean_vals, max_vals, min_vals, std_vals).
+        quantile_vals: Dictionary of quantile name to array (optional).
     Returns:
         ds: The xarray dataset of multi-model stats for the scenario.
     """
@@ -178,12 +287,26 @@ def create_xr_dataset(lats, lons, times, mean_vals, max_vals, min_vals, std_vals
                      'max': max_xr,
                      'std': std_xr,},
                     coords=ds_coords)
+    if quantile_vals is not None:
+        for name, values in quantile_vals.items():
+            ds[name] = xr.DataArray(values, dims=ds_dims, coords=ds_coords)
 
     return ds
 
 
-def export_dataset(ds, output_path, variable_name, scenario_name, normalized=False):
-    """Exports dataset to a zarr file.
+def get_mms_store_name(variable_name, scenario_name, normalized=False):
+    """Returns the name of the multi-model statistics zarr file for a scenario."""
+    if normalized:
+        return 'modelData_normalized_'+variable_name+'_'+scenario_name+'.zarr'
+    return 'modelData_'+variable_name+'_'+scenario_name+'.zarr'
+
+
+def export_dataset(ds, output_path, variable_name, scenario_name, normalized=False,
+                   layouts=PROCESSED_LAYOUTS):
+    """Exports dataset to a zarr file for each chunk layout.
+
+    The 'series' layout is read for time series at a point and the 'map'
+    layout for maps at a single time (see CHUNK_LAYOUTS).
 
     Args:
         ds: The dataset to export.
@@ -191,37 +314,90 @@ def export_dataset(ds, output_path, variable_name, scenario_name, normalized=Fal
         variable_name: The string name of the model variable.
         scenario_name: The string name of the scenario.
         normalized: False (default) if model data is not normalized.
+        layouts: List of string names of the chunk layouts to write.
     """
-    ds.chunk({'lon':10, 'lat':10, 'time':-1})
-    if normalized:
-        ds.to_zarr(output_path+'modelData_normalized_'+
-                   variable_name+'_'+scenario_name+'.zarr')
-    else:
-        ds.to_zarr(output_path+'modelData_'+
-                   variable_name+'_'+scenario_name+'.zarr')
+    write_zarr_layouts(ds, output_path+get_mms_store_name(variable_name, scenario_name,
+                                                          normalized),
+                       layouts=layouts)
+
+
+def get_model_weights(data_path, weighting=MODEL_WEIGHTING,
+                      weights_file=MODEL_WEIGHTS_FILE, obs_path=OBS_PATH,
+                      output_path=OUTPUT_PATH):
+    """Gets the weight of each model in the multi-model statistics.
+
+    With 'skill' weighting, the weights are derived from the climatologies of
+    the historical files of the observed variable (VARIABLE_ID, over
+    SKILL_PERIOD) and the observations, and are saved to
+    output_path/model_weights_<VARIABLE_ID>.csv. The same weights are used for
+    every variable.
+
+    Args:
+        data_path: String path of the processed model files.
+        weighting: Either 'equal', 'table', or 'skill'.
+        weights_file: String path of the csv file of weights for 'table'.
+        obs_path: String path of the observations zarr file for 'skill'.
+        output_path: String path where derived weights are saved.
+    Returns:
+        Dictionary of model to weight, or None for equal weights.
+    """
+    if weighting == 'equal':
+        return None
+    if weighting == 'table':
+        return read_weight_table(weights_file)
+    if weighting != 'skill':
+        raise ValueError('Unknown model weighting: '+str(weighting))
+
+    obs_clim = climatology(xr.open_zarr(obs_path)['mean'], SKILL_PERIOD)
+    model_climatologies = dict()
+    for fname in get_scenario_fnames(data_path, 'historical', variable_name=VARIABLE_ID):
+        ds = read_in_fname(data_path, fname)
+        model_climatologies[model_name(fname)] = climatology(ds[VARIABLE_ID], SKILL_PERIOD)
+    weights = derive_model_weights(model_climatologies, obs_clim)
+    write_weight_table(weights, output_path+'model_weights_'+VARIABLE_ID+'.csv')
+    return weights
+
+
+def print_model_weights(model_weights):
+    """Prints the weight of each model (nothing for equal weights)."""
+    if model_weights is not None:
+        print('Model weights: '+', '.join('%s %.2f' % (model, weight)
+                                          for model, weight in model_weights.items()))
 
 
 def create_scenario_mms_datasets(variable_name,
                                  scenario_name,
                                  num_chunks,
                                  data_path,
-                                 normalized=False):
+                                 normalized=False,
+                                 output_path=OUTPUT_PATH,
+                                 layouts=PROCESSED_LAYOUTS,
+                                 model_weights=None):
     """Create the multi-model statistics dataset for a scenario.
 
-    Runs the function initialize_empty_mms_arrays, fill_empty_arrays,
-    and create_xr_dataset to generate the multi-model statistics dataset
-    for a scenario. Prints to the user what is being done.
+    Runs the functions initialize_empty_mms_arrays and fill_empty_arrays to
+    write the multi-model statistics of a scenario (including the QUANTILES)
+    straight to a zarr file with the 'series' layout, which is then copied to
+    the other layouts. The temporal products (see TEMPORAL_PRODUCTS) of the
+    multi-model mean are then written to their own zarr files.
+    Prints to the user what is being done.
 
     Args:
         variable_name: The string name of the model variable.
         scenario_name: The string name of the scenario.
-        num_chunks: Integer number of chunks to use for saving the zarr file.
+        num_chunks: Integer number of latitude bands (None to choose the
+                    band size from the cores and memory available).
         data_path: String path where the arrays will be located.
         normalized: False (default) if model data is not normalized.
+        output_path: String path where the dataset will be exported to.
+        layouts: List of string names of the chunk layouts to write.
+        model_weights: Dictionary of model to weight (None for equal weights,
+                       see get_model_weights).
     Returns:
-        Arrays of dimensions (lats, lons, times) and multi-model statistic
-        values (mean_vals, max_vals, min_vals, std_vals).
+        Arrays of dimensions (lats, lons, times) and the zarr arrays of
+        multi-model statistic values (mean_vals, max_vals, min_vals, std_vals).
     """
+    store_path = output_path + get_mms_store_name(variable_name, scenario_name, normalized)
 
     print('Creating empty arrays')
     [empty_dsets,
@@ -230,11 +406,19 @@ def create_scenario_mms_datasets(variable_name,
      file_names,
      datasets] = initialize_empty_mms_arrays(data_path,
                                              scenario_name=scenario_name,
-                                             num_chunks=20,
-                                             normalized=normalized)
+                                             num_chunks=num_chunks,
+                                             normalized=normalized,
+                                             out_store=store_path,
+                                             quantiles=QUANTILES,
+                                             variable_name=variable_name)
     [lats, lons, times] = dims
+    time_slices = scenario_alignment(data_path, scenario_name, file_names, datasets)[1]
+    weights = None
+    if model_weights is not None:
+        weights = weights_for_files(file_names, model_weights)
 
     print('Calculating multimodel statistics')
+    reset_io_stats()
     [mean_vals,
      min_vals,
      max_vals,
@@ -243,23 +427,28 @@ def create_scenario_mms_datasets(variable_name,
                                    file_names,
                                    datasets,
                                    variable_name,
-                                   num_chunks)
+                                   num_chunks,
+                                   quantiles=QUANTILES,
+                                   weights=weights,
+                                   time_slices=time_slices)[0:len(STAT_NAMES)]
+    if io_wait_fraction() is not None:
+        print('Waited %.1f s for reads and computed for %.1f s (%d%% I/O wait)' %
+              (IO_STATS['io_wait'], IO_STATS['compute'], round(100*io_wait_fraction())))
 
     print('Exporting dataset')
-    ds = create_xr_dataset(lats, lons, times, mean_vals, max_vals, min_vals, std_vals)
+    copy_to_layouts(store_path, layouts=layouts)
 
-    export_dataset(ds=ds,
-                   output_path=OUTPUT_PATH,
-                   variable_name=variable_name,
-                   scenario_name=scenario_name,
-                   normalized=normalized)
+    print('Exporting annual, seasonal, and climatology means')
+    write_temporal_products(store_path, layouts=layouts)
 
     return lats, lons, times, mean_vals, max_vals, min_vals, std_vals
 
 
 #------------------MAIN WORKFLOW----------------------------------------
 def process_all_scenarios(data_path, variable_name, scenario_list,
-                          num_chunks=20, normalized=False):
+                          num_chunks=None, normalized=False,
+                          output_path=OUTPUT_PATH, weighting=MODEL_WEIGHTING,
+                          model_weights=None):
     """Processes all scenarios in the list.
 
     Calculates, exports, and creates datasets of multi-model statistics
@@ -269,9 +458,20 @@ def process_all_scenarios(data_path, variable_name, scenario_list,
         data_path: String path where the arrays will be located.
         variable_name: The string name of the model variable.
         scenario_list: String list of scenario names.
-        num_chunks: Integer number of chunks to use for saving the zarr file.
+        num_chunks: Integer number of latitude bands (None to choose the
+                    band size from the cores and memory available).
         normalized: False (default) if model data is not normalized.
+        output_path: String path where the datasets will be exported to.
+        weighting: How models are weighted: 'equal', 'table', or 'skill'
+                   (see get_model_weights).
+        model_weights: Dictionary of model to weight from get_model_weights,
+                       so that the weights of several variables are only
+                       derived once (None to get them here with weighting).
     """
+    if model_weights is None:
+        model_weights = get_model_weights(data_path, weighting,
+                                          output_path=output_path)
+        print_model_weights(model_weights)
     for scenario_name in scenario_list:
         print('-----------'+scenario_name+'-----------')
         start_time = time.time()
@@ -285,6 +485,8 @@ def process_all_scenarios(data_path, variable_name, scenario_list,
                                                   variable_name=variable_name,
                                                   scenario_name=scenario_name,
                                                   num_chunks=num_chunks,
-                                                  normalized=normalized)
+                                                  normalized=normalized,
+                                                  output_path=output_path,
+                                                  model_weights=model_weights)
         end_time = time.time()
         print(end_time - start_time)
@@ -3,20 +3,42 @@ subcomp_d_process_historical_obs.py
 
 Regrids the historical observations to be consistent with processed climate
 model output.
+
+The BEST file is read in blocks of whole months, so memory use does not
+depend on the length of the record. Each block of temperature anomalies is
+added to the climatology of its calendar months and its longitudes are
+rotated from -180 to 180 to 0 to 360 degrees in the same step. The block is
+then regridded onto the reference grid of the models (with cached weights,
+see subcomp B's get_regridder), so each observed cell lines up with a model
+cell, and written straight to the zarr file with the 'map' layout (whose
+chunks hold whole months). That file is then copied to the other layouts.
 """
-import math
-import datetime as dt
+import shutil
 from netCDF4 import Dataset
-import xarray as xr
 import pandas as pd
 import numpy as np
+import xarray as xr
+import dask.array as da
 
-from phase1_data_wrangler.analysis_parameters import DIR_PROCESSED_DATA
+from phase1_data_wrangler.analysis_parameters import DIR_PROCESSED_DATA, \
+    ZARR_MEMORY_BUDGET, PROCESSED_LAYOUTS, CHUNK_LAYOUTS, DATA_DTYPE, \
+    OBS_REGRID_METHOD, REGRID_BACKEND, DIR_REGRID_WEIGHTS
+from phase1_data_wrangler.zarr_writer import create_zarr_store, copy_to_layouts, \
+    layout_store_path
+from phase1_data_wrangler.calendar_normalization import validate_months
+from phase1_data_wrangler.temporal_products import write_temporal_products
+from phase1_data_wrangler.subcomp_b_process_climate_model_data import get_regridder
 
 
 OUT_DIR = DIR_PROCESSED_DATA + 'observation_data/'
 OBS_FILE_NAME = 'Complete_TAVG_LatLong1.nc'
 OUT_FILE_NAME = 'historical_obs.zarr'
+# Months skipped at the start of the record (100 years), to match the times
+# in CMIP6 model data
+OBS_FIRST_MONTH = 1200
+# Number of arrays of the size of a block held in memory at once: the masked
+# anomalies (values and mask), their filled copy, and the temperatures
+ARRAYS_PER_BLOCK = 4
 
 
 def convert_to_360(lons):
@@ -30,102 +52,206 @@ def convert_to_360(lons):
     Returns:
         new_lons: The numpy array of converted longitudes.
     """
-    new_lons = np.empty(len(lons))
+    lons = np.asarray(lons, dtype=np.float64)
+    return np.where(lons < 0, lons + 360, lons)
 
-    for n in range(len(lons)):
-        if lons[n] < 0:
-            new_lons[n] = 360 + lons[n]
-        else:
-            new_lons[n] = lons[n]
 
-    return new_lons
+def lon_rotation(lons):
+    """Finds the rotation that puts longitudes in ascending order.
+
+    Args:
+        lons: The numpy array of longitudes (0 to 360 degrees) of a grid that
+              was ascending from -180 to 180 degrees.
+    Returns:
+        split: Integer index of the smallest longitude, so that
+               lons[split:] followed by lons[:split] is ascending.
+    Raises:
+        ValueError: If no rotation of the longitudes is ascending.
+    """
+    split = int(np.argmin(lons))
+    rotated = np.concatenate([lons[split:], lons[:split]])
+    if np.any(np.diff(rotated) <= 0):
+        raise ValueError('The longitudes are not a rotation of an ascending grid')
+    return split
+
 
+def obs_months(decimal_years):
+    """Converts BEST times (decimal years at mid-month) to month indices
+    (12*year + month - 1), and checks that they are consecutive."""
+    months = np.floor(np.asarray(decimal_years, dtype=np.float64)*12).astype(np.int64)
+    validate_months(months)
+    return months
 
-def calculate_temps(filename):
-    """Calculates monthly average temperatures from the obsevations file.
 
-    Converts the temperature anomalies and climatologies from the
-    observations file into actual average, maximum, and minimum temperatures.
+def obs_times(months):
+    """Converts month indices to times on the 15th of each month."""
+    month_starts = (months - 12*1970).astype('datetime64[M]').astype('datetime64[D]')
+    return pd.DatetimeIndex((month_starts + np.timedelta64(14, 'D')).astype('datetime64[ns]'))
+
+
+def obs_block_size(nlat, nlon, time_chunk=CHUNK_LAYOUTS['map']['time'],
+                   memory_budget=ZARR_MEMORY_BUDGET):
+    """Returns the number of months read at once (a whole number of time chunks)."""
+    bytes_per_month = ARRAYS_PER_BLOCK*nlat*nlon*8
+    return time_chunk*max(memory_budget // (bytes_per_month*time_chunk), 1)
+
+
+def add_climatology(anomalies, climatology, calendar_months, split, out):
+    """Adds the climatology to a block of anomalies, rotating its longitudes.
+
+    Months of the same calendar month are every 12th month of the block, so
+    each calendar month's climatology is broadcast onto a strided view.
 
     Args:
-        filename: The string name of the observations file.
+        anomalies: Array (time, lat, lon) of temperature anomalies.
+        climatology: Array (12, lat, lon) of the climatology of each
+                     calendar month.
+        calendar_months: Integer array of the calendar month (0-11) of each
+                         time of the block.
+        split: Integer index of the first longitude (see lon_rotation).
+        out: Array of the shape of anomalies the temperatures are written to.
     Returns:
-        t_avg: Numpy array of the average temperature.
-        time: Numpy array of time coordinates.
-        lat: Numpy array of latitude coordinateas.
-        lon: Numpy array of longitude coordinates.
+        out
     """
-    # read in data, skipping first 100 years (1200 months) to match times
-    # in CMIP6 model data:
-    nc1 = Dataset(filename, 'r')
-    lat = nc1.variables['latitude'][:]
-    lon = convert_to_360(nc1.variables['longitude'][:])
-    time_avg = nc1.variables['time'][1200:]
-    t_avg_anom = nc1.variables['temperature'][1200:][:][:]
-    t_avg_clima = nc1.variables['climatology'][:][:][:]
+    nlon = anomalies.shape[2]
+    for k in range(min(12, len(calendar_months))):
+        month = calendar_months[k]
+        np.add(anomalies[k::12, :, split:], climatology[month, :, split:],
+               out=out[k::12, :, :nlon - split])
+        np.add(anomalies[k::12, :, :split], climatology[month, :, :split],
+               out=out[k::12, :, nlon - split:])
+    return out
 
-    # convert native time variables (in decimal year) to match model times
-    [dec_start, yr_start] = math.modf(time_avg[0])
-    mnth_start = int(dec_start*12 + 1)
-    first = dt.datetime(year=int(yr_start), month=mnth_start, day=15)
 
-    [dec_end, yr_end] = math.modf(time_avg[-1])
-    mnth_end = int(dec_end*12 + 1)
-    last = dt.datetime(year=int(yr_end), month=mnth_end, day=15)
+def read_filled(variable, index):
+    """Reads part of a netCDF variable as DATA_DTYPE, with NaN where masked."""
+    return np.ma.filled(np.ma.asarray(variable[index]).astype(DATA_DTYPE), np.nan)
 
-    time = pd.date_range(start=first, end=last, periods=len(time_avg))
 
-    ### calculate the avg temperatures from the anomalies and climatologies:
-    t_avg = np.empty(np.shape(t_avg_anom))
+def read_obs_grid(nc1, first_month=OBS_FIRST_MONTH):
+    """Reads the coordinates and climatology of an open observations file.
 
-    for i in range(12):
-        t_avg[i::12, :, :] = [(x + t_avg_clima[i, :, :])
-                              for x in t_avg_anom[i::12, :, :]]
-
-    return [t_avg, time, lat, lon]
+    Returns:
+        months: Integer array of the month index of each time.
+        lat: Numpy array of latitude coordinates.
+        lon: Numpy array of ascending longitude coordinates (0 to 360 degrees).
+        split: Integer index of the first longitude in the file (see
+               lon_rotation).
+        climatology: Array (12, lat, lon) of the climatology (DATA_DTYPE).
+    """
+    months = obs_months(nc1.variables['time'][first_month:])
+    lat = np.asarray(nc1.variables['latitude'][:])
+    file_lon = convert_to_360(nc1.variables['longitude'][:])
+    split = lon_rotation(file_lon)
+    lon = np.concatenate([file_lon[split:], file_lon[:split]])
+    climatology = read_filled(nc1.variables['climatology'], slice(None))
+    return [months, lat, lon, split, climatology]
 
 
-def create_obs_dataset(t_avg, time, lat, lon):
-    """Creates historical observations dataset.
+def obs_blocks(nc1, block_size, first_month=OBS_FIRST_MONTH):
+    """Reads the average temperatures of an open observations file in blocks.
 
-    Creates a dataset for the average temperature observations with variable
-    'mean' in degrees C and dimensions time, lat, and lon.
+    The same output array is reused for every block, so each block must be
+    used (e.g. written) before the next one is read.
 
     Args:
-        t_avg: Numpy array of the average temperature.
-        time: Numpy array of time coordinates.
-        lat: Numpy array of latitude coordinateas.
-        lon: Numpy array of longitude coordinates.
+        nc1: The open netCDF4 Dataset of the observations file.
+        block_size: Integer number of months in each block.
+        first_month: Integer number of months skipped at the start.
+    Yields:
+        (i0, i1, t_avg): The first and last (exclusive) time index of the
+        block and the array (time, lat, lon) of its average temperatures
+        (DATA_DTYPE), with ascending longitudes.
+    """
+    [months, lat, lon, split, climatology] = read_obs_grid(nc1, first_month)
+    ntime = len(months)
+    out = np.empty((min(block_size, ntime), len(lat), len(lon)), dtype=DATA_DTYPE)
+    for i0 in range(0, ntime, block_size):
+        i1 = min(i0 + block_size, ntime)
+        anomalies = read_filled(nc1.variables['temperature'],
+                                slice(first_month + i0, first_month + i1))
+        yield (i0, i1, add_climatology(anomalies, climatology, months[i0:i1] % 12,
+                                       split, out[:i1 - i0]))
+
+
+def create_obs_store(time, lat, lon, store_path):
+    """Creates the zarr file of the observations with the 'map' layout.
+
     Returns:
-        best_data: Dataset of the BEST temperature observations.
+        group: The zarr group of the new file, opened for writing.
     """
-    best_data = xr.Dataset(data_vars={'mean': (['time', 'lat', 'lon'], t_avg)},
-                           coords={'time': time, 'lat': lat, 'lon': lon})
+    shape = (len(time), len(lat), len(lon))
+    ds_template = xr.Dataset({'mean': (('time', 'lat', 'lon'),
+                                       da.empty(shape, dtype=DATA_DTYPE))},
+                             coords={'time': time, 'lat': lat, 'lon': lon})
+    return create_zarr_store(ds_template, layout_store_path(store_path, 'map'),
+                             chunks=CHUNK_LAYOUTS['map'])
 
-    # reorganize data so that the longitudes are in ascending order
-    best_data = best_data.sortby('lon')
 
-    return best_data
+def regrid_block(regridder, t_avg, lat, lon):
+    """Regrids a block of average temperatures (time, lat, lon) with regridder."""
+    block = xr.Dataset({'mean': (('time', 'lat', 'lon'), t_avg)},
+                       coords={'lat': lat, 'lon': lon})
+    return regridder(block)['mean'].values
 
 
-def save_dataset(best_data, data_path_out, out_file_name=OUT_FILE_NAME):
-    """Saves the processed temperature observation Datasets to zarr files."""
-    best_data.load()
-    best_data.chunk({'lat':10, 'lon':10, 'time':-1})
-    best_data.to_zarr(data_path_out + out_file_name)
+def stream_observations(filename, store_path, layouts=PROCESSED_LAYOUTS,
+                        memory_budget=ZARR_MEMORY_BUDGET, first_month=OBS_FIRST_MONTH,
+                        reference_grid=None, regrid_method=OBS_REGRID_METHOD,
+                        weights_dir=DIR_REGRID_WEIGHTS, backend=REGRID_BACKEND):
+    """Writes the average temperatures of the observations file to zarr files.
 
+    The temperatures are computed, regridded, and written one block of months
+    at a time to the file with the 'map' layout, which is then copied to the
+    other layouts (and deleted if 'map' is not one of them).
 
-##################### Main Workflow ##########################################
+    Args:
+        filename: The string name of the observations file.
+        store_path: String path of the zarr file with the 'series' layout.
+        layouts: List of string names of the chunk layouts to write.
+        memory_budget: Integer bytes of memory to use for each block.
+        first_month: Integer number of months skipped at the start.
+        reference_grid: The dataset containing the reference grid of the
+                        models (None to keep the grid of the observations).
+        regrid_method: The string name of the method to use for regridding.
+        weights_dir: The string path of the regridding weight cache.
+        backend: String name of the regridding backend ('xesmf' or 'sparse').
+    """
+    with Dataset(filename, 'r') as nc1:
+        [months, lat, lon, _, _] = read_obs_grid(nc1, first_month)
+        block_size = obs_block_size(len(lat), len(lon), memory_budget=memory_budget)
+        if reference_grid is None:
+            group = create_obs_store(obs_times(months), lat, lon, store_path)
+            for [i0, i1, t_avg] in obs_blocks(nc1, block_size, first_month):
+                group['mean'][i0:i1] = t_avg
+        else:
+            regridder = get_regridder(xr.Dataset(coords={'lat': lat, 'lon': lon}),
+                                      reference_grid, regrid_method, backend=backend,
+                                      weights_dir=weights_dir)
+            group = create_obs_store(obs_times(months), reference_grid['lat'].values,
+                                     reference_grid['lon'].values, store_path)
+            for [i0, i1, t_avg] in obs_blocks(nc1, block_size, first_month):
+                group['mean'][i0:i1] = regrid_block(regridder, t_avg, lat, lon)
+
+    copy_to_layouts(store_path, layouts=layouts, memory_budget=memory_budget,
+                    source_layout='map')
+    if 'map' not in layouts:
+        shutil.rmtree(layout_store_path(store_path, 'map'))
 
-def process_all_observations(data_path, data_path_out=OUT_DIR, out_file_name=OUT_FILE_NAME):
-    """Processes the historical observations file."""
-    obs_file = data_path + OBS_FILE_NAME
 
-    # read in the file and calculate average temperatures
-    [mean_temp, times, lats, longs] = calculate_temps(obs_file)
+##################### Main Workflow ##########################################
+
+def process_all_observations(data_path, data_path_out=OUT_DIR, out_file_name=OUT_FILE_NAME,
+                             reference_grid=None):
+    """Processes the historical observations file.
 
-    # generate the datasets
-    obs_ds = create_obs_dataset(mean_temp, times, lats, longs)
+    Saves the monthly observations, regridded onto reference_grid (the
+    reference grid of the models, see subcomp B's create_reference_grid), and
+    their annual, seasonal, and climatology means (see temporal_products.py).
+    """
+    obs_file = data_path + OBS_FILE_NAME
 
-    # save the datasets
-    save_dataset(obs_ds, data_path_out, out_file_name)
+    # compute and regrid the average temperatures and save them one block at a time
+    stream_observations(obs_file, data_path_out + out_file_name,
+                        reference_grid=reference_grid)
+    write_temporal_products(data_path_out + out_file_name)
@@ -0,0 +1,174 @@
+"""
+temporal_products.py
+
+Writes time means of the monthly multi-model means or observations (see
+TEMPORAL_PRODUCTS and PRODUCT_VARIABLES) to their own zarr files, so they can
+be read without aggregating months:
+    - 'annual': calendar year means
+    - 'seasonal': DJF, MAM, JJA, and SON means (DJF starts in December)
+    - 'climatology<N>': rolling means over N years, starting every January
+Only periods whose months are all within the data are written. Each period is
+labelled by the time of its first month; seasons also have a 'season'
+coordinate and climatologies a 'last_year' coordinate. Other statistics
+across models (e.g. 'std' or quantiles) are not averaged over time, since
+their time means are not the statistics of the models' time means.
+
+The monthly zarr file is read one latitude band at a time. Every period mean
+of a band is the difference of two cumulative sums over time (NaNs are
+skipped by also summing the number of valid months), so all products come
+from a single pass over the monthly data. The sums are accumulated in
+float64 and the means are saved in the dtype of the monthly data.
+"""
+import numpy as np
+import xarray as xr
+import dask.array as da
+
+from phase1_data_wrangler.analysis_parameters import TEMPORAL_PRODUCTS, \
+    PRODUCT_SUFFIXES, PRODUCT_VARIABLES, PROCESSED_LAYOUTS, CHUNK_LAYOUTS, ZARR_MEMORY_BUDGET
+from phase1_data_wrangler.calendar_normalization import month_index
+from phase1_data_wrangler.zarr_writer import create_zarr_store, copy_to_layouts
+
+SEASONS = {11: 'DJF', 2: 'MAM', 5: 'JJA', 8: 'SON'}
+# Number of float64 arrays of the size of a band held in memory at once: the
+# values, the cumulative sums and counts, and the means of a product
+ARRAYS_PER_BAND = 5
+
+
+def product_store_path(store_path, product):
+    """Returns the path of the zarr file of a temporal product of a monthly file."""
+    return store_path[:-len('.zarr')] + PRODUCT_SUFFIXES[product] + '.zarr'
+
+
+def product_periods(times, product):
+    """Finds the periods of a temporal product.
+
+    Args:
+        times: Array of consecutive monthly times (numpy datetime64 or cftime).
+        product: String name of the product (see TEMPORAL_PRODUCTS).
+    Returns:
+        starts: Integer array of the index of the first month of each period.
+        length: Integer number of months in each period.
+        coords: Dictionary of the extra coordinates along time of the
+                product (name to array).
+    """
+    months = month_index(times)
+    calendar_months = months % 12
+    if product == 'annual':
+        [starts, length] = [np.flatnonzero(calendar_months == 0), 12]
+    elif product == 'seasonal':
+        [starts, length] = [np.flatnonzero(np.isin(calendar_months, list(SEASONS))), 3]
+    elif product.startswith('climatology'):
+        [starts, length] = [np.flatnonzero(calendar_months == 0),
+                            12*int(product[len('climatology'):])]
+    else:
+        raise ValueError('Unknown temporal product: '+str(product))
+    starts = starts[starts + length <= len(times)]
+
+    coords = dict()
+    if product == 'seasonal':
+        coords['season'] = np.array([SEASONS[calendar_months[start]] for start in starts])
+    elif product != 'annual':
+        coords['last_year'] = (months[starts] + length - 1)//12
+    return [starts, length, coords]
+
+
+def cumulative_sums(values):
+    """Returns cumulative sums over the first axis of values and of valid counts.
+
+    Both start with a row of zeros, so the sum over [i, j) is sums[j] - sums[i].
+    """
+    valid = ~np.isnan(values)
+    shape = (values.shape[0] + 1,) + values.shape[1:]
+    sums = np.zeros(shape)
+    counts = np.zeros(shape, dtype=np.int32)
+    np.cumsum(np.where(valid, values, 0.), axis=0, out=sums[1:])
+    np.cumsum(valid, axis=0, out=counts[1:])
+    return [sums, counts]
+
+
+def period_means(sums, counts, starts, length):
+    """Returns the means over [start, start + length) for each start.
+
+    Means are NaN where all values of a period are NaN.
+    """
+    ends = starts + length
+    count = counts[ends] - counts[starts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, (sums[ends] - sums[starts])/count, np.nan)
+
+
+def create_product_store(ds, store_path, product, names):
+    """Creates the zarr file of a temporal product of a monthly dataset.
+
+    Returns:
+        group: The zarr group of the new file, opened for writing.
+        starts, length: The periods of the product (see product_periods).
+    """
+    [starts, length, coords] = product_periods(ds['time'].values, product)
+    shape = (len(starts), ds.sizes['lat'], ds.sizes['lon'])
+    ds_coords = {'time': ds['time'].values[starts], 'lat': ds['lat'].values,
+                 'lon': ds['lon'].values}
+    ds_template = xr.Dataset({name: (('time', 'lat', 'lon'),
+                                     da.empty(shape, dtype=ds[name].dtype),
+                                     ds[name].attrs) for name in names},
+                             coords=ds_coords)
+    for name, values in coords.items():
+        ds_template.coords[name] = ('time', values)
+    group = create_zarr_store(ds_template, store_path, chunks=CHUNK_LAYOUTS['series'])
+    for name, values in coords.items():
+        group[name][...] = values
+    return [group, starts, length]
+
+
+def product_band_size(ntime, nlon, lat_chunk=CHUNK_LAYOUTS['series']['lat'],
+                      memory_budget=ZARR_MEMORY_BUDGET):
+    """Returns the number of latitudes read at once (a whole number of lat chunks)."""
+    bytes_per_lat = ARRAYS_PER_BAND*(ntime + 1)*nlon*8
+    return lat_chunk*max(memory_budget // (bytes_per_lat*lat_chunk), 1)
+
+
+def write_temporal_products(store_path, products=TEMPORAL_PRODUCTS,
+                            layouts=PROCESSED_LAYOUTS, memory_budget=ZARR_MEMORY_BUDGET,
+                            variables=PRODUCT_VARIABLES):
+    """Writes the temporal products of a monthly zarr file.
+
+    Only the (time, lat, lon) variables of the monthly file listed in
+    variables are averaged. Products without any whole period in the data (e.g. a 30 year
+    climatology of 20 years of data) are skipped.
+
+    Args:
+        store_path: String path of the monthly zarr file with the 'series'
+                    layout.
+        products: List of string names of the products to write.
+        layouts: List of string names of the chunk layouts to write.
+        memory_budget: Integer bytes of memory to use for each band.
+        variables: List of string names of the variables to average.
+    Returns:
+        paths: Dictionary of product name to the string path of its zarr
+               file with the 'series' layout.
+    """
+    ds = xr.open_zarr(store_path)
+    names = [name for name in variables
+             if name in ds.data_vars and ds[name].dims == ('time', 'lat', 'lon')]
+    products = [product for product in products
+                if len(product_periods(ds['time'].values, product)[0]) > 0]
+    stores = {product: create_product_store(ds, product_store_path(store_path, product),
+                                            product, names)
+              for product in products}
+
+    band_size = product_band_size(ds.sizes['time'], ds.sizes['lon'],
+                                  memory_budget=memory_budget)
+    for nlat0 in range(0, ds.sizes['lat'], band_size):
+        nlatf = min(nlat0 + band_size, ds.sizes['lat'])
+        for name in names:
+            values = ds[name][:, nlat0:nlatf, :].values.astype(np.float64)
+            [sums, counts] = cumulative_sums(values)
+            del values
+            for [group, starts, length] in stores.values():
+                group[name][:, nlat0:nlatf, :] = period_means(sums, counts, starts, length)
+
+    paths = dict()
+    for product in products:
+        paths[product] = product_store_path(store_path, product)
+        copy_to_layouts(paths[product], layouts=layouts, memory_budget=memory_budget)
+    return paths
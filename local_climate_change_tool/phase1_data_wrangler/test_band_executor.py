@@ -0,0 +1,115 @@
+"""
+test_band_executor.py
+
+Tests computing the multi-model statistics of latitude bands in parallel.
+"""
+import glob
+import tempfile
+import unittest
+import warnings
+import numpy as np
+import xarray as xr
+
+from phase1_data_wrangler.band_executor import choose_band_size, band_bounds, \
+    compute_band, map_bands, BUFFER_DIR, ARRAYS_PER_BAND
+
+# Largest difference (in degrees C) allowed between statistics computed from
+# float32 data and float64 references
+FLOAT32_TOLERANCE = 1e-4
+
+
+def make_datasets(data_dir, num_models=4, dtype=np.float64):
+    """Writes random model datasets to zarr files and opens them."""
+    rng = np.random.default_rng(0)
+    datasets = []
+    for i in range(num_models):
+        values = rng.normal(size=(12, 23, 8)).astype(dtype)
+        values[rng.random(values.shape) < 0.1] = np.nan
+        store_path = data_dir + '/tas_historical_M' + str(i) + '.zarr'
+        xr.Dataset({'tas': (('time', 'lat', 'lon'), values)},
+                   coords={'time': np.arange(12), 'lat': np.arange(23.),
+                           'lon': np.arange(8.)}).to_zarr(store_path)
+        datasets.append(xr.open_zarr(store_path))
+    return datasets
+
+
+class TestBandExecutor(unittest.TestCase):
+    """Test class for band_executor.py"""
+
+    def test_choose_band_size(self):
+        """Tests that bands are whole lat chunks that fit the memory budget."""
+        bytes_per_lat = ARRAYS_PER_BAND*100*50*8
+        self.assertEqual(choose_band_size(100, 180, 50, num_workers=1,
+                                          memory_budget=2*45*bytes_per_lat,
+                                          lat_chunk=10), 40)
+        # Every worker gets a band
+        self.assertEqual(choose_band_size(100, 180, 50, num_workers=4,
+                                          memory_budget=10**12, lat_chunk=10), 40)
+        # Bands are never smaller than a chunk or larger than the grid
+        self.assertEqual(choose_band_size(100, 180, 50, num_workers=1,
+                                          memory_budget=1, lat_chunk=10), 10)
+        self.assertEqual(choose_band_size(100, 8, 50, num_workers=1,
+                                          memory_budget=10**12, lat_chunk=10), 8)
+
+    def test_band_bounds(self):
+        """Tests that the bands cover every latitude once."""
+        [nlat0_chunk, nlatf_chunk] = band_bounds(23, 10)
+        self.assertEqual(list(nlat0_chunk), [0, 10, 20])
+        self.assertEqual(list(nlatf_chunk), [10, 20, 23])
+
+    def test_map_bands(self):
+        """Tests that every backend gives the same results in band order."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            datasets = make_datasets(data_dir)
+            [nlat0_chunk, nlatf_chunk] = band_bounds(23, 5)
+            expected = compute_band(datasets, 'tas', 0, 23)
+            buffers_before = set(glob.glob(BUFFER_DIR + 'mms_band_*'))
+            for [num_workers, backend] in [(1, 'threads'), (3, 'threads'), (2, 'processes')]:
+                bands = list(map_bands(datasets, 'tas', nlat0_chunk, nlatf_chunk,
+                                       num_workers=num_workers, backend=backend))
+                self.assertEqual([band[0] for band in bands], list(nlat0_chunk))
+                for name in ['mean', 'min', 'max', 'std']:
+                    combined = np.concatenate([band[2][name] for band in bands], axis=1)
+                    self.assertTrue(np.array_equal(combined, expected[name], equal_nan=True))
+            self.assertEqual(set(glob.glob(BUFFER_DIR + 'mms_band_*')), buffers_before)
+
+    def test_map_bands_quantiles(self):
+        """Tests that quantiles computed with the bands match np.nanquantile."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            datasets = make_datasets(data_dir)
+            values = np.stack([dataset['tas'].values for dataset in datasets])
+            [nlat0_chunk, nlatf_chunk] = band_bounds(23, 10)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                expected = np.nanquantile(values, [0.1, 0.5], axis=0)
+            for [num_workers, backend] in [(1, 'threads'), (2, 'processes')]:
+                bands = list(map_bands(datasets, 'tas', nlat0_chunk, nlatf_chunk,
+                                       num_workers=num_workers, backend=backend,
+                                       quantiles=[0.1, 0.5]))
+                for i, name in enumerate(['q10', 'median']):
+                    combined = np.concatenate([band[2][name] for band in bands], axis=1)
+                    self.assertTrue(np.allclose(combined, expected[i], equal_nan=True))
+
+    def test_float32_within_tolerance(self):
+        """Tests that float32 temperatures give statistics close to float64."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            datasets = make_datasets(data_dir, num_models=8, dtype=np.float32)
+            for dataset in datasets:
+                dataset['tas'] = 15 + 20*dataset['tas']
+            values = np.stack([dataset['tas'].values.astype(np.float64)
+                               for dataset in datasets])
+            results = compute_band(datasets, 'tas', 0, 23, quantiles=[0.5])
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                expected = {'mean': np.nanmean(values, axis=0),
+                            'std': np.nanstd(values, axis=0),
+                            'max': np.nanmax(values, axis=0),
+                            'median': np.nanmedian(values, axis=0)}
+            for name, expected_values in expected.items():
+                self.assertEqual(results[name].dtype, np.float32)
+                self.assertTrue(np.allclose(results[name], expected_values, rtol=0,
+                                            atol=FLOAT32_TOLERANCE, equal_nan=True), msg=name)
+
+
+if __name__ == '__main__':
+    unittest.main()
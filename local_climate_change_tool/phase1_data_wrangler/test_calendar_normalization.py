@@ -0,0 +1,79 @@
+"""
+test_calendar_normalization.py
+
+Tests the conversion of model time axes to the shared monthly index.
+"""
+import unittest
+import numpy as np
+import cftime
+
+from phase1_data_wrangler.calendar_normalization import month_index, \
+    validate_months, months_to_times, normalize_times, SUPPORTED_CALENDARS
+from phase1_data_wrangler.benchmarks import legacy_reindex_time, monthly_times
+
+
+class TestCalendarNormalization(unittest.TestCase):
+    """
+    Tests the functions in calendar_normalization.py
+    """
+
+    def test_matches_legacy_loop(self):
+        """Every supported calendar gives the same times as the original loop"""
+        for calendar in SUPPORTED_CALENDARS:
+            times = monthly_times(3, calendar)
+            self.assertTrue(np.all(normalize_times(times.values) ==
+                                   legacy_reindex_time(times)))
+
+    def test_datetime64(self):
+        """Numpy datetime64 times are converted to the 15th of each month"""
+        times = np.array(['1850-01-31T12', '1850-02-01', '1850-03-15'],
+                         dtype='datetime64[ns]')
+        expected = [cftime.DatetimeProlepticGregorian(1850, month, 15)
+                    for month in [1, 2, 3]]
+        self.assertTrue(np.all(normalize_times(times) == np.array(expected)))
+
+    def test_end_of_month_times(self):
+        """Times on the last day of a month stay in that month"""
+        times = [cftime.Datetime360Day(2000, 2, 30, 23, 59),
+                 cftime.DatetimeNoLeap(2000, 2, 28, 12),
+                 cftime.DatetimeJulian(2000, 2, 29)]
+        for time in times:
+            self.assertEqual(month_index(np.array([time])), [12*2000 + 1])
+
+    def test_matches_date_fields(self):
+        """Month indices match the year and month of every time, whatever the
+        calendar, day, and time of day"""
+        rng = np.random.default_rng(0)
+        for calendar in SUPPORTED_CALENDARS:
+            days = np.sort(rng.uniform(0, 800*365, 500))
+            times = cftime.num2date(days, 'days since 1500-01-01', calendar=calendar)
+            expected = [12*time.year + time.month - 1 for time in times]
+            self.assertTrue(np.all(month_index(np.asarray(times)) == expected))
+            self.assertEqual(month_index(np.asarray(times).reshape(20, 25)).shape, (20, 25))
+
+    def test_month_round_trip(self):
+        """Month indices are converted back to the right year and month"""
+        months = np.arange(12*1700, 12*2300, 7)
+        times = months_to_times(months)
+        self.assertTrue(np.all(np.array([12*time.year + time.month - 1 for time in times]) ==
+                               months))
+
+    def test_gaps_and_duplicates(self):
+        """Missing, duplicate, and out of order months raise a ValueError"""
+        months = np.arange(24)
+        for bad_months in [np.delete(months, 5),
+                           np.insert(months, 5, 5),
+                           months[::-1]]:
+            with self.assertRaises(ValueError):
+                validate_months(bad_months)
+        validate_months(months)
+
+    def test_skip_validation(self):
+        """Times with gaps are still converted if validation is turned off"""
+        times = np.array([cftime.DatetimeNoLeap(1900, 1, 16),
+                          cftime.DatetimeNoLeap(1900, 6, 16)])
+        self.assertEqual(len(normalize_times(times, validate=False)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+"""
+test_manifest.py
+
+Contains the test class for manifest.py.
+"""
+import unittest
+import os
+import tempfile
+import pandas as pd
+
+from phase1_data_wrangler import manifest
+from phase1_data_wrangler.manifest import read_manifest, write_manifest, \
+    code_revision, source_revision, catalog_entry, make_entry, is_stale, staging_path, \
+    replace_store, prune_stores, file_hash
+
+TEST_KEY = 'CMIP.BCC.BCC-CSM2-MR.historical.Amon.gn'
+DATASET_INFO = pd.DataFrame({'activity_id': ['CMIP', 'CMIP', 'CMIP'],
+                             'institution_id': ['BCC', 'BCC', 'NCAR'],
+                             'source_id': ['BCC-CSM2-MR', 'BCC-CSM2-MR', 'CESM2'],
+                             'experiment_id': ['historical']*3,
+                             'member_id': ['r2i1p1f1', 'r1i1p1f1', 'r1i1p1f1'],
+                             'table_id': ['Amon']*3,
+                             'variable_id': ['tas', 'pr', 'tas'],
+                             'grid_label': ['gn']*3,
+                             'zstore': ['gs://b/r2', 'gs://b/r1', 'gs://c/r1'],
+                             'version': ['20181126', '20181126', '20190308']})
+PARAMETERS = {'reference_grid': TEST_KEY}
+
+
+def write_dummy_store(data_dir, store_name, contents):
+    """Writes a directory store_name in data_dir holding a single file."""
+    os.makedirs(data_dir + store_name, exist_ok=True)
+    with open(data_dir + store_name + '/data', 'w') as data_file:
+        data_file.write(contents)
+
+
+def read_dummy_store(data_dir, store_name):
+    """Reads the single file in the directory store_name in data_dir."""
+    with open(data_dir + store_name + '/data', 'r') as data_file:
+        return data_file.read()
+
+
+class TestManifest(unittest.TestCase):
+    """Test class for manifest.py"""
+
+    def test_catalog_entry(self):
+        """Tests that the catalog entry only includes the rows of the key."""
+        entry = catalog_entry(TEST_KEY, DATASET_INFO)
+        self.assertEqual(entry['zstore'], ['gs://b/r1', 'gs://b/r2'])
+        self.assertEqual(entry['member_id'], ['r1i1p1f1', 'r2i1p1f1'])
+        self.assertEqual(entry['version'], ['20181126', '20181126'])
+        entry = catalog_entry(TEST_KEY, DATASET_INFO, variable_id='pr')
+        self.assertEqual(entry['zstore'], ['gs://b/r1'])
+
+    def test_code_revision(self):
+        """Tests that the code revision is a stable string."""
+        self.assertEqual(code_revision(manifest), code_revision(read_manifest))
+
+    def test_source_revision_imports(self):
+        """Tests that the revision changes with the modules a file imports."""
+        with tempfile.TemporaryDirectory() as package_dir:
+            package_dir = package_dir + '/'
+            with open(package_dir + 'main.py', 'w') as source:
+                source.write('from phase1_data_wrangler.helper import f\n')
+            with open(package_dir + 'helper.py', 'w') as source:
+                source.write('from phase1_data_wrangler import other\n')
+            with open(package_dir + 'other.py', 'w') as source:
+                source.write('X = 1\n')
+            revision = source_revision(package_dir + 'main.py')
+            with open(package_dir + 'other.py', 'w') as source:
+                source.write('X = 2\n')
+            self.assertNotEqual(source_revision(package_dir + 'main.py'), revision)
+
+    def test_manifest_round_trip(self):
+        """Tests that manifest entries compare equal after being saved."""
+        entry = make_entry(catalog_entry(TEST_KEY, DATASET_INFO), PARAMETERS, 'abc')
+        with tempfile.TemporaryDirectory() as data_dir:
+            data_dir = data_dir + '/'
+            self.assertEqual(read_manifest(data_dir), {})
+            write_manifest(data_dir, {'a.zarr': entry})
+            self.assertEqual(read_manifest(data_dir), {'a.zarr': entry})
+
+    def test_file_hash(self):
+        """Tests that file hashes only depend on the contents of the file."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            filename = os.path.join(data_dir, 'weights.csv')
+            self.assertIsNone(file_hash(filename))
+            with open(filename, 'w') as weights_file:
+                weights_file.write('model,weight\nCESM2,1\n')
+            weights_hash = file_hash(filename)
+            os.utime(filename, (0, 0))
+            self.assertEqual(file_hash(filename), weights_hash)
+            with open(filename, 'w') as weights_file:
+                weights_file.write('model,weight\nCESM2,2\n')
+            self.assertNotEqual(file_hash(filename), weights_hash)
+
+    def test_is_stale(self):
+        """Tests that only missing or changed stores are stale."""
+        entry = make_entry(catalog_entry(TEST_KEY, DATASET_INFO), PARAMETERS, 'abc')
+        new_code_entry = make_entry(catalog_entry(TEST_KEY, DATASET_INFO),
+                                    PARAMETERS, 'def')
+        with tempfile.TemporaryDirectory() as data_dir:
+            data_dir = data_dir + '/'
+            self.assertTrue(is_stale(data_dir, {'a.zarr': entry}, 'a.zarr', entry))
+            write_dummy_store(data_dir, 'a.zarr', 'old')
+            self.assertFalse(is_stale(data_dir, {'a.zarr': entry}, 'a.zarr', entry))
+            self.assertTrue(is_stale(data_dir, {'a.zarr': entry}, 'a.zarr',
+                                     new_code_entry))
+            self.assertTrue(is_stale(data_dir, {}, 'a.zarr', entry))
+
+    def test_replace_store(self):
+        """Tests that a staged store replaces the old store and is recorded."""
+        entry = make_entry({'file': 'x'}, PARAMETERS, 'abc')
+        with tempfile.TemporaryDirectory() as data_dir:
+            data_dir = data_dir + '/'
+            write_dummy_store(data_dir, 'a.zarr', 'old')
+            this_manifest = read_manifest(data_dir)
+            write_dummy_store(staging_path(data_dir), 'a.zarr', 'new')
+            replace_store(data_dir, this_manifest, 'a.zarr', entry)
+
+            self.assertEqual(read_dummy_store(data_dir, 'a.zarr'), 'new')
+            self.assertEqual(read_manifest(data_dir), {'a.zarr': entry})
+
+    def test_prune_stores(self):
+        """Tests that stores that are no longer produced are deleted."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            data_dir = data_dir + '/'
+            this_manifest = dict()
+            for name in ['tas_a.zarr', 'tas_b.zarr', 'pr_a.zarr']:
+                write_dummy_store(data_dir, name, name)
+                this_manifest[name] = {}
+            pruned = prune_stores(data_dir, this_manifest, ['tas_a.zarr'], prefix='tas_')
+
+            self.assertEqual(pruned, ['tas_b.zarr'])
+            self.assertEqual(sorted(read_manifest(data_dir)), ['pr_a.zarr', 'tas_a.zarr'])
+            self.assertFalse(os.path.exists(data_dir + 'tas_b.zarr'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+test_model_weights.py
+
+Contains the test class for model_weights.py.
+"""
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from phase1_data_wrangler.model_weights import model_name, model_family, \
+    independence_weights, read_weight_table, write_weight_table, weights_for_files, \
+    pattern_error, derive_model_weights
+
+
+def make_field(values):
+    """Returns a DataArray on a small lat/lon grid."""
+    return xr.DataArray(values, dims=('lat', 'lon'),
+                        coords={'lat': np.linspace(-60, 60, values.shape[0]),
+                                'lon': np.linspace(0, 350, values.shape[1])})
+
+
+class TestModelWeights(unittest.TestCase):
+    """Test class for model_weights.py"""
+
+    def test_families(self):
+        """Tests that model families share their weight."""
+        self.assertEqual(model_name('tas_historical_CESM2-WACCM'), 'CESM2-WACCM')
+        self.assertEqual(model_family('CESM2-WACCM'), 'CESM2')
+        self.assertEqual(model_family('NorESM2-LM', {'NorESM2-LM': 'CESM2'}), 'CESM2')
+        weights = independence_weights(['CESM2', 'CESM2-WACCM', 'CAMS-CSM1-0'])
+        self.assertEqual(weights, {'CESM2': 0.5, 'CESM2-WACCM': 0.5, 'CAMS-CSM1-0': 1.})
+
+    def test_weight_table(self):
+        """Tests reading and writing weight tables."""
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = out_dir + '/weights.csv'
+            write_weight_table({'CESM2': 0.5, 'MIROC6': 1.5}, path)
+            weights = read_weight_table(path)
+            self.assertEqual(weights, {'CESM2': 0.5, 'MIROC6': 1.5})
+            pd.DataFrame({'model': ['CESM2'], 'weight': [-1.]}).to_csv(path, index=False)
+            with self.assertRaises(ValueError):
+                read_weight_table(path)
+        self.assertEqual(weights_for_files(['tas_ssp585_MIROC6'], weights), [1.5])
+        with self.assertRaises(ValueError):
+            weights_for_files(['tas_ssp585_CanESM5'], weights)
+
+    def test_derive_model_weights(self):
+        """Tests that skillful and independent models get more weight."""
+        rng = np.random.default_rng(0)
+        obs = make_field(rng.normal(size=(13, 36)))
+        # An offset (e.g. K instead of C) does not count as an error
+        self.assertAlmostEqual(pattern_error(obs + 273.15, obs), 0.)
+        climatologies = {'MIROC6': obs + 273.15,
+                         'CESM2': obs + rng.normal(size=obs.shape),
+                         'CESM2-WACCM': obs + rng.normal(size=obs.shape),
+                         'CanESM5': obs + 2*rng.normal(size=obs.shape)}
+        weights = derive_model_weights(climatologies, obs)
+        self.assertAlmostEqual(np.mean(list(weights.values())), 1.)
+        self.assertEqual(max(weights, key=weights.get), 'MIROC6')
+        self.assertLess(weights['CanESM5'], weights['CESM2'] + weights['CESM2-WACCM'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+test_prefetch_reader.py
+
+Tests the reader that reads model data ahead of time.
+"""
+import time
+import threading
+import unittest
+
+from phase1_data_wrangler.prefetch_reader import prefetch, IO_STATS, \
+    reset_io_stats, merge_io_stats, io_wait_fraction
+
+
+def slow_read(value, delay=0.02):
+    """Returns value after a delay, like a read from a slow disk."""
+    time.sleep(delay)
+    return value
+
+
+class TestPrefetchReader(unittest.TestCase):
+    """Test class for prefetch_reader.py"""
+
+    def setUp(self):
+        reset_io_stats()
+
+    def tearDown(self):
+        reset_io_stats()
+
+    def test_results_in_order(self):
+        """Tests that results come back in order for any depth."""
+        for depth in [0, 1, 3, 20]:
+            read_args = [(i, 0.01*(i % 3)) for i in range(10)]
+            self.assertEqual(list(prefetch(slow_read, read_args, depth)), list(range(10)))
+
+    def test_depth_limits_reads_ahead(self):
+        """Tests that no more than depth reads run ahead of the caller."""
+        running = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def counting_read(value):
+            with lock:
+                running['now'] = running['now'] + 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(0.01)
+            with lock:
+                running['now'] = running['now'] - 1
+            return value
+
+        list(prefetch(counting_read, [(i,) for i in range(12)], depth=2))
+        self.assertEqual(running['max'], 2)
+
+    def test_reads_overlap_compute(self):
+        """Tests that reading ahead hides reads behind computing."""
+        read_args = [(i, 0.05) for i in range(6)]
+        for value in prefetch(slow_read, read_args, depth=0):
+            time.sleep(0.05)
+        serial_wait = IO_STATS['io_wait']
+        reset_io_stats()
+        for value in prefetch(slow_read, read_args, depth=2):
+            time.sleep(0.05)
+        self.assertEqual(IO_STATS['reads'], 6)
+        self.assertLess(IO_STATS['io_wait'], serial_wait/2)
+        self.assertGreater(IO_STATS['compute'], 0.25)
+
+    def test_merge_io_stats(self):
+        """Tests that I/O statistics from workers are added to the totals."""
+        merge_io_stats({'reads': 4, 'io_wait': 1.0, 'compute': 3.0})
+        self.assertEqual(IO_STATS['reads'], 4)
+        self.assertAlmostEqual(io_wait_fraction(), 0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+test_quantiles.py
+
+Contains the test class for quantiles.py.
+"""
+import unittest
+import warnings
+import numpy as np
+
+from phase1_data_wrangler.quantiles import quantile_name, exact_quantiles, \
+    ExactQuantiles, QuantileSketch, make_quantile_accumulator
+
+QUANTILES = [0., 0.05, 0.1, 0.5, 0.9, 0.95, 1.]
+
+
+def nanquantiles(values, quantiles):
+    """Returns np.nanquantile over the first axis without all-NaN warnings."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanquantile(values, quantiles, axis=0)
+
+
+class TestQuantiles(unittest.TestCase):
+    """Test class for quantiles.py"""
+
+    def test_quantile_name(self):
+        """Tests the names of the quantile variables."""
+        self.assertEqual([quantile_name(q) for q in [0.05, 0.1, 0.5, 0.95, 0.025]],
+                         ['q05', 'q10', 'median', 'q95', 'q2p5'])
+
+    def test_exact_quantiles(self):
+        """Tests that the quantiles match numpy with and without NaNs."""
+        rng = np.random.default_rng(0)
+        values = rng.normal(size=(9, 6, 7))
+        results = exact_quantiles(values, QUANTILES)
+        expected = np.quantile(values, QUANTILES, axis=0)
+        for i, quantile in enumerate(QUANTILES):
+            self.assertTrue(np.allclose(results[quantile_name(quantile)], expected[i]))
+
+        values[rng.random(values.shape) < 0.3] = np.nan
+        values[:, 0, 0] = np.nan
+        results = exact_quantiles(values, QUANTILES)
+        expected = nanquantiles(values, QUANTILES)
+        for i, quantile in enumerate(QUANTILES):
+            self.assertTrue(np.allclose(results[quantile_name(quantile)], expected[i],
+                                        equal_nan=True))
+
+    def test_accumulators(self):
+        """Tests that both accumulators are exact until the sketch compacts."""
+        rng = np.random.default_rng(1)
+        values = rng.normal(size=(8, 5, 4))
+        values[rng.random(values.shape) < 0.2] = np.nan
+        expected = nanquantiles(values, QUANTILES)
+        for accumulator in [ExactQuantiles((5, 4), 8, QUANTILES),
+                            QuantileSketch((5, 4), 16, QUANTILES)]:
+            for model_values in values:
+                accumulator.add(model_values)
+            results = accumulator.results()
+            for i, quantile in enumerate(QUANTILES):
+                self.assertTrue(np.allclose(results[quantile_name(quantile)], expected[i],
+                                            equal_nan=True))
+
+    def test_sketch(self):
+        """Tests that the sketch keeps few values and stays close to exact."""
+        rng = np.random.default_rng(2)
+        values = rng.uniform(size=(512, 3, 3))
+        sketch = make_quantile_accumulator((3, 3), 512, [0.1, 0.5, 0.9], sketch_size=32)
+        self.assertIsInstance(sketch, QuantileSketch)
+        for model_values in values:
+            sketch.add(model_values)
+        self.assertLessEqual(sum(sketch.fill), 32*len(sketch.levels))
+        results = sketch.results()
+        for quantile in [0.1, 0.5, 0.9]:
+            error = np.abs(results[quantile_name(quantile)] -
+                           np.quantile(values, quantile, axis=0))
+            self.assertLess(error.max(), 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
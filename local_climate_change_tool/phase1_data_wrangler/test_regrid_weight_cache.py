@@ -0,0 +1,104 @@
+"""
+test_regrid_weight_cache.py
+
+Contains the test class for regrid_weight_cache.py.
+"""
+import unittest
+import os
+import time
+import tempfile
+import xarray as xr
+import numpy as np
+
+from phase1_data_wrangler.regrid_weight_cache import grid_hash, \
+    weight_file_path, lookup_weights, cache_hit_rate, reset_cache_stats, \
+    evict_weight_files, temporary_weight_path, is_temporary_weight_file
+
+# Define a source grid and two reference grids
+SOURCE_GRID = xr.Dataset({'lat': np.linspace(-89., 89., 90),
+                          'lon': np.linspace(0., 358., 180)})
+REF_GRID1 = xr.Dataset({'lat': np.linspace(-89.5, 89.5, 180),
+                        'lon': np.linspace(0., 359., 360)})
+REF_GRID2 = xr.Dataset({'lat': np.linspace(-88., 88., 45),
+                        'lon': np.linspace(0., 356., 90)})
+METHOD = 'nearest_s2d'
+
+
+def write_dummy_file(filename, num_bytes, age_days=0):
+    """Writes a file of num_bytes bytes that was last modified age_days ago."""
+    with open(filename, 'wb') as dummy_file:
+        dummy_file.write(b'0'*num_bytes)
+    mtime = time.time() - age_days*24*60*60
+    os.utime(filename, (mtime, mtime))
+
+
+class TestRegridWeightCache(unittest.TestCase):
+    """Test class for regrid_weight_cache.py"""
+
+    def test_grid_hash(self):
+        """Tests that the hash only depends on the grids and the method."""
+        key = grid_hash(SOURCE_GRID, REF_GRID1, METHOD)
+        same_key = grid_hash(SOURCE_GRID.copy(deep=True), REF_GRID1, METHOD)
+        other_ref_key = grid_hash(SOURCE_GRID, REF_GRID2, METHOD)
+        other_method_key = grid_hash(SOURCE_GRID, REF_GRID1, 'bilinear')
+
+        self.assertEqual(key, same_key)
+        self.assertNotEqual(key, other_ref_key)
+        self.assertNotEqual(key, other_method_key)
+
+    def test_hit_rate(self):
+        """Tests that lookups are counted as hits and misses."""
+        reset_cache_stats()
+        self.assertTrue(cache_hit_rate() is None)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            weight_file = weight_file_path('abc', METHOD, cache_dir=cache_dir+'/')
+            self.assertFalse(lookup_weights(weight_file))
+            write_dummy_file(weight_file, 10)
+            self.assertTrue(lookup_weights(weight_file))
+            self.assertTrue(lookup_weights(weight_file))
+        self.assertAlmostEqual(cache_hit_rate(), 2/3)
+        reset_cache_stats()
+
+    def test_evict_by_age(self):
+        """Tests that only files older than the maximum age are evicted."""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_dir = cache_dir + '/'
+            write_dummy_file(cache_dir + 'old.nc', 10, age_days=30)
+            write_dummy_file(cache_dir + 'new.nc', 10, age_days=1)
+            num_evicted = evict_weight_files(cache_dir, max_bytes=1000,
+                                             max_age_days=10)
+            self.assertEqual(num_evicted, 1)
+            self.assertFalse(os.path.isfile(cache_dir + 'old.nc'))
+            self.assertTrue(os.path.isfile(cache_dir + 'new.nc'))
+
+    def test_evict_by_size(self):
+        """Tests that the least recently used files are evicted first."""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_dir = cache_dir + '/'
+            for i in range(4):
+                write_dummy_file(cache_dir + str(i) + '.nc', 100, age_days=4-i)
+            num_evicted = evict_weight_files(cache_dir, max_bytes=250,
+                                             max_age_days=10)
+            remaining = sorted(os.listdir(cache_dir))
+            self.assertEqual(num_evicted, 2)
+            self.assertEqual(remaining, ['2.nc', '3.nc'])
+
+    def test_evict_temporary_files(self):
+        """Tests that weight files still being generated are not evicted, but
+        ones left behind by killed runs are."""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_dir = cache_dir + '/'
+            tmp_file = temporary_weight_path(cache_dir + 'bilinear_abc.nc')
+            write_dummy_file(tmp_file, 100)
+            orphan_file = cache_dir + 'bilinear_def.123.tmp.nc'
+            write_dummy_file(orphan_file, 100, age_days=1)
+            write_dummy_file(cache_dir + 'old.nc', 100, age_days=30)
+            num_evicted = evict_weight_files(cache_dir, max_bytes=0, max_age_days=10,
+                                             tmp_max_age_hours=12)
+            self.assertEqual(num_evicted, 2)
+            self.assertTrue(is_temporary_weight_file(tmp_file))
+            self.assertTrue(is_temporary_weight_file(orphan_file))
+            self.assertEqual(os.listdir(cache_dir), [os.path.basename(tmp_file)])
+
+if __name__ == '__main__':
+    unittest.main()
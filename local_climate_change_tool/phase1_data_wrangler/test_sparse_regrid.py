@@ -0,0 +1,163 @@
+"""
+test_sparse_regrid.py
+
+Tests the scipy.sparse regridding backend.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import dask.array as da
+import xarray as xr
+
+from phase1_data_wrangler import sparse_regrid
+from phase1_data_wrangler.subcomp_b_process_climate_model_data import get_regridder, xe
+from phase1_data_wrangler.regrid_weight_cache import CACHE_STATS, reset_cache_stats
+
+LATS_IN = np.linspace(-89, 89, 90)
+LONS_IN = np.arange(0, 360, 2.)
+LATS_OUT = np.linspace(-88.5, 88.5, 60)
+LONS_OUT = np.arange(0, 360, 3.) + 1
+
+
+def smooth_field(lats, lons):
+    """Returns a smooth test field on a rectilinear grid."""
+    [lon_2d, lat_2d] = np.meshgrid(lons, lats)
+    return (np.cos(np.deg2rad(lat_2d))*np.sin(np.deg2rad(lon_2d)) +
+            lat_2d/90 + np.cos(np.deg2rad(lat_2d))**2)
+
+
+def area_mean(field, lats):
+    """Returns the cos(lat) weighted mean of a field."""
+    weights = np.cos(np.deg2rad(lats))[:, np.newaxis]*np.ones(field.shape)
+    return (field*weights).sum()/weights.sum()
+
+
+def make_dataset(field, lats, lons, chunks=None):
+    """Returns a dataset with 4 timesteps of a field."""
+    data = np.stack([field]*4)
+    if chunks is not None:
+        data = da.from_array(data, chunks=chunks)
+    return xr.Dataset({'tas': (('time', 'lat', 'lon'), data)},
+                      coords={'time': np.arange(4), 'lat': lats, 'lon': lons})
+
+
+class TestSparseRegrid(unittest.TestCase):
+    """
+    Tests the functions in sparse_regrid.py
+    """
+
+    def test_weights_are_normalized(self):
+        """Every destination cell's weights sum to one for each method"""
+        for method in sparse_regrid.SUPPORTED_METHODS:
+            weights = sparse_regrid.create_weights(LATS_IN, LONS_IN, LATS_OUT,
+                                                   LONS_OUT, method)
+            self.assertTrue(np.allclose(weights.sum(axis=1), 1))
+
+    def test_same_grid_is_identity(self):
+        """Regridding to the same grid leaves the data unchanged"""
+        field = smooth_field(LATS_IN, LONS_IN)
+        for method in sparse_regrid.SUPPORTED_METHODS:
+            weights = sparse_regrid.create_weights(LATS_IN, LONS_IN, LATS_IN,
+                                                   LONS_IN, method)
+            regridded = sparse_regrid.apply_weights(weights, field[np.newaxis],
+                                                    field.shape)
+            self.assertTrue(np.allclose(regridded[0], field))
+
+    def test_bilinear_accuracy(self):
+        """Bilinear regridding of a smooth field is close to the exact values"""
+        weights = sparse_regrid.create_weights(LATS_IN, LONS_IN, LATS_OUT,
+                                               LONS_OUT, 'bilinear')
+        regridded = sparse_regrid.apply_weights(weights,
+                                                smooth_field(LATS_IN, LONS_IN)[np.newaxis],
+                                                (len(LATS_OUT), len(LONS_OUT)))
+        error = np.abs(regridded[0] - smooth_field(LATS_OUT, LONS_OUT)).max()
+        self.assertLess(error, 1e-3)
+
+    def test_decreasing_latitudes(self):
+        """Source grids with decreasing latitudes give the same result"""
+        field = smooth_field(LATS_IN, LONS_IN)
+        shape_out = (len(LATS_OUT), len(LONS_OUT))
+        increasing = sparse_regrid.apply_weights(
+            sparse_regrid.create_weights(LATS_IN, LONS_IN, LATS_OUT, LONS_OUT, 'bilinear'),
+            field[np.newaxis], shape_out)
+        decreasing = sparse_regrid.apply_weights(
+            sparse_regrid.create_weights(LATS_IN[::-1], LONS_IN, LATS_OUT, LONS_OUT,
+                                         'bilinear'),
+            field[::-1][np.newaxis], shape_out)
+        self.assertTrue(np.allclose(increasing, decreasing))
+
+    def test_conservative_preserves_area_mean(self):
+        """Conservative regridding keeps the area weighted global mean"""
+        field = smooth_field(LATS_IN, LONS_IN)
+        weights = sparse_regrid.create_weights(LATS_IN, LONS_IN, LATS_OUT,
+                                               LONS_OUT, 'conservative')
+        regridded = sparse_regrid.apply_weights(weights, field[np.newaxis],
+                                                (len(LATS_OUT), len(LONS_OUT)))
+        self.assertAlmostEqual(area_mean(field, LATS_IN),
+                               area_mean(regridded[0], LATS_OUT), places=3)
+
+    def test_dask_matches_numpy(self):
+        """Regridding dask arrays gives the same result as numpy arrays"""
+        field = smooth_field(LATS_IN, LONS_IN)
+        grid = xr.Dataset({'lat': LATS_OUT, 'lon': LONS_OUT})
+        regridder = sparse_regrid.build_regridder(make_dataset(field, LATS_IN, LONS_IN),
+                                                  grid, 'bilinear')
+        in_memory = regridder(make_dataset(field, LATS_IN, LONS_IN))
+        lazy = regridder(make_dataset(field, LATS_IN, LONS_IN, chunks=(3, 45, 90)))
+        self.assertIsInstance(lazy['tas'].data, da.Array)
+        self.assertTrue(np.allclose(in_memory['tas'].values, lazy['tas'].values))
+        self.assertTrue(np.array_equal(lazy['lat'].values, LATS_OUT))
+
+    def test_curvilinear_nearest(self):
+        """Nearest neighbor regridding works from a curvilinear grid"""
+        [lon_2d, lat_2d] = np.meshgrid(LONS_IN - 180, LATS_IN)
+        ds_in = xr.Dataset({'tas': (('time', 'y', 'x'),
+                                    np.stack([smooth_field(LATS_IN, LONS_IN)]*2))},
+                           coords={'lat': (('y', 'x'), lat_2d),
+                                   'lon': (('y', 'x'), lon_2d)})
+        grid = xr.Dataset({'lat': LATS_OUT, 'lon': LONS_OUT})
+        regridded = sparse_regrid.build_regridder(ds_in, grid, 'nearest_s2d')(ds_in)
+        self.assertEqual(regridded['tas'].shape, (2, len(LATS_OUT), len(LONS_OUT)))
+
+    def test_unsupported_method(self):
+        """Unsupported methods raise a ValueError"""
+        with self.assertRaises(ValueError):
+            sparse_regrid.create_weights(LATS_IN, LONS_IN, LATS_OUT, LONS_OUT, 'patch')
+
+    def test_weights_are_cached(self):
+        """Weights are saved to the cache and reused by get_regridder"""
+        cache_dir = tempfile.mkdtemp() + '/'
+        try:
+            reset_cache_stats()
+            ds_in = make_dataset(smooth_field(LATS_IN, LONS_IN), LATS_IN, LONS_IN)
+            grid = xr.Dataset({'lat': LATS_OUT, 'lon': LONS_OUT})
+            first = get_regridder(ds_in, grid, 'bilinear', backend='sparse',
+                                  weights_dir=cache_dir)
+            second = get_regridder(ds_in, grid, 'bilinear', backend='sparse',
+                                   weights_dir=cache_dir)
+            self.assertEqual(CACHE_STATS, {'hits': 1, 'misses': 1})
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertTrue(np.allclose(first(ds_in)['tas'].values,
+                                        second(ds_in)['tas'].values))
+        finally:
+            reset_cache_stats()
+            shutil.rmtree(cache_dir)
+
+    @unittest.skipIf(xe is None, 'xESMF is not installed')
+    def test_matches_xesmf(self):
+        """The sparse backend agrees with xESMF away from the poles"""
+        ds_in = make_dataset(smooth_field(LATS_IN, LONS_IN), LATS_IN, LONS_IN)
+        grid = xr.Dataset({'lat': LATS_OUT, 'lon': LONS_OUT})
+        for method in ['nearest_s2d', 'bilinear']:
+            sparse_result = sparse_regrid.build_regridder(ds_in, grid, method)(ds_in)
+            xesmf_result = xe.Regridder(ds_in, grid, method, periodic=True)(ds_in)
+            interior = slice(5, -5)
+            self.assertTrue(np.allclose(sparse_result['tas'].values[:, interior],
+                                        xesmf_result['tas'].values[:, interior],
+                                        atol=1e-2))
+
+
+if __name__ == '__main__':
+    unittest.main()
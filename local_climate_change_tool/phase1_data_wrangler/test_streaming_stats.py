@@ -0,0 +1,192 @@
+"""
+test_streaming_stats.py
+
+Tests the streaming statistics over ensemble members.
+"""
+import unittest
+import warnings
+import numpy as np
+import xarray as xr
+
+from phase1_data_wrangler.streaming_stats import reduce_ensemble, reduce_dataarray, \
+    StreamingStats
+
+
+def make_ensemble(num_members=6, chunks=None):
+    """Returns a dataset of random values with some NaNs and an all-NaN point."""
+    rng = np.random.default_rng(0)
+    values = rng.normal(280, 5, size=(num_members, 4, 3, 5)).astype(np.float32)
+    values[rng.random(values.shape) < 0.2] = np.nan
+    values[:, 0, 0, 0] = np.nan
+    ds = xr.Dataset({'tas': (('member_id', 'time', 'lat', 'lon'), values,
+                             {'units': 'K'}),
+                     'time_bnds': (('time', 'bnds'), np.zeros((4, 2)))},
+                    coords={'member_id': ['r'+str(i)+'i1p1f1' for i in range(num_members)],
+                            'time': np.arange(4), 'lat': np.arange(3), 'lon': np.arange(5)})
+    if chunks is not None:
+        ds = ds.chunk(chunks)
+    return ds
+
+
+class TestStreamingStats(unittest.TestCase):
+    """
+    Tests the functions in streaming_stats.py
+    """
+
+    def test_matches_mean(self):
+        """The ensemble mean matches ds.mean, including all-NaN points"""
+        ds = make_ensemble()
+        reduced = reduce_ensemble(ds)
+        expected = ds.mean(dim='member_id')
+        self.assertTrue(np.allclose(reduced['tas'].values, expected['tas'].values,
+                                    equal_nan=True, rtol=1e-6))
+        self.assertTrue(np.isnan(reduced['tas'].values[0, 0, 0]))
+        self.assertEqual(reduced['tas'].dtype, np.float32)
+        self.assertNotIn('member_id', reduced.dims)
+        self.assertIn('time_bnds', reduced)
+
+    def test_spread_and_count(self):
+        """The spread and count match np.nanstd and the number of non-NaN members"""
+        ds = make_ensemble()
+        reduced = reduce_ensemble(ds, spread=True, count=True)
+        values = ds['tas'].values.astype(np.float64)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            expected_std = np.nanstd(values, axis=0)
+        self.assertTrue(np.allclose(reduced['tas_spread'].values, expected_std,
+                                    equal_nan=True, rtol=1e-5))
+        self.assertTrue(np.array_equal(reduced['tas_count'].values,
+                                       (~np.isnan(values)).sum(axis=0)))
+
+    def test_dask_input(self):
+        """Lazy datasets give the same result as in-memory datasets"""
+        reduced = reduce_ensemble(make_ensemble())
+        reduced_lazy = reduce_ensemble(make_ensemble(chunks={'member_id': 1, 'time': 2}))
+        self.assertTrue(np.array_equal(reduced['tas'].values, reduced_lazy['tas'].values,
+                                       equal_nan=True))
+
+    def test_stays_lazy(self):
+        """Lazy DataArrays are reduced lazily in blocks of times"""
+        ds = make_ensemble().transpose('time', 'lat', 'member_id', 'lon', 'bnds')
+        lazy = ds.chunk({'member_id': 1, 'time': 1})
+        # Room for all (float32) members of two times
+        block_bytes = 2*6*3*5*4
+        reduced = reduce_dataarray(lazy['tas'], spread=True, count=True,
+                                   block_bytes=block_bytes)
+        expected = reduce_dataarray(ds['tas'], spread=True, count=True)
+        for name in ['mean', 'spread', 'count']:
+            self.assertIsNotNone(reduced[name].chunks)
+            self.assertEqual(reduced[name].dims, ('time', 'lat', 'lon'))
+            self.assertTrue(np.allclose(reduced[name].values, expected[name].values,
+                                        equal_nan=True))
+        self.assertEqual(reduced['mean'].chunks[0], (2, 2))
+        self.assertIsNone(reduce_dataarray(lazy['tas'])['spread'])
+
+    def test_single_member(self):
+        """A single member is returned unchanged with zero spread"""
+        ds = make_ensemble(num_members=1)
+        reduced = reduce_ensemble(ds, spread=True)
+        self.assertTrue(np.array_equal(reduced['tas'].values, ds['tas'].values[0],
+                                       equal_nan=True))
+        self.assertTrue(np.all(reduced['tas_spread'].values[~np.isnan(ds['tas'].values[0])]
+                               == 0))
+
+
+class TestStreamingStatsClass(unittest.TestCase):
+    """
+    Tests the StreamingStats class
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.values = rng.normal(0, 3, size=(7, 5, 4))
+        self.values[rng.random(self.values.shape) < 0.25] = np.nan
+        self.values[:, 0, 0] = np.nan
+
+    def expected(self, values):
+        """Returns the statistics computed with numpy's nan functions."""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return {'mean': np.nanmean(values, axis=0),
+                    'min': np.nanmin(values, axis=0),
+                    'max': np.nanmax(values, axis=0),
+                    'std': np.nanstd(values, axis=0),
+                    'count': (~np.isnan(values)).sum(axis=0)}
+
+    def check_results(self, results, expected):
+        """Checks that all statistics match."""
+        for name in ['mean', 'min', 'max', 'std', 'count']:
+            self.assertTrue(np.allclose(results[name], expected[name], equal_nan=True),
+                            msg=name)
+
+    def test_matches_numpy(self):
+        """Statistics match numpy's nan functions"""
+        stats = StreamingStats(self.values.shape[1:])
+        for values in self.values:
+            stats.add(values)
+        self.check_results(stats.results(), self.expected(self.values))
+
+    def test_add_to_existing_result(self):
+        """Adding more slices after taking results updates the statistics"""
+        stats = StreamingStats(self.values.shape[1:])
+        for values in self.values[:4]:
+            stats.add(values)
+        stats.results()
+        for values in self.values[4:]:
+            stats.add(values)
+        self.check_results(stats.results(), self.expected(self.values))
+
+    def test_merge(self):
+        """Merging the statistics of two groups gives the statistics of both"""
+        first = StreamingStats(self.values.shape[1:])
+        second = StreamingStats(self.values.shape[1:])
+        for values in self.values[:3]:
+            first.add(values)
+        for values in self.values[3:]:
+            second.add(values)
+        first.merge(second)
+        self.check_results(first.results(), self.expected(self.values))
+
+    def test_weighted(self):
+        """Weighted means and stds match numpy, also after merging"""
+        weights = np.linspace(0.5, 3, len(self.values))
+        expanded = np.where(np.isnan(self.values), 0,
+                            weights.reshape((-1,) + (1,)*(self.values.ndim - 1)))
+        with np.errstate(invalid='ignore'):
+            mean = np.nansum(expanded*self.values, axis=0)/expanded.sum(axis=0)
+            std = np.sqrt(np.nansum(expanded*(self.values - mean)**2, axis=0) /
+                          expanded.sum(axis=0))
+        first = StreamingStats(self.values.shape[1:], weighted=True)
+        second = StreamingStats(self.values.shape[1:], weighted=True)
+        for values, weight in zip(self.values[:3], weights[:3]):
+            first.add(values, weight)
+        for values, weight in zip(self.values[3:], weights[3:]):
+            second.add(values, weight)
+        first.merge(second)
+        results = first.results()
+        self.assertTrue(np.allclose(results['mean'], mean, equal_nan=True))
+        self.assertTrue(np.allclose(results['std'], std, equal_nan=True))
+
+    def test_results_dtype(self):
+        """Results can be returned as float32"""
+        stats = StreamingStats((2,))
+        stats.add(np.array([1, np.nan]))
+        results = stats.results(np.float32)
+        self.assertEqual(results['mean'].dtype, np.float32)
+        self.assertTrue(np.isnan(results['max'][1]))
+
+    def test_mean_only(self):
+        """Only the mean and count are kept without spread and extremes"""
+        stats = StreamingStats(self.values.shape[1:], spread=False, extremes=False)
+        for values in self.values:
+            stats.add(values)
+        self.assertIsNone(stats.m2)
+        self.assertIsNone(stats.min)
+        results = stats.results()
+        self.assertEqual(sorted(results), ['count', 'mean'])
+        self.assertTrue(np.allclose(results['mean'], self.expected(self.values)['mean'],
+                                    equal_nan=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
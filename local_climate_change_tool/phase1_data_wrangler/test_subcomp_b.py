@@ -4,17 +4,20 @@ test_subcomp_b.py
 Contains the test class for subcomp_b_process_climate_model_data.py.
 """
 import datetime
+import time
 import cftime
 import unittest
 import os
 import glob
+import tempfile
 import pandas as pd
 import xarray as xr
 import numpy as np
 
 from phase1_data_wrangler.subcomp_b_process_climate_model_data import \
     reindex_time, generate_new_filename, create_reference_grid, \
-    regrid_model, process_dataset, process_all_files_in_dictionary
+    regrid_model, process_dataset, process_all_files_in_dictionary, \
+    convert_units, dataset_variables, limit_task_memory, psutil
 from phase1_data_wrangler.analysis_parameters import DIR_TESTING_DATA
 import download_file_from_google_drive
 
@@ -150,6 +153,25 @@ class TestSubcompB(unittest.TestCase):
         fname = generate_new_filename(test_key)
         self.assertTrue(((fname is not None) and (type(fname) == str)))
 
+    def test_generate_new_filename_variables(self, test_key=TEST_KEY1):
+        """Tests that each variable of a dataset gets its own filename."""
+        self.assertEqual(generate_new_filename(test_key, 'pr'), 'pr_ssp585_UKESM1-0-LL')
+        self.assertEqual(generate_new_filename(test_key), VARNAME+'_ssp585_UKESM1-0-LL')
+
+    def test_convert_units(self):
+        """Tests the unit conversions of temperature and precipitation."""
+        kelvin = xr.DataArray(np.array([273.15, 300.], dtype=np.float32),
+                              attrs={'units': 'K'})
+        celsius = convert_units(kelvin, 'tas')
+        self.assertTrue(np.allclose(celsius.values, [0., 26.85]))
+        self.assertEqual(celsius.dtype, np.float32)
+        self.assertEqual(celsius.attrs['units'], 'degC')
+        flux = xr.DataArray(np.array([1e-5, 0.]), attrs={'units': 'kg m-2 s-1'})
+        self.assertTrue(np.allclose(convert_units(flux, 'pr').values, [0.864, 0.]))
+        self.assertIs(convert_units(flux, 'huss'), flux)
+        self.assertEqual(dataset_variables(xr.Dataset({'pr': flux, 'tas': kelvin}),
+                                           ['tas', 'tasmin', 'pr']), ['tas', 'pr'])
+
     def test_create_reference_grid(self, dset_dict=DSET_DICT, test_key=TEST_KEY2):
         """Tests that the reference grid function creates a sensible reference grid."""
         ds_original = dset_dict[test_key]
@@ -284,6 +306,41 @@ class TestSubcompB(unittest.TestCase):
         self.assertTrue(years_pass)
         self.assertTrue(coord_types_pass)
 
+    def test_failures_are_isolated(self, dset_dict=DSET_DICT, key_for_grid=TEST_KEY2):
+        """
+        Tests that a dataset that fails to process is reported without
+        stopping the other datasets from being processed in parallel.
+        """
+        final_grid = create_reference_grid(dset_dict=dset_dict,
+                                           reference_key=key_for_grid)
+        broken_dict = {TEST_KEY1: dset_dict[TEST_KEY1],
+                       'CMIP.BAD.BROKEN-MODEL.historical.Amon.gn': xr.Dataset()}
+
+        with tempfile.TemporaryDirectory() as data_path_out:
+            failures = process_all_files_in_dictionary(broken_dict, (), final_grid,
+                                                       data_path_out + '/',
+                                                       num_workers=2,
+                                                       variable_ids=[VARNAME])
+            saved_files = os.listdir(data_path_out)
+
+        self.assertEqual(list(failures.keys()), [VARNAME+'_historical_BROKEN-MODEL'])
+        self.assertEqual(saved_files, [generate_new_filename(TEST_KEY1)+'.zarr'])
+
+    @unittest.skipIf(psutil is None, 'psutil is not installed')
+    def test_limit_task_memory(self):
+        """
+        Tests that a task over the memory limit is stopped with a MemoryError,
+        and that the limit ends with the task.
+        """
+        start = time.time()
+        with self.assertRaises(MemoryError):
+            with limit_task_memory(1, interval=0.01):
+                time.sleep(5)
+        self.assertLess(time.time() - start, 5)
+        with limit_task_memory(2**50, interval=0.01):
+            time.sleep(0.1)
+        time.sleep(0.1)
+
 
 if __name__ == '__main__':
     unittest.main()
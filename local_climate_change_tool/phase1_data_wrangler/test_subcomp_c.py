@@ -5,6 +5,7 @@ Contains the test class for subcomp_c_multi_model_stats.py.
 """
 import time
 import glob
+import tempfile
 import unittest
 import cftime
 import pandas as pd
@@ -180,6 +181,27 @@ class TestSubcompC(unittest.TestCase):
 
         self.assertTrue(ds is not None)
 
+    def test_fill_zarr_arrays(self, data_path=DATA_PATH, scenario_name=SCENARIO,
+                              num_chunks=NUM_CHUNKS, mean_vals=MULTI_MODEL_MEANS,
+                              std_vals=MULTI_MODEL_STDS):
+        """
+        Tests that statistics written straight to a zarr file match the
+        statistics computed in memory.
+        """
+        with tempfile.TemporaryDirectory() as out_dir:
+            store_path = out_dir + '/test.zarr'
+            [empty_dsets,
+             dim_info, _,
+             file_names,
+             datasets] = initialize_empty_mms_arrays(data_path, scenario_name, num_chunks,
+                                                     out_store=store_path)
+            fill_empty_arrays(empty_dsets, dim_info, file_names, datasets,
+                              VARIABLE_NAME, num_chunks)
+            ds_written = xr.open_zarr(store_path)
+
+            self.assertTrue(np.allclose(ds_written['mean'].values, mean_vals) and
+                            np.allclose(ds_written['std'].values, std_vals))
+
 
 if __name__ == '__main__':
     unittest.main()
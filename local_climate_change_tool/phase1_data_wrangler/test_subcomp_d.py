@@ -3,39 +3,62 @@ test_subcomp_d.py
 
 Contains the test class for subcomp_d_process_historical_obs.
 """
-import glob
 import unittest
-import os
+import tempfile
+from netCDF4 import Dataset
 import xarray as xr
 import pandas as pd
 import numpy as np
 
-from phase1_data_wrangler.data_wrangler import delete_zarr_files
-from phase1_data_wrangler.analysis_parameters import \
-    DIR_INTERMEDIATE_OBSERVATION_DATA, DIR_TESTING_DATA
+from phase1_data_wrangler.analysis_parameters import DATA_DTYPE
 from phase1_data_wrangler.subcomp_d_process_historical_obs import \
-    convert_to_360, calculate_temps, save_dataset
-
-TEST_DATA_DIR = DIR_INTERMEDIATE_OBSERVATION_DATA
-TEST_OUTPUT_DIR = DIR_TESTING_DATA + 'dummy_obs_data/'
-TEST_FILE = TEST_DATA_DIR + 'Complete_TAVG_LatLong1.nc'
-OUTPUT_FILE_NAME = 'dummy_test_dataset.zarr'
-OUTPUT_FILE = TEST_OUTPUT_DIR + OUTPUT_FILE_NAME
-
-# make the output file directory for testing data if needed
-os.makedirs(TEST_OUTPUT_DIR, exist_ok=True)
-
-# expected types and dimensions of processed obs dataset (latitude, longitude, time)
-EXP_TYPES = np.array([xr.core.dataset.Dataset,
-                      np.float32,
-                      np.float64,
-                      np.datetime64])
-EXP_DIMS = [180, 360, 2037]
-
-# dummy Dataset to test if the file saves correctly
-DUMMY_OBS = xr.Dataset(data_vars={'mean': (['time', 'lat', 'lon'],
-                                           np.empty((2, 2, 2)))},
-                       coords={'time': [0, 1], 'lat': [0, 1], 'lon':[0, 1]})
+    convert_to_360, read_obs_grid, obs_blocks, obs_times, stream_observations
+from phase1_data_wrangler.regrid_weight_cache import CACHE_STATS, reset_cache_stats
+
+# Number of months in each block read from the test files
+TEST_BLOCK_SIZE = 5
+
+
+def write_dummy_best(filename, nyears=3, nlat=4, nlon=6):
+    """Writes a small file in the format of the BEST observations.
+
+    Returns:
+        The anomalies and climatology written to the file, with NaN for the
+        masked anomaly.
+    """
+    rng = np.random.default_rng(0)
+    anomalies = rng.normal(size=(12*nyears, nlat, nlon)).astype(np.float32)
+    anomalies[14, 1, 2] = -999.
+    climatology = 10*rng.normal(size=(12, nlat, nlon)).astype(np.float32)
+    with Dataset(filename, 'w') as nc1:
+        nc1.createDimension('time', 12*nyears)
+        nc1.createDimension('latitude', nlat)
+        nc1.createDimension('longitude', nlon)
+        nc1.createDimension('month_number', 12)
+        nc1.createVariable('time', 'f8', ('time',))[:] = 1850 + (np.arange(12*nyears) + 0.5)/12
+        nc1.createVariable('latitude', 'f4', ('latitude',))[:] = np.linspace(-60, 60, nlat)
+        nc1.createVariable('longitude', 'f4', ('longitude',))[:] = np.linspace(-150, 150, nlon)
+        nc1.createVariable('temperature', 'f4', ('time', 'latitude', 'longitude'),
+                           fill_value=np.float32(-999.))[:] = anomalies
+        nc1.createVariable('climatology', 'f4',
+                           ('month_number', 'latitude', 'longitude'))[:] = climatology
+    anomalies[14, 1, 2] = np.nan
+    return [anomalies, climatology]
+
+
+def read_temps(filename, first_month=0, block_size=TEST_BLOCK_SIZE):
+    """Reads the average temperatures of an observations file with obs_blocks.
+
+    Returns:
+        t_avg: Numpy array (time, lat, lon) of the average temperatures.
+        time, lat, lon: The coordinates of t_avg.
+    """
+    with Dataset(filename, 'r') as nc1:
+        [months, lat, lon, _, _] = read_obs_grid(nc1, first_month)
+        # obs_blocks reuses its output array, so each block is copied
+        t_avg = np.concatenate([block.copy() for [_, _, block]
+                                in obs_blocks(nc1, block_size, first_month)])
+    return [t_avg, obs_times(months), lat, lon]
 
 
 class TestSubcompD(unittest.TestCase):
@@ -53,53 +76,74 @@ class TestSubcompD(unittest.TestCase):
 
         self.assertTrue(np.array_equal(exp_lons, conv_lons))
 
-    def test_calculate_temps(self):
+    def test_obs_blocks(self):
+        """
+        Tests that obs_blocks reads the observations file in consecutive
+        blocks of months of DATA_DTYPE, with times of the expected type.
+        """
+        with tempfile.TemporaryDirectory() as out_dir:
+            write_dummy_best(out_dir + '/best.nc')
+            with Dataset(out_dir + '/best.nc', 'r') as nc1:
+                bounds = [(i0, i1, block.shape, block.dtype) for [i0, i1, block]
+                          in obs_blocks(nc1, TEST_BLOCK_SIZE, first_month=12)]
+            self.assertEqual([bound[:2] for bound in bounds],
+                             [(i0, min(i0 + TEST_BLOCK_SIZE, 24))
+                              for i0 in range(0, 24, TEST_BLOCK_SIZE)])
+            self.assertTrue(all(shape == (i1 - i0, 4, 6) and dtype == DATA_DTYPE
+                                for [i0, i1, shape, dtype] in bounds))
+
+            [t_avg, time, lat, lon] = read_temps(out_dir + '/best.nc', first_month=12)
+            self.assertEqual(t_avg.shape, (24, len(lat), len(lon)))
+            self.assertIsInstance(time, pd.DatetimeIndex)
+            self.assertEqual(time[0].year, 1851)
+
+    def test_stream_observations(self):
+        """
+        Tests that the observations written one block at a time match the
+        anomalies plus climatology, sorted by longitude.
+        """
+        with tempfile.TemporaryDirectory() as out_dir:
+            [anomalies, climatology] = write_dummy_best(out_dir + '/best.nc')
+            expected = xr.Dataset({'mean': (['time', 'lat', 'lon'],
+                                            anomalies + np.tile(climatology, (3, 1, 1)))},
+                                  coords={'lon': convert_to_360(np.linspace(-150, 150, 6))})
+            expected = expected.sortby('lon')
+
+            [t_avg, time, _, lon] = read_temps(out_dir + '/best.nc')
+            self.assertTrue(np.array_equal(lon, expected.lon.values))
+            self.assertTrue(np.allclose(t_avg, expected['mean'].values, equal_nan=True))
+            self.assertEqual([time[0].month, time[0].day, time[-1].year], [1, 15, 1852])
+
+            stream_observations(out_dir + '/best.nc', out_dir + '/obs.zarr',
+                                memory_budget=1, first_month=0)
+            for store_name in ['obs.zarr', 'obs_map.zarr']:
+                test_ds = xr.open_zarr(out_dir + '/' + store_name)
+                self.assertTrue(np.allclose(test_ds['mean'].values, t_avg, equal_nan=True))
+                self.assertTrue((test_ds.time.values == time.values).all())
+
+    def test_regrid_observations(self):
         """
-        Tests that the raw observations file exists and calculate_temps function
-        returns a list of length 4 with t_avg, time, and lat and lon with the
-        expected data types.
+        Tests that the observations are regridded onto the reference grid
+        with cached weights.
         """
-        output = calculate_temps(filename=TEST_FILE)
-        exp_length = 4
-        exp_types = [np.ndarray, pd.core.indexes.datetimes.DatetimeIndex,
-                     np.ndarray, np.ndarray]
-
-        correct_length = len(output) == exp_length
-        if correct_length:
-            correct_types = all([isinstance(output[i], exp_types[i])
-                                 for i in range(exp_length)])
-        else:
-            correct_types = False
-
-        self.assertTrue(correct_types)
-        self.assertTrue(correct_length)
-
-    def test_save_dataset(self):
-        """Tests that the dataset was saved correctly."""
-        # if the directory is not empty, delete first - zarr can't overwrite
-        delete_zarr_files(data_dir=TEST_OUTPUT_DIR, regex='',
-                          file_type=OUTPUT_FILE_NAME)
-
-        save_dataset(best_data=DUMMY_OBS, data_path_out=TEST_OUTPUT_DIR,
-                     out_file_name=OUTPUT_FILE_NAME)
-
-        out_dir_files = glob.glob(TEST_OUTPUT_DIR + '*.zarr', recursive=True)
-        file_exists = OUTPUT_FILE in out_dir_files
-
-        if file_exists:
-            test_ds = xr.open_zarr(OUTPUT_FILE)
-
-            ds_pass = isinstance(test_ds, type(DUMMY_OBS))
-            coord_pass = ((test_ds.lat.values == DUMMY_OBS.lat.values).all() and
-                          (test_ds.lon.values == DUMMY_OBS.lon.values).all() and
-                          (test_ds.time.values == DUMMY_OBS.time.values).all())
-        else:
-            ds_pass = False
-            coord_pass = False
-
-        self.assertTrue(file_exists)
-        self.assertTrue(ds_pass)
-        self.assertTrue(coord_pass)
+        reference_grid = xr.Dataset({'lat': [-20., 60.], 'lon': [30., 270.]})
+        with tempfile.TemporaryDirectory() as out_dir:
+            write_dummy_best(out_dir + '/best.nc')
+            [t_avg, _, lat, lon] = read_temps(out_dir + '/best.nc')
+            native = xr.DataArray(t_avg, dims=['time', 'lat', 'lon'],
+                                  coords={'lat': lat, 'lon': lon})
+            expected = native.sel(lat=reference_grid.lat, lon=reference_grid.lon).values
+
+            reset_cache_stats()
+            for store_name in ['obs.zarr', 'obs_again.zarr']:
+                stream_observations(out_dir + '/best.nc', out_dir + '/' + store_name,
+                                    layouts=['series'], first_month=0,
+                                    reference_grid=reference_grid,
+                                    weights_dir=out_dir + '/', backend='sparse')
+                test_ds = xr.open_zarr(out_dir + '/' + store_name)
+                self.assertTrue((test_ds.lon.values == reference_grid.lon.values).all())
+                self.assertTrue(np.allclose(test_ds['mean'].values, expected, equal_nan=True))
+            self.assertEqual([CACHE_STATS['misses'], CACHE_STATS['hits']], [1, 1])
 
 
 if __name__ == '__main__':
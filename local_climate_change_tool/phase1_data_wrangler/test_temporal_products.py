@@ -0,0 +1,78 @@
+"""
+test_temporal_products.py
+
+Contains the test class for temporal_products.py.
+"""
+import os
+import tempfile
+import unittest
+import warnings
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from phase1_data_wrangler.temporal_products import product_periods, \
+    write_temporal_products, product_store_path
+from phase1_data_wrangler.zarr_writer import write_zarr_layouts, layout_store_path
+
+TIMES = pd.date_range('1999-12-01', periods=12*25 + 1, freq='MS') + pd.Timedelta(days=14)
+
+
+def make_monthly_dataset():
+    """Returns a monthly dataset with some NaNs."""
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(len(TIMES), 12, 5))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    values[:, 0, 0] = np.nan
+    return xr.Dataset({'mean': (('time', 'lat', 'lon'), values),
+                       'std': (('time', 'lat', 'lon'), np.abs(values))},
+                      coords={'time': TIMES, 'lat': np.arange(12.), 'lon': np.arange(5.)})
+
+
+class TestTemporalProducts(unittest.TestCase):
+    """Test class for temporal_products.py"""
+
+    def test_product_periods(self):
+        """Tests that only whole periods are found."""
+        [starts, length, _] = product_periods(TIMES, 'annual')
+        self.assertEqual(length, 12)
+        self.assertEqual(list(TIMES[starts].year), list(range(2000, 2025)))
+        [starts, length, coords] = product_periods(TIMES, 'seasonal')
+        self.assertEqual(list(coords['season'][:5]), ['DJF', 'MAM', 'JJA', 'SON', 'DJF'])
+        self.assertEqual(TIMES[starts[0]].month, 12)
+        self.assertEqual(starts[-1] + length, len(TIMES) - 1)
+        [starts, length, coords] = product_periods(TIMES, 'climatology20')
+        self.assertEqual(list(coords['last_year']), [2019, 2020, 2021, 2022, 2023, 2024])
+
+    def test_write_temporal_products(self):
+        """Tests that the products match xarray's NaN-skipping means, and that
+        only the mean is averaged."""
+        ds = make_monthly_dataset()
+        with tempfile.TemporaryDirectory() as out_dir:
+            store_path = out_dir + '/obs.zarr'
+            write_zarr_layouts(ds, store_path, layouts=['series'])
+            paths = write_temporal_products(store_path,
+                                            products=['annual', 'seasonal', 'climatology20'],
+                                            layouts=['series', 'map'], memory_budget=1)
+            self.assertEqual(paths['annual'], product_store_path(store_path, 'annual'))
+            self.assertTrue(os.path.exists(layout_store_path(paths['seasonal'], 'map')))
+
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                annual = ds.sel(time=slice('2000', '2024')).groupby('time.year').mean()
+                seasonal = ds.isel(time=slice(0, -1)).coarsen(time=3).mean()
+            written = xr.open_zarr(paths['annual'])
+            self.assertTrue(np.allclose(written['mean'].values, annual['mean'].values,
+                                        equal_nan=True))
+            written = xr.open_zarr(layout_store_path(paths['seasonal'], 'map'))
+            self.assertTrue(np.allclose(written['mean'].values, seasonal['mean'].values,
+                                        equal_nan=True))
+            self.assertEqual(list(written.data_vars), ['mean'])
+            written = xr.open_zarr(paths['climatology20'])
+            first = ds['mean'].sel(time=slice('2000', '2019')).mean('time').values
+            self.assertTrue(np.allclose(written['mean'][0].values, first, equal_nan=True))
+            self.assertEqual(int(written['last_year'][0]), 2019)
+
+
+if __name__ == '__main__':
+    unittest.main()
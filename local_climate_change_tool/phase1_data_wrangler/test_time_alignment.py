@@ -0,0 +1,98 @@
+"""
+test_time_alignment.py
+
+Contains the test class for time_alignment.py.
+"""
+import os
+import tempfile
+import unittest
+import warnings
+import numpy as np
+import xarray as xr
+
+from phase1_data_wrangler.time_alignment import align_months, align_datasets, \
+    alignment_key, cached_alignment, read_aligned_band, ALIGNMENT_CACHE
+from phase1_data_wrangler.band_executor import map_bands, band_bounds
+from phase1_data_wrangler.calendar_normalization import months_to_times
+
+# First month index and number of months of each test model
+MODEL_MONTHS = [(12*2015, 12*86), (12*2015, 12*85), (12*2014 + 6, 12*80)]
+
+
+def make_datasets(data_dir):
+    """Writes models covering different months to zarr files and opens them."""
+    rng = np.random.default_rng(0)
+    datasets = []
+    for i, [first, ntime] in enumerate(MODEL_MONTHS):
+        values = rng.normal(size=(ntime, 7, 4)).astype(np.float32)
+        values[rng.random(values.shape) < 0.1] = np.nan
+        store_path = data_dir + '/tas_ssp585_M' + str(i) + '.zarr'
+        times = months_to_times(np.arange(first, first + ntime))
+        xr.Dataset({'tas': (('time', 'lat', 'lon'), values)},
+                   coords={'time': times, 'lat': np.arange(7.),
+                           'lon': np.arange(4.)}).to_zarr(store_path)
+        datasets.append(xr.open_zarr(store_path))
+    return datasets
+
+
+class TestTimeAlignment(unittest.TestCase):
+    """Test class for time_alignment.py"""
+
+    def test_align_months(self):
+        """Tests the offsets of the union and intersection of months."""
+        model_months = [np.arange(10, 20), np.arange(12, 25), np.arange(5, 15)]
+        [months, time_slices] = align_months(model_months, 'union')
+        self.assertEqual([months[0], months[-1]], [5, 24])
+        self.assertEqual(time_slices, [(0, 10, 5, 20), (0, 13, 7, 20), (0, 10, 0, 20)])
+        [months, time_slices] = align_months(model_months, 'intersection')
+        self.assertEqual(list(months), [12, 13, 14])
+        self.assertEqual(time_slices, [(2, 5, 0, 3), (0, 3, 0, 3), (7, 10, 0, 3)])
+        with self.assertRaises(ValueError):
+            align_months([np.arange(0, 5), np.arange(5, 10)], 'intersection')
+        with self.assertRaisesRegex(ValueError, 'ssp585'):
+            align_months([], 'union', scenario_name='ssp585')
+
+    def test_read_aligned_band(self):
+        """Tests that months a model does not cover are NaN."""
+        dataset = xr.Dataset({'tas': (('time', 'lat', 'lon'), np.ones((4, 3, 2)))})
+        band = read_aligned_band(dataset, 'tas', 1, 3, (1, 4, 2, 6))
+        self.assertEqual(band.shape, (6, 2, 2))
+        self.assertTrue(np.isnan(band[[0, 1, 5]]).all())
+        self.assertTrue((band[2:5] == 1).all())
+
+    def test_aligned_statistics(self):
+        """Tests that statistics on the shared axis match reindexed models."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            datasets = make_datasets(data_dir)
+            [nlat0_chunk, nlatf_chunk] = band_bounds(7, 3)
+            for how in ['union', 'intersection']:
+                [times, time_slices] = cached_alignment(('test', data_dir), datasets, how)
+                self.assertIs(cached_alignment(('test', data_dir), datasets, how)[0], times)
+                values = np.stack([dataset['tas'].reindex(time=times).values
+                                   for dataset in datasets])
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    expected = np.nanmean(values, axis=0)
+                bands = list(map_bands(datasets, 'tas', nlat0_chunk, nlatf_chunk,
+                                       num_workers=1, time_slices=time_slices))
+                combined = np.concatenate([band[2]['mean'] for band in bands], axis=1)
+                self.assertEqual(combined.shape[0], len(times))
+                self.assertTrue(np.allclose(combined, expected, atol=1e-5, equal_nan=True))
+            self.assertEqual(len(align_datasets(datasets, 'union')[0]), 12*86 + 6)
+            ALIGNMENT_CACHE.clear()
+
+    def test_alignment_key(self):
+        """Tests that rewriting a model file changes the alignment cache key."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            make_datasets(data_dir)
+            data_path = data_dir + '/'
+            file_names = ['tas_ssp585_M0', 'tas_ssp585_M1']
+            key = alignment_key(data_path, 'ssp585', file_names)
+            self.assertEqual(alignment_key(data_path, 'ssp585', file_names), key)
+            mtime = os.path.getmtime(data_path + 'tas_ssp585_M1.zarr')
+            os.utime(data_path + 'tas_ssp585_M1.zarr', (mtime + 10, mtime + 10))
+            self.assertNotEqual(alignment_key(data_path, 'ssp585', file_names), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
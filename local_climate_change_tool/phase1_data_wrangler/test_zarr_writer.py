@@ -0,0 +1,136 @@
+"""
+test_zarr_writer.py
+
+Contains the test class for zarr_writer.py.
+"""
+import unittest
+import tempfile
+import zarr
+import xarray as xr
+import numpy as np
+import pandas as pd
+import dask.array as da
+
+from phase1_data_wrangler.zarr_writer import plan_chunks, plan_regions, \
+    choose_region_dim, write_zarr_streaming, write_zarr_layouts, \
+    create_zarr_store, copy_to_layouts, zarr_encoding
+
+CHUNKS = {'time': -1, 'lat': 4, 'lon': 5}
+TIMES = pd.date_range(start='1850-01-15', periods=24, freq='MS') + pd.Timedelta(days=14)
+DS = xr.Dataset({'mean': (['time', 'lat', 'lon'], np.random.rand(24, 18, 20)),
+                 'std': (['time', 'lat', 'lon'], np.random.rand(24, 18, 20))},
+                coords={'time': TIMES,
+                        'lat': np.linspace(-85., 85., 18),
+                        'lon': np.linspace(0., 342., 20)})
+DS['mean'][0, 0, 0] = np.nan
+BYTES_PER_LAT = 2*24*20*8
+
+
+class TestZarrWriter(unittest.TestCase):
+    """Test class for zarr_writer.py"""
+
+    def test_plan_chunks(self):
+        """Tests that -1 and oversized chunks become the whole dimension."""
+        planned = plan_chunks(DS, {'time': -1, 'lat': 4, 'lon': 100})
+        self.assertEqual(planned, {'time': 24, 'lat': 4, 'lon': 20})
+
+    def test_plan_regions(self):
+        """Tests that regions are whole chunks that fit the memory budget."""
+        planned = plan_chunks(DS, CHUNKS)
+        regions = plan_regions(DS, planned, memory_budget=9*BYTES_PER_LAT)
+        self.assertEqual(regions, [slice(0, 8), slice(8, 16), slice(16, 18)])
+
+        # A region is never smaller than one chunk
+        regions = plan_regions(DS, planned, memory_budget=1)
+        self.assertEqual(len(regions), 5)
+
+    def test_write_zarr_streaming(self):
+        """Tests that the written file matches the dataset and the chunk plan."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            store_path = data_dir + '/test.zarr'
+            write_zarr_streaming(DS, store_path, chunks=CHUNKS,
+                                 memory_budget=5*BYTES_PER_LAT)
+            ds_written = xr.open_zarr(store_path)
+
+            xr.testing.assert_identical(ds_written.load(), DS)
+            self.assertEqual(zarr.open_group(store_path)['mean'].chunks, (24, 4, 5))
+
+    def test_choose_region_dim(self):
+        """Tests that regions are along a dimension split into several chunks."""
+        self.assertEqual(choose_region_dim(DS, plan_chunks(DS, CHUNKS)), 'lat')
+        map_chunks = {'time': 12, 'lat': -1, 'lon': -1}
+        self.assertEqual(choose_region_dim(DS, plan_chunks(DS, map_chunks)), 'time')
+
+    def test_write_zarr_layouts(self):
+        """Tests that a file is written for each layout with its own chunks."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            paths = write_zarr_layouts(DS, data_dir + '/test.zarr',
+                                       layouts=['series', 'map'],
+                                       memory_budget=5*BYTES_PER_LAT)
+
+            self.assertEqual(paths, [data_dir + '/test.zarr', data_dir + '/test_map.zarr'])
+            self.assertEqual(zarr.open_group(paths[0])['mean'].chunks, (24, 10, 10))
+            self.assertEqual(zarr.open_group(paths[1])['mean'].chunks, (12, 18, 20))
+            xr.testing.assert_identical(xr.open_zarr(paths[1]).load(), DS)
+
+    def test_create_zarr_store(self):
+        """Tests that values assigned to the created file's arrays are saved."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            store_path = data_dir + '/test.zarr'
+            ds_template = DS.copy()
+            for name in ['mean', 'std']:
+                ds_template[name] = (['time', 'lat', 'lon'], da.empty((24, 18, 20)))
+            group = create_zarr_store(ds_template, store_path, chunks=CHUNKS)
+            for name in ['mean', 'std']:
+                group[name][:, 0:8, :] = DS[name].values[:, 0:8, :]
+                group[name][:, 8:, :] = DS[name].values[:, 8:, :]
+
+            xr.testing.assert_identical(xr.open_zarr(store_path).load(), DS)
+
+    def test_copy_to_layouts(self):
+        """Tests that a 'series' file is copied to the other layouts."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            store_path = data_dir + '/test.zarr'
+            write_zarr_streaming(DS, store_path, chunks={'time': -1, 'lat': 10, 'lon': 10})
+            paths = copy_to_layouts(store_path, layouts=['series', 'map'],
+                                    memory_budget=5*BYTES_PER_LAT)
+
+            self.assertEqual(paths, [data_dir + '/test_map.zarr'])
+            self.assertEqual(zarr.open_group(paths[0])['mean'].chunks, (12, 18, 20))
+            xr.testing.assert_identical(xr.open_zarr(paths[0]).load(), DS)
+
+    def test_encoding(self):
+        """Tests that the compressor and quantization are applied to copies too."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            store_path = data_dir + '/test.zarr'
+            write_zarr_streaming(DS, store_path, chunks=CHUNKS,
+                                 compressor={'cname': 'lz4', 'clevel': 1, 'shuffle': 'byte'})
+            self.assertEqual(zarr.open_group(store_path)['std'].compressor.cname, 'lz4')
+            copy_path = data_dir + '/copy.zarr'
+            write_zarr_streaming(xr.open_zarr(store_path), copy_path, chunks=CHUNKS,
+                                 compressor={'cname': 'zstd', 'clevel': 9, 'shuffle': 'bit'},
+                                 quantize_digits=3)
+            written = zarr.open_group(copy_path)['mean']
+            self.assertEqual(written.compressor.cname, 'zstd')
+            self.assertEqual(written.compressor.clevel, 9)
+            copied = xr.open_zarr(copy_path).load()
+            self.assertTrue(np.allclose(copied['mean'], DS['mean'], rtol=1e-3, atol=0,
+                                        equal_nan=True))
+            self.assertFalse(np.array_equal(copied['mean'], DS['mean'], equal_nan=True))
+
+    def test_significant_digits(self):
+        """Tests that quantization keeps significant digits at any scale."""
+        values = np.array([[[0.0012345, 2.345678], [287.1234, -17.98765]]], dtype=np.float32)
+        ds = xr.Dataset({'pr': (['time', 'lat', 'lon'], values)},
+                        coords={'time': TIMES[:1], 'lat': [0., 1.], 'lon': [0., 1.]})
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_zarr_streaming(ds, data_dir + '/test.zarr',
+                                 chunks={'time': 1, 'lat': 2, 'lon': 2}, quantize_digits=4)
+            written = xr.open_zarr(data_dir + '/test.zarr')['pr'].values
+        self.assertTrue(np.allclose(written, values, rtol=1e-4, atol=0))
+        self.assertFalse(np.array_equal(written, values))
+        self.assertEqual(zarr_encoding(ds, quantize_digits=8)['pr'].get('filters'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
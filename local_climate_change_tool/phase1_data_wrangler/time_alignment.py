@@ -0,0 +1,123 @@
+"""
+time_alignment.py
+
+Aligns the time axes of the models of a scenario, which do not all cover the
+same months (e.g. ssp runs ending in 2099 or 2100, or historical runs
+starting in different years).
+
+Each model's times are turned into consecutive month indices (see
+calendar_normalization.py) and the shared time axis is either the union or
+the intersection of their months (see TIME_ALIGNMENT). Each model is then
+described by a time slice: the integer offsets of the part of its own time
+axis that is on the shared axis, and where that part starts on the shared
+axis. Bands are read with these offsets straight into an array on the
+shared axis (see read_aligned_band), so no model is reindexed; months a model
+does not cover are NaN, which the statistics skip.
+
+The alignment of a scenario is cached, so that the models' times are only
+decoded and compared once. The cache key includes the modification time of
+each model's file, so rewritten files are aligned again.
+"""
+import os
+import numpy as np
+
+from phase1_data_wrangler.analysis_parameters import TIME_ALIGNMENT
+from phase1_data_wrangler.calendar_normalization import month_index, \
+    validate_months, months_to_times
+
+# Alignments that were already made (cache key to [times, time_slices])
+ALIGNMENT_CACHE = dict()
+
+
+def align_months(model_months, how=TIME_ALIGNMENT, scenario_name=None):
+    """Aligns the consecutive month indices of several models.
+
+    Args:
+        model_months: List of integer arrays of the month indices of each model.
+        how: Either 'union' or 'intersection'.
+        scenario_name: String name of the scenario of the models, for errors.
+    Returns:
+        months: Integer array of the month indices of the shared time axis.
+        time_slices: List of (start, end, offset, ntime) for each model: the
+                     months [start, end) of the model are months
+                     [offset, offset + end - start) of the ntime shared months.
+    Raises:
+        ValueError: If there are no models, how is unknown, or the
+                    intersection is empty.
+    """
+    if len(model_months) == 0:
+        raise ValueError('Scenario '+str(scenario_name)+' has no model files to align')
+    firsts = np.array([months[0] for months in model_months])
+    lasts = np.array([months[-1] for months in model_months])
+    if how == 'union':
+        [first, last] = [firsts.min(), lasts.max()]
+    elif how == 'intersection':
+        [first, last] = [firsts.max(), lasts.min()]
+        if last < first:
+            raise ValueError('The models of scenario '+str(scenario_name)+
+                             ' do not have any months in common')
+    else:
+        raise ValueError('Unknown time alignment: '+str(how))
+
+    ntime = int(last - first + 1)
+    starts = np.maximum(first - firsts, 0)
+    ends = np.minimum(last - firsts + 1, [len(months) for months in model_months])
+    offsets = firsts + starts - first
+    time_slices = [(int(start), int(end), int(offset), ntime)
+                   for start, end, offset in zip(starts, ends, offsets)]
+    return [np.arange(first, last + 1), time_slices]
+
+
+def align_datasets(datasets, how=TIME_ALIGNMENT, scenario_name=None):
+    """Aligns the time axes of model datasets (see align_months).
+
+    Returns:
+        times: Numpy array of the proleptic Gregorian times of the shared axis.
+        time_slices: List of the time slice of each dataset.
+    """
+    model_months = []
+    for dataset in datasets:
+        months = month_index(dataset['time'].values)
+        validate_months(months)
+        model_months.append(months)
+    [months, time_slices] = align_months(model_months, how, scenario_name)
+    return [months_to_times(months), time_slices]
+
+
+def alignment_key(data_path, scenario_name, file_names):
+    """Returns the cache key of the alignment of a scenario's model files.
+
+    The key includes the modification time of each zarr file, so the cached
+    alignment is not used once a file has been rewritten.
+    """
+    mtimes = tuple(os.path.getmtime(data_path + fname + '.zarr') for fname in file_names)
+    return (data_path, scenario_name, tuple(file_names), mtimes)
+
+
+def cached_alignment(cache_key, datasets, how=TIME_ALIGNMENT, scenario_name=None):
+    """Returns align_datasets(datasets, how), made once for each cache_key.
+
+    Args:
+        cache_key: Hashable key of the datasets (e.g. from alignment_key).
+        datasets: List of the model datasets.
+        how: Either 'union' or 'intersection'.
+        scenario_name: String name of the scenario of the models, for errors.
+    """
+    if (cache_key, how) not in ALIGNMENT_CACHE:
+        ALIGNMENT_CACHE[(cache_key, how)] = align_datasets(datasets, how, scenario_name)
+    return ALIGNMENT_CACHE[(cache_key, how)]
+
+
+def read_aligned_band(dataset, varname, nlat0, nlatf, time_slice):
+    """Reads one latitude band of a model's variable on the shared time axis.
+
+    Only the model's months on the shared axis are read. Months the model
+    does not cover are NaN.
+    """
+    [start, end, offset, ntime] = time_slice
+    values = dataset[varname][start:end, nlat0:nlatf, :].values
+    if offset == 0 and end - start == ntime:
+        return values
+    band = np.full((ntime,) + values.shape[1:], np.nan, dtype=values.dtype)
+    band[offset:offset + end - start] = values
+    return band
@@ -0,0 +1,296 @@
+"""
+zarr_writer.py
+
+Writes datasets to zarr files one region at a time, so that the dataset stays
+lazy and only a bounded amount of it is held in memory while it is written.
+The chunk layout on disk is planned up front and checked after writing.
+Every data variable is compressed (and optionally quantized) as set by
+ZARR_COMPRESSOR and ZARR_QUANTIZE_DIGITS.
+"""
+import math
+import numpy as np
+import zarr
+import xarray as xr
+from numcodecs import Blosc
+
+from phase1_data_wrangler.analysis_parameters import ZARR_CHUNKS, \
+    ZARR_MEMORY_BUDGET, CHUNK_LAYOUTS, LAYOUT_SUFFIXES, PROCESSED_LAYOUTS, \
+    ZARR_COMPRESSOR, ZARR_QUANTIZE_DIGITS
+
+SHUFFLES = {'none': Blosc.NOSHUFFLE, 'byte': Blosc.SHUFFLE, 'bit': Blosc.BITSHUFFLE}
+
+
+def plan_chunks(ds, chunks=ZARR_CHUNKS):
+    """Plans the chunk size of each dimension of the dataset.
+
+    Args:
+        ds: The dataset to write.
+        chunks: Dictionary of dimension name to chunk size (-1 for the whole
+                dimension). Dimensions that are not listed are not split.
+    Returns:
+        planned: Dictionary of dimension name to integer chunk size.
+    """
+    planned = dict()
+    for dim, size in ds.sizes.items():
+        chunk = chunks.get(dim, -1)
+        if chunk == -1 or chunk > size:
+            chunk = size
+        planned[dim] = max(int(chunk), 1)
+    return planned
+
+
+def choose_region_dim(ds, planned, dims=('lat', 'time', 'lon')):
+    """Returns the first dimension in dims that is split into several chunks.
+
+    Regions along this dimension are made of whole chunks, so each region
+    can be written without touching the chunks of any other region.
+    """
+    for dim in dims:
+        if dim in planned and planned[dim] < ds.sizes[dim]:
+            return dim
+    return dims[0]
+
+
+def plan_regions(ds, planned, memory_budget=ZARR_MEMORY_BUDGET, region_dim='lat'):
+    """Splits region_dim into regions that each fit in the memory budget.
+
+    Each region is a whole number of chunks along region_dim, so that no two
+    regions write to the same chunk. A region is never smaller than a single
+    chunk, even if that is over the budget.
+
+    Args:
+        ds: The dataset to write.
+        planned: Dictionary of dimension name to integer chunk size.
+        memory_budget: Integer maximum number of bytes to hold in memory.
+        region_dim: String name of the dimension to split into regions.
+    Returns:
+        regions: List of slices along region_dim.
+    """
+    bytes_per_index = 0
+    for name in ds.data_vars:
+        data_array = ds[name]
+        if region_dim in data_array.dims:
+            bytes_per_index = bytes_per_index + (data_array.dtype.itemsize *
+                                                 data_array.size //
+                                                 data_array.sizes[region_dim])
+
+    size = ds.sizes[region_dim]
+    chunk = planned[region_dim]
+    chunks_per_region = max(memory_budget // max(bytes_per_index*chunk, 1), 1)
+    region_size = int(chunks_per_region*chunk)
+
+    return [slice(start, min(start+region_size, size))
+            for start in range(0, size, region_size)]
+
+
+def mantissa_bits(significant_digits):
+    """Returns the number of mantissa bits that keep at least
+    significant_digits significant decimal digits."""
+    return math.ceil(significant_digits*math.log2(10))
+
+
+def zarr_encoding(ds, compressor=ZARR_COMPRESSOR, quantize_digits=ZARR_QUANTIZE_DIGITS):
+    """Returns the zarr encoding of the data variables of a dataset.
+
+    Args:
+        ds: The dataset to write.
+        compressor: Dictionary of the Blosc 'cname', 'clevel', and 'shuffle'
+                    (see ZARR_COMPRESSOR), or None for zarr's default.
+        quantize_digits: Integer number of significant decimal digits to keep
+                         in floating point variables, or None to keep every
+                         bit. The precision is relative to each value, so it
+                         suits variables of any units (e.g. degC and mm/day).
+                         Requires numcodecs 0.10 or later.
+    Returns:
+        encoding: Dictionary of variable name to its encoding.
+    """
+    encoding = dict()
+    for name in ds.data_vars:
+        variable_encoding = dict()
+        if compressor is not None:
+            variable_encoding['compressor'] = Blosc(cname=compressor['cname'],
+                                                    clevel=compressor['clevel'],
+                                                    shuffle=SHUFFLES[compressor['shuffle']])
+        if quantize_digits is not None and np.issubdtype(ds[name].dtype, np.floating):
+            # BitRound is only in numcodecs 0.10 and later
+            from numcodecs import BitRound
+            keepbits = mantissa_bits(quantize_digits)
+            # Rounding to the full mantissa (or more) would keep every bit
+            if keepbits < np.finfo(ds[name].dtype).nmant:
+                variable_encoding['filters'] = [BitRound(keepbits=keepbits)]
+        encoding[name] = variable_encoding
+    return encoding
+
+
+def encoded_values(variable, name):
+    """Encodes a variable the way xarray stores it on disk."""
+    encoded = xr.conventions.encode_cf_variable(variable, name=name)
+    return np.asarray(encoded.values)
+
+
+def check_chunks(store_path, ds, planned):
+    """Checks that the chunks of every variable in the zarr file match the plan.
+
+    Raises:
+        ValueError: If a variable was written with different chunks.
+    """
+    group = zarr.open_group(store_path, mode='r')
+    for name in ds.variables:
+        expected = tuple(planned[dim] for dim in ds[name].dims)
+        written = group[name].chunks
+        if name not in ds.dims and tuple(written) != expected:
+            raise ValueError('Variable ' + str(name) + ' was written with chunks ' +
+                             str(written) + ' instead of ' + str(expected))
+
+
+def write_zarr_streaming(ds, store_path, chunks=ZARR_CHUNKS,
+                         memory_budget=ZARR_MEMORY_BUDGET, region_dim=None,
+                         compressor=ZARR_COMPRESSOR, quantize_digits=ZARR_QUANTIZE_DIGITS):
+    """Writes a dataset to a zarr file one region at a time.
+
+    The zarr file is first created with all of its metadata and coordinates.
+    Each region of region_dim is then computed and written on its own, so at
+    most memory_budget bytes of output (plus the input chunks needed to
+    compute one region) are held in memory at once.
+
+    Args:
+        ds: The (lazy or in-memory) dataset to write.
+        store_path: String path of the zarr file to create.
+        chunks: Dictionary of dimension name to chunk size (-1 for the whole
+                dimension).
+        memory_budget: Integer maximum number of bytes of output to hold in
+                       memory at once.
+        region_dim: String name of the dimension to split into regions (by
+                    default, chosen by choose_region_dim).
+        compressor, quantize_digits: Encoding of the data variables (see
+                                     zarr_encoding).
+    Returns:
+        planned: Dictionary of dimension name to the chunk size on disk.
+    """
+    planned = plan_chunks(ds, chunks)
+    if region_dim is None:
+        region_dim = choose_region_dim(ds, planned)
+    ds = ds.chunk(planned)
+    for name in ds.variables:
+        ds[name].encoding.pop('chunks', None)
+        ds[name].encoding.pop('preferred_chunks', None)
+
+    # Creates the metadata and writes the index coordinates; everything else
+    # is written below
+    ds.to_zarr(store_path, compute=False, consolidated=True,
+               encoding=zarr_encoding(ds, compressor, quantize_digits))
+
+    group = zarr.open_group(store_path, mode='r+')
+    region_names = [name for name in ds.variables
+                    if name not in ds.dims and region_dim in ds[name].dims]
+    for name in ds.variables:
+        if name not in ds.dims and name not in region_names:
+            group[name][...] = encoded_values(ds[name].variable, name)
+
+    if region_names:
+        for region in plan_regions(ds, planned, memory_budget, region_dim):
+            # Compute all variables in the region together so they can share
+            # the work of computing their inputs
+            ds_region = ds[region_names].isel({region_dim: region}).load()
+            for name in region_names:
+                variable = ds_region[name].variable
+                index = tuple(region if dim == region_dim else slice(None)
+                              for dim in variable.dims)
+                group[name][index] = encoded_values(variable, name)
+
+    check_chunks(store_path, ds, planned)
+
+    return planned
+
+
+def create_zarr_store(ds_template, store_path, chunks=ZARR_CHUNKS,
+                      compressor=ZARR_COMPRESSOR, quantize_digits=ZARR_QUANTIZE_DIGITS):
+    """Creates a zarr file for a dataset whose values are written later.
+
+    Only the metadata and the index coordinates are written; the data
+    variables of ds_template are never computed, so they can be lazy
+    placeholders (e.g. dask.array.empty). Their values are written later by
+    assigning to regions of the returned zarr arrays, and unwritten chunks
+    read as the fill value (NaN for floats).
+
+    Args:
+        ds_template: Dataset with the coordinates, variables, and dtypes of
+                     the zarr file.
+        store_path: String path of the zarr file to create.
+        chunks: Dictionary of dimension name to chunk size (-1 for the whole
+                dimension).
+        compressor, quantize_digits: Encoding of the data variables (see
+                                     zarr_encoding).
+    Returns:
+        group: The zarr group of the new file, opened for writing.
+    """
+    planned = plan_chunks(ds_template, chunks)
+    ds_template = ds_template.chunk(planned)
+    for name in ds_template.variables:
+        ds_template[name].encoding.pop('chunks', None)
+        ds_template[name].encoding.pop('preferred_chunks', None)
+    ds_template.to_zarr(store_path, compute=False, consolidated=True,
+                        encoding=zarr_encoding(ds_template, compressor, quantize_digits))
+    check_chunks(store_path, ds_template, planned)
+
+    return zarr.open_group(store_path, mode='r+')
+
+
+def layout_store_path(store_path, layout):
+    """Returns the path of the zarr file with the given chunk layout.
+
+    Files with the 'series' layout keep the original name, so existing
+    readers of those files are unaffected.
+    """
+    return store_path[:-len('.zarr')] + LAYOUT_SUFFIXES[layout] + '.zarr'
+
+
+def write_zarr_layouts(ds, store_path, layouts=PROCESSED_LAYOUTS,
+                       memory_budget=ZARR_MEMORY_BUDGET):
+    """Writes a dataset to one zarr file per chunk layout in CHUNK_LAYOUTS.
+
+    Args:
+        ds: The (lazy or in-memory) dataset to write.
+        store_path: String path of the zarr file with the 'series' layout.
+        layouts: List of string names of the layouts to write.
+        memory_budget: Integer maximum number of bytes of output to hold in
+                       memory at once.
+    Returns:
+        paths: List of the string paths of the written zarr files.
+    """
+    paths = []
+    for layout in layouts:
+        path = layout_store_path(store_path, layout)
+        write_zarr_streaming(ds, path, chunks=CHUNK_LAYOUTS[layout],
+                             memory_budget=memory_budget)
+        paths.append(path)
+    return paths
+
+
+def copy_to_layouts(store_path, layouts=PROCESSED_LAYOUTS,
+                    memory_budget=ZARR_MEMORY_BUDGET, source_layout='series'):
+    """Copies a zarr file with one layout (by default 'series') to the others.
+
+    The copies are streamed region by region from the zarr file, so the
+    dataset never has to fit in memory.
+
+    Args:
+        store_path: String path of the zarr file with the 'series' layout.
+        layouts: List of string names of the layouts to write (source_layout
+                 is skipped, since it is the file being copied).
+        memory_budget: Integer maximum number of bytes of output to hold in
+                       memory at once.
+        source_layout: String name of the layout of the file being copied.
+    Returns:
+        paths: List of the string paths of the written zarr files.
+    """
+    source_path = layout_store_path(store_path, source_layout)
+    paths = []
+    for layout in layouts:
+        if layout == source_layout:
+            continue
+        path = layout_store_path(store_path, layout)
+        write_zarr_streaming(xr.open_zarr(source_path), path, chunks=CHUNK_LAYOUTS[layout],
+                             memory_budget=memory_budget)
+        paths.append(path)
+    return paths
@@ -0,0 +1,122 @@
+"""
+city_index.py
+
+Index of the cities of the dashboard (worldcities.csv), saved as a binary
+.npz file so that it is loaded in milliseconds instead of parsing the CSV in
+every dashboard session.
+
+The cities are sorted by country and then by name, so the cities of a
+country are one slice of each column, found by bisecting the sorted country
+names. Cities are looked up by id in bulk through the order of the ids. The
+saved index records the size and modification time of the CSV it was built
+from, and is rebuilt when the CSV changes.
+"""
+import os
+import bisect
+import numpy as np
+import pandas as pd
+
+# Columns of the city table kept in the index
+TEXT_COLUMNS = ['city', 'city_ascii', 'admin_name', 'country']
+NUMBER_COLUMNS = ['id', 'lat', 'lng', 'population']
+
+
+def csv_source(csv_file):
+    """Returns the size and modification time of the city table file."""
+    return np.array([os.path.getsize(csv_file), os.path.getmtime(csv_file)])
+
+
+def build_city_index(csv_file):
+    """Builds the city index from a city table of any length.
+
+    Args:
+        csv_file: String path of the city table (columns as worldcities.csv).
+    Returns:
+        index: Dictionary of numpy arrays: each column of the cities (sorted
+               by country and name), the sorted 'countries' and the 'starts'
+               of their cities (with the number of cities appended), the
+               'id_order' of the rows sorted by id and the 'sorted_ids', and
+               the 'source' file.
+    """
+    cities = pd.read_csv(csv_file, keep_default_na=False,
+                         na_values={column: [''] for column in NUMBER_COLUMNS})
+    cities['population'] = cities['population'].fillna(0)
+    cities = cities.sort_values(['country', 'city_ascii'], kind='stable')
+
+    index = {column: cities[column].values.astype(str) for column in TEXT_COLUMNS}
+    index.update({column: cities[column].values for column in NUMBER_COLUMNS})
+    [index['countries'], starts] = np.unique(index['country'], return_index=True)
+    index['starts'] = np.append(starts, len(cities))
+    index['id_order'] = np.argsort(index['id'], kind='stable')
+    index['sorted_ids'] = index['id'][index['id_order']]
+    index['source'] = csv_source(csv_file)
+    return index
+
+
+def save_city_index(index, index_file):
+    """Atomically saves the city index to index_file (a .npz file)."""
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    tmp_file = index_file[:-len('.npz')] + '.' + str(os.getpid()) + '.tmp.npz'
+    np.savez(tmp_file, **index)
+    os.replace(tmp_file, index_file)
+
+
+def load_city_index(csv_file, index_file):
+    """Loads the saved city index, building and saving it if it is missing
+    or older than the city table.
+
+    Args:
+        csv_file: String path of the city table.
+        index_file: String path of the saved index (.npz).
+    Returns:
+        index: The city index (see build_city_index).
+    """
+    if os.path.isfile(index_file):
+        with np.load(index_file) as saved:
+            index = {key: saved[key] for key in saved.files}
+        if np.array_equal(index['source'], csv_source(csv_file)):
+            return index
+    index = build_city_index(csv_file)
+    try:
+        save_city_index(index, index_file)
+    except OSError:
+        # The index still works for this session if it cannot be saved
+        pass
+    return index
+
+
+def country_rows(index, country):
+    """Returns the slice of the rows of the cities of a country."""
+    i = bisect.bisect_left(index['countries'], country)
+    if i == len(index['countries']) or index['countries'][i] != country:
+        raise KeyError('Unknown country: ' + str(country))
+    return slice(index['starts'][i], index['starts'][i + 1])
+
+
+def city_rows(index, city_ids):
+    """Returns the rows of one or more city ids.
+
+    Raises:
+        KeyError: If a city id is not in the index.
+    """
+    sorted_ids = index['sorted_ids']
+    positions = np.minimum(np.searchsorted(sorted_ids, city_ids), len(sorted_ids) - 1)
+    if np.any(sorted_ids[positions] != city_ids):
+        raise KeyError('Unknown city id: ' + str(city_ids))
+    return index['id_order'][positions]
+
+
+def country_cities(index, country):
+    """Returns the city names, ids, latitudes, and longitudes of a country."""
+    rows = country_rows(index, country)
+    return [index['city_ascii'][rows], index['id'][rows],
+            index['lat'][rows], index['lng'][rows]]
+
+
+def country2city2latlon(index):
+    """Creates the nested dictionary of country to city name to [lat, lon]."""
+    return {country: dict(zip(index['city_ascii'][start:end].tolist(),
+                              map(list, zip(index['lat'][start:end].tolist(),
+                                            index['lng'][start:end].tolist()))))
+            for country, start, end in zip(index['countries'].tolist(), index['starts'][:-1],
+                                           index['starts'][1:])}
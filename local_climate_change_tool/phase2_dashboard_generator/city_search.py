@@ -0,0 +1,130 @@
+"""
+city_search.py
+
+Typeahead search of the cities of the dashboard by the prefix of their name
+(city or city_ascii), region (admin_name), or country, ignoring case and
+accents, with the most populous matches first.
+
+Every word of every searched name starts a search key (so 'york' finds New
+York), and the keys are kept in one sorted list. The keys with a prefix are
+a contiguous range of the list, found by bisection. The matches for short
+prefixes, which have the largest ranges, are ranked when the index is built.
+The index is saved next to the city index and rebuilt when the cities change.
+"""
+import os
+import bisect
+import pickle
+import unicodedata
+import numpy as np
+
+# Columns of the city index that are searched
+SEARCH_COLUMNS = ['city_ascii', 'city', 'admin_name', 'country']
+# Prefixes up to this length have their matches ranked in advance
+RANKED_PREFIX_LENGTH = 2
+# Number of matches kept for the prefixes ranked in advance
+RANKED_TOP_K = 50
+# Larger than any character, to end the range of keys with a prefix
+LAST_CHARACTER = '\U0010ffff'
+
+
+def normalize(text):
+    """Removes the accents of a string and makes it lower case."""
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    return ''.join(character for character in decomposed
+                   if not unicodedata.combining(character)).casefold()
+
+
+def name_keys(name):
+    """Returns the search keys of a name: the name from each word on."""
+    words = normalize(name).replace('-', ' ').split()
+    return {' '.join(words[i:]) for i in range(len(words))}
+
+
+def rank_rows(rows, population, top_k):
+    """Returns the top_k distinct rows, the most populous first."""
+    rows = np.unique(rows)
+    order = np.argsort(-population[rows], kind='stable')
+    return rows[order[0:top_k]]
+
+
+def build_city_search(city_index):
+    """Builds the search index of the cities.
+
+    Args:
+        city_index: The city index (see city_index.py).
+    Returns:
+        search: Dictionary with the sorted list of search 'keys', the city
+                index 'rows' of the keys, the 'population' of the rows, and
+                the 'ranked' rows of each prefix up to RANKED_PREFIX_LENGTH,
+                and the 'source' of the city index.
+    """
+    entries = set()
+    for column in SEARCH_COLUMNS:
+        for row, name in enumerate(city_index[column]):
+            entries.update((key, row) for key in name_keys(name))
+    entries = sorted(entries)
+    search = {'keys': [key for key, _ in entries],
+              'rows': np.array([row for _, row in entries], dtype=np.int64),
+              'population': np.asarray(city_index['population'], dtype=np.float64),
+              'ranked': dict(),
+              'source': np.asarray(city_index['source'])}
+
+    prefixes = {key[0:length] for key in search['keys']
+                for length in range(0, RANKED_PREFIX_LENGTH + 1)}
+    for prefix in prefixes:
+        search['ranked'][prefix] = rank_rows(search['rows'][key_range(search, prefix)],
+                                             search['population'], RANKED_TOP_K)
+    return search
+
+
+def load_city_search(city_index, search_file):
+    """Loads the saved search index, building and saving it if it is missing
+    or was built from other cities.
+
+    Args:
+        city_index: The city index (see city_index.py).
+        search_file: String path of the saved search index.
+    Returns:
+        search: The search index (see build_city_search).
+    """
+    if os.path.isfile(search_file):
+        with open(search_file, 'rb') as saved:
+            search = pickle.load(saved)
+        if np.array_equal(search['source'], city_index['source']):
+            return search
+    search = build_city_search(city_index)
+    try:
+        os.makedirs(os.path.dirname(search_file), exist_ok=True)
+        tmp_file = search_file + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_file, 'wb') as saved:
+            pickle.dump(search, saved, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, search_file)
+    except OSError:
+        # The index still works for this session if it cannot be saved
+        pass
+    return search
+
+
+def key_range(search, prefix):
+    """Returns the slice of the search keys that start with prefix."""
+    return slice(bisect.bisect_left(search['keys'], prefix),
+                 bisect.bisect_left(search['keys'], prefix + LAST_CHARACTER))
+
+
+def search_cities(search, text, top_k=10):
+    """Finds the most populous cities with a name, region, or country
+    starting with text.
+
+    Args:
+        search: The search index (see build_city_search).
+        text: String typed so far.
+        top_k: Integer maximum number of matches.
+    Returns:
+        Integer array of the city index rows of the matches, the most
+        populous first.
+    """
+    prefix = ' '.join(normalize(text).replace('-', ' ').split())
+    if prefix in search['ranked'] and top_k <= RANKED_TOP_K:
+        return search['ranked'][prefix][0:top_k]
+    return rank_rows(search['rows'][key_range(search, prefix)],
+                     search['population'], top_k)
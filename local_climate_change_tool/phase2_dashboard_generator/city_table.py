@@ -0,0 +1,200 @@
+"""
+city_table.py
+
+Tables of the time series at every city of the dashboard, so that selecting a
+city reads one slice of a memory-mapped array instead of decoding zarr chunks.
+
+There is one table per dataset (e.g. modelData_tas_ssp126) and temporal
+product. Each is a .npy file of float32 values of shape (number of cities,
+number of statistics, number of times), with the cities in the order of the
+city ids, so the statistics of a city are one contiguous slice. Next to it
+are the times (<name>_time.npy) and the city ids (city_ids.npy). A JSON file
+records the statistics of each table, the zarr file it was extracted from,
+and the city table file (see city_index.csv_source) its cities came from, so
+tables older than their zarr file or built for other cities are not used.
+"""
+import os
+import json
+import numpy as np
+import xarray as xr
+
+from grid_index import load_grid_index, nearest_cells, grid_dims
+
+CITY_TABLE_INFO = 'city_tables.json'
+CITY_IDS_FILE = 'city_ids.npy'
+# Maximum bytes of cell values read at once while writing a table
+BAND_MEMORY_BUDGET = 64 * 1024**2
+
+
+def table_name(experiment_key, product='monthly'):
+    """Returns the name of the table of a dataset and temporal product."""
+    return 'city_series_' + experiment_key + '_' + product
+
+
+def source_entry(store_path):
+    """Describes the zarr file a table is extracted from."""
+    return {'store': os.path.basename(os.path.normpath(store_path)),
+            'mtime': os.path.getmtime(store_path)}
+
+
+def cell_series(data, stat_names, cell_ilat, cell_ilon):
+    """Reads the time series of the statistics at a set of grid cells.
+
+    Args:
+        data: Dataset of the statistics on a grid.
+        stat_names: List of the string names of the statistics to read.
+        cell_ilat, cell_ilon: Integer arrays of the indices of the cells.
+    Returns:
+        values: Numpy float32 array of shape (number of cells, number of
+                statistics, number of times).
+    """
+    indexers = dict(zip(grid_dims(data),
+                        [xr.DataArray(cell_ilat, dims='points'),
+                         xr.DataArray(cell_ilon, dims='points')]))
+    values = np.empty((len(cell_ilat), len(stat_names), data.sizes['time']),
+                      dtype=np.float32)
+    for j, stat_name in enumerate(stat_names):
+        values[:, j, :] = data[stat_name].isel(indexers).transpose('points', 'time').values
+    return values
+
+
+def write_city_table(out_dir, name, data, stat_names, city_lats, city_lons, index_dir,
+                     memory_budget=BAND_MEMORY_BUDGET):
+    """Writes the table of the statistics at every city for one dataset.
+
+    Cities in the same grid cell share the values read for the cell. The
+    cells are read in bands of up to memory_budget bytes, in grid order, and
+    each band is copied straight to the rows of its cities in the
+    memory-mapped table, so only one band is held in memory at a time.
+
+    Args:
+        out_dir: String path of the directory of the tables.
+        name: String name of the table (see table_name).
+        data: Dataset of the statistics on a grid (series chunk layout).
+        stat_names: List of the string names of the statistics to write.
+        city_lats, city_lons: Numpy arrays of the city coordinates, in the
+                              order of the city ids.
+        index_dir: String path of the directory of the grid indexes.
+        memory_budget: Integer bytes of cell values to read at once.
+    """
+    index = load_grid_index(data['lat'].values, data['lon'].values, index_dir)
+    [ilat, ilon] = nearest_cells(index, city_lats, city_lons)
+    [cells, city_cells] = np.unique(np.ravel_multi_index([ilat, ilon], index['shape']),
+                                    return_inverse=True)
+    [cell_ilat, cell_ilon] = np.unravel_index(cells, index['shape'])
+    # Cities sorted by cell, so the cities of a band of cells are contiguous
+    city_order = np.argsort(city_cells, kind='stable')
+    sorted_cells = city_cells[city_order]
+    row_shape = (len(stat_names), data.sizes['time'])
+    band_size = max(memory_budget // (4*row_shape[0]*row_shape[1] or 1), 1)
+
+    tmp_filename = out_dir + name + '.' + str(os.getpid()) + '.tmp.npy'
+    table = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=np.float32,
+                                      shape=(len(city_lats),) + row_shape)
+    for cell0 in range(0, len(cells), band_size):
+        cellf = min(cell0 + band_size, len(cells))
+        values = cell_series(data, stat_names, cell_ilat[cell0:cellf], cell_ilon[cell0:cellf])
+        [city0, cityf] = np.searchsorted(sorted_cells, [cell0, cellf])
+        band_cities = city_order[city0:cityf]
+        table[band_cities] = values[city_cells[band_cities] - cell0]
+    table.flush()
+    del table
+    os.replace(tmp_filename, out_dir + name + '.npy')
+    np.save(out_dir + name + '_time.npy', data['time'].values)
+
+
+def build_city_tables(filenames, city_ids, city_lats, city_lons, out_dir,
+                      index_dir, stat_names, print_statements_on=False,
+                      cities_source=None):
+    """Writes the tables of the statistics at every city.
+
+    Args:
+        filenames: Dictionary of (experiment key, product) to the string path
+                   of the zarr file (series chunk layout) of the statistics.
+        city_ids: Integer array of the city ids.
+        city_lats, city_lons: Numpy arrays of the city coordinates.
+        out_dir: String path of the directory of the tables.
+        index_dir: String path of the directory of the grid indexes.
+        stat_names: List of the string names of the statistics to write, of
+                    those each zarr file has (e.g. observations only 'mean').
+        print_statements_on: Boolean of whether to print progress.
+        cities_source: Array of the size and modification time of the city
+                       table file of the cities (see city_index.csv_source).
+    Returns:
+        info: Dictionary of table name to its statistics and sources.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    order = np.argsort(city_ids, kind='stable')
+    np.save(out_dir + CITY_IDS_FILE, np.asarray(city_ids)[order])
+
+    info = dict()
+    for [experiment_key, product], filename in filenames.items():
+        if not os.path.exists(filename):
+            continue
+        data = xr.open_zarr(filename)
+        name = table_name(experiment_key, product)
+        table_stats = [stat_name for stat_name in stat_names if stat_name in data]
+        write_city_table(out_dir, name, data, table_stats,
+                         np.asarray(city_lats)[order], np.asarray(city_lons)[order],
+                         index_dir)
+        info[name] = {'stats': table_stats, 'source': source_entry(filename)}
+        if cities_source is not None:
+            info[name]['cities'] = np.asarray(cities_source).tolist()
+        if print_statements_on:
+            print('Wrote ' + name)
+
+    # Written to a temporary file first, so readers never see a partial file
+    tmp_filename = out_dir + CITY_TABLE_INFO + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filename, 'w') as info_file:
+        json.dump(info, info_file, indent=1, sort_keys=True)
+    os.replace(tmp_filename, out_dir + CITY_TABLE_INFO)
+    return info
+
+
+def read_city_table_info(out_dir):
+    """Reads the statistics and sources of the tables (empty if none were built)."""
+    if not os.path.isfile(out_dir + CITY_TABLE_INFO):
+        return dict()
+    with open(out_dir + CITY_TABLE_INFO, 'r') as info_file:
+        return json.load(info_file)
+
+
+def load_city_table(out_dir, name, info, store_path, cities_source=None):
+    """Memory-maps a table, if it is up to date with its zarr file and cities.
+
+    Args:
+        out_dir: String path of the directory of the tables.
+        name: String name of the table.
+        info: Dictionary of the tables (see read_city_table_info).
+        store_path: String path of the zarr file the table was extracted from.
+        cities_source: Array of the size and modification time of the current
+                       city table file (None to not check the cities).
+    Returns:
+        table: Dictionary with the memory-mapped 'values', the 'time' array,
+               and the 'stats' names, or None if there is no up to date table.
+    """
+    if name not in info or not os.path.exists(store_path):
+        return None
+    if info[name]['source'] != source_entry(store_path):
+        return None
+    if cities_source is not None and \
+            not np.array_equal(info[name].get('cities'), cities_source):
+        return None
+    return {'values': np.load(out_dir + name + '.npy', mmap_mode='r'),
+            'time': np.load(out_dir + name + '_time.npy'),
+            'stats': info[name]['stats']}
+
+
+def city_rows(sorted_city_ids, city_ids):
+    """Returns the table rows of one or more city ids (empty for no ids).
+
+    Raises:
+        KeyError: If a city id is not in the tables.
+    """
+    rows = np.searchsorted(sorted_city_ids, city_ids)
+    if np.size(rows) == 0:
+        return rows
+    rows = np.minimum(rows, len(sorted_city_ids) - 1)
+    if len(sorted_city_ids) == 0 or np.any(sorted_city_ids[rows] != city_ids):
+        raise KeyError('City id not in the city tables: ' + str(city_ids))
+    return rows
@@ -0,0 +1,116 @@
+"""
+grid_index.py
+
+Spatial index of the grid cells of the processed data, so that the nearest
+grid cell to a point (e.g. a city) is found without searching the lat and lon
+coordinates of every dataset.
+
+The cell centers are put on the unit sphere and into a KD-tree, so distances
+do not depend on the longitude convention (0 to 360 or -180 to 180) and the
+grid can be curvilinear (2D lat and lon). The index is built once per grid and
+saved, under a hash of the grid's coordinates, next to the processed data.
+
+Needs phase1_data_wrangler on the path (see util_panel.py).
+"""
+import os
+import pickle
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+
+from sparse_regrid import latlon_to_xyz
+
+
+def grid_key(lats, lons):
+    """Returns a short hash identifying a grid by its lat and lon coordinates."""
+    hasher = hashlib.sha1()
+    for coord in [lats, lons]:
+        values = np.ascontiguousarray(np.asarray(coord), dtype=np.float64)
+        hasher.update(str(values.shape).encode())
+        hasher.update(values.tobytes())
+    return hasher.hexdigest()[0:16]
+
+
+def index_file_path(key, index_dir):
+    """Returns the path of the saved index of the grid with this key."""
+    return index_dir + 'grid_index_' + key + '.pkl'
+
+
+def build_grid_index(lats, lons):
+    """Builds the nearest grid cell index of a grid.
+
+    Args:
+        lats: Numpy array of the cell center latitudes, either 1D (rectilinear
+              grid) or 2D (curvilinear grid, same shape as lons).
+        lons: Numpy array of the cell center longitudes (any convention).
+    Returns:
+        index: Dictionary with the grid's 'key', the 'shape' of its (lat, lon)
+               or (y, x) dimensions, and the KD-tree 'tree' of its cells.
+    """
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    key = grid_key(lats, lons)
+    if lats.ndim == 1:
+        [lons, lats] = np.meshgrid(lons, lats)
+    return {'key': key,
+            'shape': lats.shape,
+            'tree': cKDTree(latlon_to_xyz(lats, lons))}
+
+
+def save_grid_index(index, index_dir):
+    """Atomically saves a grid index to index_dir."""
+    os.makedirs(index_dir, exist_ok=True)
+    filename = index_file_path(index['key'], index_dir)
+    tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filename, 'wb') as index_file:
+        pickle.dump(index, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
+
+
+def load_grid_index(lats, lons, index_dir):
+    """Loads the saved index of a grid, building and saving it if needed.
+
+    Args:
+        lats, lons: Numpy arrays of the cell centers (see build_grid_index).
+        index_dir: String path of the directory of the saved indexes.
+    Returns:
+        index: The grid index.
+    """
+    filename = index_file_path(grid_key(lats, lons), index_dir)
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as index_file:
+            return pickle.load(index_file)
+    index = build_grid_index(lats, lons)
+    try:
+        save_grid_index(index, index_dir)
+    except OSError:
+        # The index still works for this session if it cannot be saved
+        pass
+    return index
+
+
+def grid_dims(data):
+    """Returns the names of the (lat, lon) dimensions of a dataset, which are
+    (y, x)-like dimensions for curvilinear grids."""
+    if data['lat'].ndim == 1:
+        return [data['lat'].dims[0], data['lon'].dims[0]]
+    return list(data['lat'].dims)
+
+
+def nearest_cells(index, lat, lon):
+    """Finds the grid cells nearest to one or more points.
+
+    Args:
+        index: The grid index (see build_grid_index).
+        lat: Latitude of the point, or array of latitudes.
+        lon: Longitude of the point (any convention), or array of longitudes.
+    Returns:
+        ilat: Integer index (or array of indices) of the cells along the first
+              grid dimension (lat, or y for curvilinear grids).
+        ilon: Integer index (or array of indices) along the second dimension.
+    """
+    [_, nearest] = index['tree'].query(latlon_to_xyz(lat, lon))
+    [ilat, ilon] = np.unravel_index(nearest, index['shape'])
+    if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+        return [int(ilat[0]), int(ilon[0])]
+    return [ilat.reshape(np.shape(lat)), ilon.reshape(np.shape(lon))]
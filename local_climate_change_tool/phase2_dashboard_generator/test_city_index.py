@@ -0,0 +1,131 @@
+"""
+test_city_index.py
+
+Contains the test class for city_index.py.
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+# The dashboard modules are imported the way util_panel.py imports them
+DIR_DASHBOARD = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, DIR_DASHBOARD)
+import city_index
+from city_index import build_city_index, load_city_index, country_rows, \
+    city_rows, country_cities, country2city2latlon
+
+# A small city table with the columns of worldcities.csv that are indexed
+# (not sorted, with two cities of the same name in one country and a missing
+# population)
+CITY_CSV = '''city,city_ascii,lat,lng,country,admin_name,population,id
+São Paulo,Sao Paulo,-23.5504,-46.6339,Brazil,São Paulo,22046000,1076532519
+New York,New York,40.6943,-73.9249,United States,New York,18972871,1840034016
+Kraków,Krakow,50.0614,19.9372,Poland,Małopolskie,766683,1616172264
+Portland,Portland,45.5371,-122.6500,United States,Oregon,2036875,1840019941
+Portland,Portland,43.6773,-70.2715,United States,Maine,,1840000327
+Brasília,Brasilia,-15.7939,-47.8828,Brazil,Distrito Federal,3015268,1076144436
+'''
+NEW_CITY = 'Gdańsk,Gdansk,54.3475,18.6453,Poland,Pomorskie,470907,1616406700\n'
+
+
+def write_city_csv(csv_file, text=CITY_CSV):
+    """Writes a city table to csv_file."""
+    with open(csv_file, 'w', encoding='utf-8') as city_file:
+        city_file.write(text)
+
+
+def legacy_country2city2latlon(csv_file):
+    """Builds the country to city to [lat, lon] dictionary with the loop
+    util_panel.py used before the city index."""
+    cities = pd.read_csv(csv_file)
+    my_dict = dict()
+    for country in cities['country'].unique():
+        my_dict.update({country: dict()})
+    for i in range(len(cities)):
+        latlon = [cities['lat'].values[i], cities['lng'].values[i]]
+        my_dict[cities['country'].values[i]].update({cities['city_ascii'].values[i]: latlon})
+    return my_dict
+
+
+class TestCityIndex(unittest.TestCase):
+    """Test class for city_index.py"""
+
+    def test_country2city2latlon(self):
+        """Tests that the nested dictionary matches the legacy loop."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            csv_file = data_dir + '/cities.csv'
+            write_city_csv(csv_file)
+            index = build_city_index(csv_file)
+            self.assertEqual(country2city2latlon(index), legacy_country2city2latlon(csv_file))
+            self.assertEqual(index['countries'].tolist(),
+                             ['Brazil', 'Poland', 'United States'])
+            self.assertEqual(index['population'][index['admin_name'] == 'Maine'][0], 0)
+
+    def test_country_rows(self):
+        """Tests the rows of a country and that unknown countries raise KeyError."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            csv_file = data_dir + '/cities.csv'
+            write_city_csv(csv_file)
+            index = build_city_index(csv_file)
+            [names, ids, _, _] = country_cities(index, 'Brazil')
+            self.assertEqual(names.tolist(), ['Brasilia', 'Sao Paulo'])
+            self.assertEqual(ids.tolist(), [1076144436, 1076532519])
+            rows = country_rows(index, 'United States')
+            self.assertEqual(index['admin_name'][rows].tolist(), ['New York', 'Oregon', 'Maine'])
+            for country in ['France', 'Aaa', 'Zzz', 'brazil']:
+                with self.assertRaises(KeyError):
+                    country_rows(index, country)
+
+    def test_city_rows(self):
+        """Tests looking up the rows of several city ids at once."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            csv_file = data_dir + '/cities.csv'
+            write_city_csv(csv_file)
+            index = build_city_index(csv_file)
+            city_ids = np.array([1840000327, 1616172264, 1076532519, 1840000327])
+            rows = city_rows(index, city_ids)
+            self.assertTrue((index['id'][rows] == city_ids).all())
+            self.assertEqual(index['city'][rows].tolist(),
+                             ['Portland', 'Kraków', 'São Paulo', 'Portland'])
+            self.assertEqual(index['id'][city_rows(index, 1616172264)], 1616172264)
+            with self.assertRaises(KeyError):
+                city_rows(index, [1616172264, 1])
+            with self.assertRaises(KeyError):
+                city_rows(index, 9999999999)
+
+    def test_load_city_index(self):
+        """Tests that the saved index is reused until the city table changes."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            csv_file = data_dir + '/cities.csv'
+            index_file = data_dir + '/indexes/city_index.npz'
+            write_city_csv(csv_file)
+            index = load_city_index(csv_file, index_file)
+            self.assertTrue(os.path.isfile(index_file))
+            with mock.patch.object(city_index, 'build_city_index',
+                                   side_effect=AssertionError('rebuilt')):
+                loaded = load_city_index(csv_file, index_file)
+            self.assertEqual(loaded['city'].tolist(), index['city'].tolist())
+
+            # A new modification time rebuilds the index
+            mtime = os.path.getmtime(csv_file)
+            os.utime(csv_file, (mtime + 10, mtime + 10))
+            with mock.patch.object(city_index, 'build_city_index',
+                                   wraps=build_city_index) as build:
+                load_city_index(csv_file, index_file)
+            self.assertEqual(build.call_count, 1)
+
+            # So does a new size, and the new city is found
+            write_city_csv(csv_file, CITY_CSV + NEW_CITY)
+            index = load_city_index(csv_file, index_file)
+            self.assertEqual(index['city_ascii'][country_rows(index, 'Poland')].tolist(),
+                             ['Gdansk', 'Krakow'])
+            self.assertEqual(load_city_index(csv_file, index_file)['id'].tolist(),
+                             index['id'].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+test_city_search.py
+
+Contains the test class for city_search.py.
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+# The dashboard modules are imported the way util_panel.py imports them
+DIR_DASHBOARD = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, DIR_DASHBOARD)
+import city_search
+from city_search import build_city_search, load_city_search, search_cities, \
+    key_range, rank_rows
+from city_index import build_city_index
+
+# A small city table with the columns of worldcities.csv that are indexed
+CITY_CSV = '''city,city_ascii,lat,lng,country,admin_name,population,id
+São Pedro,Sao Pedro,-22.5483,-47.9136,Brazil,São Paulo,35980,1076000001
+New York,New York,40.6943,-73.9249,United States,New York,18972871,1840034016
+York,York,53.9583,-1.0803,United Kingdom,York,153717,1826000001
+São Paulo,Sao Paulo,-23.5504,-46.6339,Brazil,São Paulo,22046000,1076532519
+Yorkton,Yorkton,51.2139,-102.4628,Canada,Saskatchewan,16343,1124000001
+Saint-Étienne,Saint-Etienne,45.4347,4.3903,France,Auvergne-Rhône-Alpes,173821,1250000001
+Paris,Paris,48.8567,2.3522,France,Île-de-France,11060000,1250015082
+Parintins,Parintins,-2.6283,-56.7358,Brazil,Amazonas,,1076000002
+'''
+
+
+def make_city_index(data_dir):
+    """Writes the test city table to data_dir and builds its city index."""
+    csv_file = data_dir + '/cities.csv'
+    with open(csv_file, 'w', encoding='utf-8') as city_file:
+        city_file.write(CITY_CSV)
+    return build_city_index(csv_file)
+
+
+def found_cities(index, search, text, top_k=10):
+    """Returns the city names found for text."""
+    return index['city'][search_cities(search, text, top_k)].tolist()
+
+
+class TestCitySearch(unittest.TestCase):
+    """Test class for city_search.py"""
+
+    def test_accents_and_case(self):
+        """Tests that prefixes match whatever their accents and case."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            index = make_city_index(data_dir)
+            search = build_city_search(index)
+            for text in ['sao p', 'São P', 'SAO  P', 'são p']:
+                self.assertEqual(found_cities(index, search, text), ['São Paulo', 'São Pedro'])
+            self.assertEqual(found_cities(index, search, 'São'), ['São Paulo', 'São Pedro'])
+            self.assertEqual(found_cities(index, search, 'saint etienne'), ['Saint-Étienne'])
+            self.assertEqual(found_cities(index, search, 'ile-de'), ['Paris'])
+            self.assertEqual(found_cities(index, search, 'sao x'), [])
+
+    def test_word_start(self):
+        """Tests that every word of a name starts a match, but not other letters."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            index = make_city_index(data_dir)
+            search = build_city_search(index)
+            self.assertEqual(found_cities(index, search, 'york'),
+                             ['New York', 'York', 'Yorkton'])
+            self.assertEqual(found_cities(index, search, 'etienne'), ['Saint-Étienne'])
+            self.assertEqual(found_cities(index, search, 'ork'), [])
+
+    def test_population_order(self):
+        """Tests that the most populous matches come first, up to top_k."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            index = make_city_index(data_dir)
+            search = build_city_search(index)
+            rows = search_cities(search, 'p')
+            self.assertEqual(index['city'][rows].tolist(),
+                             ['São Paulo', 'Paris', 'São Pedro', 'Parintins'])
+            self.assertTrue((np.diff(index['population'][rows]) <= 0).all())
+            self.assertEqual(found_cities(index, search, 'p', top_k=2), ['São Paulo', 'Paris'])
+            self.assertEqual(len(search_cities(search, '')), len(index['city']))
+
+    def test_ranked_prefixes(self):
+        """Tests that the prefixes ranked in advance give the slow path's matches."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            index = make_city_index(data_dir)
+            search = build_city_search(index)
+            unranked = dict(search, ranked=dict())
+            self.assertIn('sa', search['ranked'])
+            for prefix in search['ranked']:
+                for top_k in [1, 3, 10]:
+                    expected = rank_rows(search['rows'][key_range(search, prefix)],
+                                         search['population'], top_k)
+                    self.assertEqual(search_cities(search, prefix, top_k).tolist(),
+                                     expected.tolist())
+                    self.assertEqual(search_cities(unranked, prefix, top_k).tolist(),
+                                     expected.tolist())
+
+    def test_load_city_search(self):
+        """Tests that the saved index is reused until the cities change."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            index = make_city_index(data_dir)
+            search_file = data_dir + '/indexes/city_search.pkl'
+            search = load_city_search(index, search_file)
+            self.assertTrue(os.path.isfile(search_file))
+            with mock.patch.object(city_search, 'build_city_search',
+                                   side_effect=AssertionError('rebuilt')):
+                loaded = load_city_search(index, search_file)
+            self.assertEqual(loaded['keys'], search['keys'])
+
+            index['source'] = index['source'] + 1
+            with mock.patch.object(city_search, 'build_city_search',
+                                   wraps=build_city_search) as build:
+                rebuilt = load_city_search(index, search_file)
+            self.assertEqual(build.call_count, 1)
+            self.assertTrue(np.array_equal(rebuilt['source'], index['source']))
+            self.assertTrue(np.array_equal(load_city_search(index, search_file)['source'],
+                                           index['source']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+"""
+test_city_table.py
+
+Contains the test class for city_table.py.
+"""
+import os
+import sys
+import tempfile
+import unittest
+import xarray as xr
+import numpy as np
+import pandas as pd
+
+# The dashboard modules are imported the way util_panel.py imports them
+DIR_DASHBOARD = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, DIR_DASHBOARD)
+sys.path.insert(0, os.path.join(DIR_DASHBOARD, '..', 'phase1_data_wrangler'))
+from city_table import table_name, write_city_table, build_city_tables, \
+    read_city_table_info, load_city_table, city_rows
+from grid_index import build_grid_index, nearest_cells
+
+STAT_NAMES = ['mean', 'std']
+TIMES = pd.date_range(start='1850-01-15', periods=24, freq='MS') + pd.Timedelta(days=14)
+DS = xr.Dataset({'mean': (['time', 'lat', 'lon'], np.random.rand(24, 18, 20)),
+                 'std': (['time', 'lat', 'lon'], np.random.rand(24, 18, 20))},
+                coords={'time': TIMES,
+                        'lat': np.linspace(-85., 85., 18),
+                        'lon': np.linspace(0., 342., 20)})
+DS['mean'][0, 0, 0] = np.nan
+# Cities (not in id order); the first two share a grid cell, and the last is
+# in the cell with the NaN
+CITY_IDS = np.array([30, 10, 20, 50, 40])
+CITY_LATS = np.array([40.1, 41.2, -33.9, 60., -85.])
+CITY_LONS = np.array([-74., -73.5, 151.2, 10.7, 1.])
+CITIES_SOURCE = np.array([1234., 1.5e9])
+
+
+def expected_series(city_lats, city_lons):
+    """Selects the statistics at the nearest cells of the cities with isel."""
+    [ilat, ilon] = nearest_cells(build_grid_index(DS['lat'].values, DS['lon'].values),
+                                 city_lats, city_lons)
+    return np.stack([np.stack([DS[stat_name].isel(lat=ilat[i], lon=ilon[i]).values
+                               for stat_name in STAT_NAMES])
+                     for i in range(len(city_lats))])
+
+
+class TestCityTable(unittest.TestCase):
+    """Test class for city_table.py"""
+
+    def test_write_city_table(self):
+        """Tests that each row of a table is the series at the city's cell."""
+        with tempfile.TemporaryDirectory() as out_dir:
+            out_dir = out_dir + '/'
+            write_city_table(out_dir, 'test', DS, STAT_NAMES, CITY_LATS, CITY_LONS, out_dir)
+            table = np.load(out_dir + 'test.npy')
+            self.assertEqual(table.shape, (5, 2, 24))
+            self.assertEqual(table.dtype, np.float32)
+            expected = expected_series(CITY_LATS, CITY_LONS)
+            self.assertTrue(np.allclose(table, expected, equal_nan=True))
+            self.assertTrue(np.array_equal(table[0], table[1]))
+            self.assertTrue(np.isnan(table[4, 0, 0]))
+            self.assertTrue((np.load(out_dir + 'test_time.npy') == DS['time'].values).all())
+
+    def test_write_in_bands(self):
+        """Tests that tables read a few cells at a time match one read at once."""
+        with tempfile.TemporaryDirectory() as out_dir:
+            out_dir = out_dir + '/'
+            write_city_table(out_dir, 'test', DS, STAT_NAMES, CITY_LATS, CITY_LONS, out_dir,
+                             memory_budget=1)
+            self.assertTrue(np.allclose(np.load(out_dir + 'test.npy'),
+                                        expected_series(CITY_LATS, CITY_LONS), equal_nan=True))
+            write_city_table(out_dir, 'empty', DS, STAT_NAMES, CITY_LATS[:0], CITY_LONS[:0],
+                             out_dir)
+            self.assertEqual(np.load(out_dir + 'empty.npy').shape, (0, 2, 24))
+            self.assertFalse(any('.tmp' in filename for filename in os.listdir(out_dir)))
+
+    def test_load_city_table(self):
+        """Tests that tables are read by city id, and not used once stale."""
+        with tempfile.TemporaryDirectory() as out_dir:
+            out_dir = out_dir + '/'
+            store_path = out_dir + 'test.zarr'
+            DS.to_zarr(store_path)
+            name = table_name('ssp126')
+            info = build_city_tables({('ssp126', 'monthly'): store_path,
+                                      ('ssp585', 'monthly'): out_dir + 'missing.zarr'},
+                                     CITY_IDS, CITY_LATS, CITY_LONS, out_dir, out_dir,
+                                     STAT_NAMES + ['min'], cities_source=CITIES_SOURCE)
+            self.assertEqual(list(info), [name])
+            self.assertEqual(read_city_table_info(out_dir), info)
+            self.assertFalse(any(filename.endswith('.tmp') for filename in os.listdir(out_dir)))
+            self.assertEqual(info[name]['stats'], STAT_NAMES)
+
+            table = load_city_table(out_dir, name, info, store_path, CITIES_SOURCE)
+            sorted_ids = np.load(out_dir + 'city_ids.npy')
+            rows = city_rows(sorted_ids, CITY_IDS)
+            self.assertTrue(np.allclose(table['values'][rows],
+                                        expected_series(CITY_LATS, CITY_LONS), equal_nan=True))
+            self.assertEqual(table['stats'], STAT_NAMES)
+            with self.assertRaises(KeyError):
+                city_rows(sorted_ids, 60)
+            self.assertEqual(len(city_rows(sorted_ids, np.array([], dtype=int))), 0)
+            self.assertEqual(len(city_rows(sorted_ids[:0], [])), 0)
+
+            # Tables built for other cities are not used
+            self.assertIsNone(load_city_table(out_dir, name, info, store_path,
+                                              CITIES_SOURCE + 1))
+            self.assertIsNone(load_city_table(out_dir, table_name('ssp585'), info,
+                                              out_dir + 'missing.zarr'))
+
+            # Tables older than their zarr file are not used
+            mtime = os.path.getmtime(store_path)
+            os.utime(store_path, (mtime + 10, mtime + 10))
+            self.assertIsNone(load_city_table(out_dir, name, info, store_path, CITIES_SOURCE))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+test_grid_index.py
+
+Contains the test class for grid_index.py.
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+# The dashboard modules are imported the way util_panel.py imports them
+DIR_DASHBOARD = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, DIR_DASHBOARD)
+sys.path.insert(0, os.path.join(DIR_DASHBOARD, '..', 'phase1_data_wrangler'))
+import grid_index
+from grid_index import build_grid_index, load_grid_index, nearest_cells, \
+    index_file_path
+from sparse_regrid import latlon_to_xyz
+
+# A 5 degree grid with 0 to 360 longitudes
+GRID_LATS = np.arange(-87.5, 90., 5.)
+GRID_LONS = np.arange(2.5, 360., 5.)
+NUM_POINTS = 50
+
+
+def random_points(num_points=NUM_POINTS):
+    """Returns random latitudes and -180 to 180 longitudes."""
+    rng = np.random.default_rng(0)
+    return [rng.uniform(-85., 85., num_points), rng.uniform(-180., 180., num_points)]
+
+
+def brute_force_cells(lats, lons, point_lats, point_lons):
+    """Finds the nearest cells of a 2D grid by comparing every distance."""
+    cells = latlon_to_xyz(lats, lons)
+    points = latlon_to_xyz(point_lats, point_lons)
+    nearest = np.argmin(((points[:, np.newaxis, :] - cells[np.newaxis, :, :])**2).sum(axis=2),
+                        axis=1)
+    return np.unravel_index(nearest, lats.shape)
+
+
+class TestGridIndex(unittest.TestCase):
+    """Test class for grid_index.py"""
+
+    def test_scalar_and_batched(self):
+        """Tests that one point at a time and a batch give the same cells."""
+        index = build_grid_index(GRID_LATS, GRID_LONS)
+        [point_lats, point_lons] = random_points()
+        [ilat, ilon] = nearest_cells(index, point_lats, point_lons)
+        self.assertEqual([ilat.shape, ilon.shape], [(NUM_POINTS,), (NUM_POINTS,)])
+        for i in range(NUM_POINTS):
+            cell = nearest_cells(index, point_lats[i], point_lons[i])
+            self.assertTrue(all(isinstance(value, int) for value in cell))
+            self.assertEqual(cell, [ilat[i], ilon[i]])
+
+        [lons2d, lats2d] = np.meshgrid(GRID_LONS, GRID_LATS)
+        [exp_ilat, exp_ilon] = brute_force_cells(lats2d, lons2d, point_lats, point_lons)
+        self.assertTrue((ilat == exp_ilat).all())
+        self.assertTrue((ilon == exp_ilon).all())
+
+    def test_longitude_conventions(self):
+        """Tests that 0 to 360 and -180 to 180 longitudes give the same cells."""
+        index = build_grid_index(GRID_LATS, GRID_LONS)
+        [point_lats, point_lons] = random_points()
+        [ilat, ilon] = nearest_cells(index, point_lats, point_lons)
+        [ilat_360, ilon_360] = nearest_cells(index, point_lats, point_lons % 360)
+        self.assertTrue((ilat == ilat_360).all())
+        self.assertTrue((ilon == ilon_360).all())
+        self.assertEqual(nearest_cells(index, 2., -177.), nearest_cells(index, 2., 183.))
+        self.assertEqual(nearest_cells(index, 2., -177.), [18, 36])
+
+    def test_curvilinear_grid(self):
+        """Tests the nearest cells of a 2D (curvilinear) grid."""
+        [x, y] = np.meshgrid(np.arange(0., 360., 6.), np.arange(-84., 90., 6.))
+        lats = y + 2.*np.sin(np.deg2rad(x))
+        lons = x + 3.*np.cos(np.deg2rad(y))
+        index = build_grid_index(lats, lons)
+        self.assertEqual(index['shape'], lats.shape)
+        [point_lats, point_lons] = random_points()
+        [ilat, ilon] = nearest_cells(index, point_lats, point_lons)
+        [exp_ilat, exp_ilon] = brute_force_cells(lats, lons, point_lats, point_lons)
+        self.assertTrue((ilat == exp_ilat).all())
+        self.assertTrue((ilon == exp_ilon).all())
+
+    def test_load_grid_index(self):
+        """Tests that a saved index is loaded instead of being rebuilt."""
+        with tempfile.TemporaryDirectory() as index_dir:
+            index_dir = index_dir + '/'
+            index = load_grid_index(GRID_LATS, GRID_LONS, index_dir)
+            self.assertTrue(os.path.isfile(index_file_path(index['key'], index_dir)))
+            with mock.patch.object(grid_index, 'build_grid_index',
+                                   side_effect=AssertionError('rebuilt')):
+                loaded = load_grid_index(GRID_LATS, GRID_LONS, index_dir)
+            self.assertEqual(loaded['key'], index['key'])
+            self.assertEqual(nearest_cells(loaded, 40., 100.), nearest_cells(index, 40., 100.))
+            self.assertEqual(os.listdir(index_dir), ['grid_index_' + index['key'] + '.pkl'])
+
+            # A different grid has its own index
+            other = load_grid_index(GRID_LATS[1:], GRID_LONS, index_dir)
+            self.assertNotEqual(other['key'], index['key'])
+            self.assertEqual(len(os.listdir(index_dir)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,47 +4,270 @@ util_panel.py
 Module of functions for creating data that the climate_dashboard panel reads in.
 """
 
+import os
 import sys
-import pandas as pd
+import numpy as np
 import xarray as xr
 
 
 DIR_ANALYSIS = '../phase1_data_wrangler'
 sys.path.insert(0, DIR_ANALYSIS)
 import analysis_parameters
+from grid_index import load_grid_index, nearest_cells, grid_dims
+import city_table
+import city_index
+import city_search
 
 
-DF = pd.read_csv('worldcities.csv')
-COUNTRIES = list(set(DF['country']))
+CITY_FILE = 'worldcities.csv'
+CITY_INDEX_FILE = analysis_parameters.DIR_DASHBOARD_INDEXES + 'city_index.npz'
+# The city index, loaded on first access (see get_city_index)
+CITY_INDEX = dict()
+CITY_SEARCH_FILE = analysis_parameters.DIR_DASHBOARD_INDEXES + 'city_search.pkl'
+# The city search index, loaded on first access (see get_city_search)
+CITY_SEARCH = dict()
 THIS_EXPERIMENT_ID = ['historical', 'ssp126', 'ssp370', 'ssp245', 'ssp585']
 EXPERIMENT_KEYS = THIS_EXPERIMENT_ID.copy()
 EXPERIMENT_KEYS.append('historical_obs')
+DATA_BY_LAYOUT = dict()
+# Grid index of each dataset's grid (see get_grid_index)
+GRID_INDEXES = dict()
+# Statistics kept in the tables of the time series at every city
+CITY_STATS = ['mean', 'min', 'max', 'std']
+# City tables of each data key and product, None where there is no up to
+# date table (see get_city_table)
+CITY_TABLES = dict()
 
 
-def read_data():
+def layout_filename(filename, layout):
+    """Returns the name of the zarr file with the given chunk layout."""
+    return filename[:-len('.zarr')] + analysis_parameters.LAYOUT_SUFFIXES[layout] + '.zarr'
+
+
+def product_filename(filename, product):
+    """Returns the name of the zarr file of a temporal product (e.g. 'annual')."""
+    return filename[:-len('.zarr')] + analysis_parameters.PRODUCT_SUFFIXES[product] + '.zarr'
+
+
+def data_filenames(layout='series', product='monthly'):
+    """Returns a dictionary of the zarr file of each data key (see read_data),
+    falling back to the 'series' files if the layout was not saved."""
+    data_path = analysis_parameters.DIR_PROCESSED_DATA
+    filenames = dict()
+    # Model data
+    for experiment_id in THIS_EXPERIMENT_ID:
+        filenames[experiment_id] = (data_path + 'model_data/modelData_tas_' +
+                                    experiment_id + '.zarr')
+    # Observation data
+    filenames['historical_obs'] = data_path + 'observation_data/historical_obs.zarr'
+
+    for key, filename in filenames.items():
+        filename = product_filename(filename, product)
+        if os.path.exists(layout_filename(filename, layout)):
+            filename = layout_filename(filename, layout)
+        filenames[key] = filename
+    return filenames
+
+
+def read_data(layout='series', product='monthly'):
     """Reads in the data.
 
     Reads in the data and returns a dictionary for data_type with keys
     'historical', 'ssp126', 'ssp370', 'ssp245', 'ssp585', and 'historical_obs'.
 
+    Args:
+        layout: String name of the chunk layout to read: 'series' (fast for
+                time series at a point) or 'map' (fast for maps at one time).
+                Falls back to 'series' files if the layout was not saved.
+        product: String name of the time means to read: 'monthly', or one of
+                 analysis_parameters.TEMPORAL_PRODUCTS (e.g. 'annual',
+                 'seasonal', 'climatology30').
     Returns:
         dict_timeseries: The data_type dictionary.
     """
     dict_timeseries = dict()
-    data_path = analysis_parameters.DIR_PROCESSED_DATA
-    # Read in model data
-    for experiment_id in THIS_EXPERIMENT_ID:
-        filename = data_path + 'model_data/modelData_tas_' + experiment_id + '.zarr'
-        data = xr.open_zarr(filename)
-        dict_timeseries[experiment_id] = data
-    # Read in observation data
-    filename = data_path + 'observation_data/historical_obs.zarr'
-    data = xr.open_zarr(filename)
-    dict_timeseries['historical_obs'] = data
+    for key, filename in data_filenames(layout, product).items():
+        dict_timeseries[key] = xr.open_zarr(filename)
 
     return dict_timeseries
 
 
+def get_data(layout='series', product='monthly'):
+    """Returns the data dictionary for a chunk layout and temporal product,
+    reading it in only once."""
+    if (layout, product) not in DATA_BY_LAYOUT:
+        DATA_BY_LAYOUT[(layout, product)] = read_data(layout, product)
+    return DATA_BY_LAYOUT[(layout, product)]
+
+
+def get_grid_index(experiment_key, product='monthly'):
+    """Returns the nearest grid cell index of a dataset's grid.
+
+    The index is loaded (or built) once per session. It is saved in
+    analysis_parameters.DIR_DASHBOARD_INDEXES, so it is only built once per
+    grid; all datasets on the reference grid share it.
+    """
+    if (experiment_key, product) not in GRID_INDEXES:
+        data = get_data('series', product)[experiment_key]
+        GRID_INDEXES[(experiment_key, product)] = load_grid_index(
+            data['lat'].values, data['lon'].values,
+            analysis_parameters.DIR_DASHBOARD_INDEXES)
+    return GRID_INDEXES[(experiment_key, product)]
+
+
+def nearest_grid_cells(experiment_key, lat, lon, product='monthly'):
+    """Returns the integer [ilat, ilon] indices of the grid cells nearest to
+    one point or to arrays of points (longitudes in either convention)."""
+    return nearest_cells(get_grid_index(experiment_key, product), lat, lon)
+
+
+def select_data(experiment_key, lat=None, lon=None, time=None, product='monthly'):
+    """Selects data, reading from the chunk layout that suits the query.
+
+    Queries for grid cells (lat and lon given) read the 'series' files,
+    which hold all times of a cell in one chunk, and look up the nearest
+    cells in the grid index. Queries for a single time over the globe (only
+    time given) read the 'map' files.
+
+    Args:
+        experiment_key: String key of the data (e.g. 'ssp126', 'historical_obs').
+        lat: Latitude of the grid cell, or array of latitudes (optional).
+        lon: Longitude of the grid cell in degrees east, 0 to 360 or -180 to
+             180, or array of longitudes (optional).
+        time: Time of the map (optional).
+        product: String name of the time means to read (see read_data).
+    Returns:
+        The dataset of the nearest grid cell, time, or both. Arrays of points
+        give a dataset with a 'points' dimension.
+    """
+    if lat is not None and lon is not None:
+        data = get_data('series', product)[experiment_key]
+        [ilat, ilon] = nearest_grid_cells(experiment_key, lat, lon, product)
+        if np.ndim(ilat) > 0:
+            [ilat, ilon] = [xr.DataArray(np.ravel(ilat), dims='points'),
+                            xr.DataArray(np.ravel(ilon), dims='points')]
+        data = data.isel(dict(zip(grid_dims(data), [ilat, ilon])))
+    else:
+        data = get_data('map', product)[experiment_key]
+    if time is not None:
+        data = data.sel(time=time, method='nearest')
+    return data
+
+
+def get_city_index():
+    """Returns the index of the cities of worldcities.csv, loading it only
+    once (and building it only when the CSV changes)."""
+    if not CITY_INDEX:
+        CITY_INDEX.update(city_index.load_city_index(CITY_FILE, CITY_INDEX_FILE))
+    return CITY_INDEX
+
+
+def get_countries():
+    """Returns the sorted list of the countries of the cities."""
+    return get_city_index()['countries'].tolist()
+
+
+def city_latlons(city_ids):
+    """Returns the [lats, lons] of one or more city ids."""
+    index = get_city_index()
+    rows = city_index.city_rows(index, city_ids)
+    return [index['lat'][rows], index['lng'][rows]]
+
+
+def get_city_search():
+    """Returns the typeahead search index of the cities, loading it only once."""
+    if not CITY_SEARCH:
+        CITY_SEARCH.update(city_search.load_city_search(get_city_index(),
+                                                        CITY_SEARCH_FILE))
+    return CITY_SEARCH
+
+
+def search_cities(text, top_k=10):
+    """Finds the most populous cities with a name, region, or country
+    starting with text, ignoring case and accents.
+
+    Args:
+        text: String typed so far (e.g. 'sao p').
+        top_k: Integer maximum number of matches.
+    Returns:
+        city_ids: Integer array of the ids of the matching cities.
+        labels: List of the string labels ('city, region, country') of the
+                matching cities.
+    """
+    index = get_city_index()
+    rows = city_search.search_cities(get_city_search(), text, top_k)
+    labels = [', '.join([index['city'][row], index['admin_name'][row], index['country'][row]])
+              for row in rows]
+    return [index['id'][rows], labels]
+
+
+def build_city_tables(print_statements_on=False):
+    """Writes the tables of the time series at every city of worldcities.csv,
+    for every data key and temporal product, from the 'series' files.
+
+    Run this after the data wrangler, e.g. with python util_panel.py.
+    """
+    filenames = dict()
+    for product in analysis_parameters.PRODUCT_SUFFIXES:
+        for key, filename in data_filenames('series', product).items():
+            filenames[(key, product)] = filename
+    CITY_TABLES.clear()
+    index = get_city_index()
+    return city_table.build_city_tables(filenames, index['id'], index['lat'], index['lng'],
+                                        analysis_parameters.DIR_DASHBOARD_INDEXES,
+                                        analysis_parameters.DIR_DASHBOARD_INDEXES,
+                                        CITY_STATS, print_statements_on,
+                                        cities_source=index['source'])
+
+
+def get_city_table(experiment_key, product='monthly'):
+    """Returns the memory-mapped table of the time series at every city for
+    a data key and product (None if it was not built or is out of date)."""
+    if 'city_ids' not in CITY_TABLES:
+        table_dir = analysis_parameters.DIR_DASHBOARD_INDEXES
+        CITY_TABLES['info'] = city_table.read_city_table_info(table_dir)
+        CITY_TABLES['city_ids'] = None
+        if CITY_TABLES['info']:
+            CITY_TABLES['city_ids'] = np.load(table_dir + city_table.CITY_IDS_FILE)
+    if (experiment_key, product) not in CITY_TABLES:
+        CITY_TABLES[(experiment_key, product)] = city_table.load_city_table(
+            analysis_parameters.DIR_DASHBOARD_INDEXES,
+            city_table.table_name(experiment_key, product), CITY_TABLES['info'],
+            data_filenames('series', product)[experiment_key],
+            cities_source=get_city_index()['source'])
+    return CITY_TABLES[(experiment_key, product)]
+
+
+def select_city(experiment_key, city_id, product='monthly'):
+    """Selects the time series of the statistics at a city.
+
+    Reads one slice of the city table, or the nearest grid cell of the
+    'series' files if there is no up to date table or the city is not in it.
+
+    Args:
+        experiment_key: String key of the data (e.g. 'ssp126', 'historical_obs').
+        city_id: Integer id of the city (the 'id' column of worldcities.csv).
+        product: String name of the time means to read (see read_data).
+    Returns:
+        Dataset of the time series of each statistic.
+    """
+    table = get_city_table(experiment_key, product)
+    row = None
+    if table is not None:
+        try:
+            row = city_table.city_rows(CITY_TABLES['city_ids'], city_id)
+        except KeyError:
+            # The city was added after the tables were built
+            pass
+    if row is None:
+        [lat, lon] = city_latlons(city_id)
+        return select_data(experiment_key, float(lat), float(lon), product=product)
+    values = np.array(table['values'][row])
+    return xr.Dataset({stat_name: ('time', values[j])
+                       for j, stat_name in enumerate(table['stats'])},
+                      coords={'time': table['time']})
+
+
 def create_country2city2latlon_dict():
     """Creates a country-city, latitude-longitude dictionary.
 
@@ -54,17 +277,10 @@ def create_country2city2latlon_dict():
     down menu that depends on the input of the first.
 
     Returns:
-        my_dict: The city latitude-longitude dictionary.
+        The city latitude-longitude dictionary.
     """
-    my_dict = dict()
-    for country in COUNTRIES:
-        my_dict.update({country: dict()})
-    for i in range(12959):
-        coun = DF['country'].values[i]
-        city = DF['city_ascii'].values[i]
-        lat = DF['lat'].values[i]
-        lon = DF['lng'].values[i]
-        latlon = [lat, lon]
-        my_dict[coun].update({city: latlon})
-
-    return my_dict
+    return city_index.country2city2latlon(get_city_index())
+
+
+if __name__ == '__main__':
+    build_city_tables(print_statements_on=True)